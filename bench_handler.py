@@ -0,0 +1,256 @@
+"""
+Offline benchmark of handler overhead against the stub ComfyUI server.
+
+Starts comfy_stub.py in a child process, then runs each selected handler in its own
+child process through --jobs jobs, one at a time or --concurrency at once, so peak
+RSS is measured per handler.
+Handler-added latency is the job wall time minus the stub's simulated execution time.
+Results are written as JSON for regression tracking.
+
+--instances N starts N stubs and routes rp_handler's jobs over all of them, like a
+worker running one ComfyUI per GPU, best with --concurrency so jobs overlap; the
+report then shows the jobs each instance got and the models it was last seen to
+hold. --error-rate makes the stubs fail prompts, which must not count as loading
+their models.
+
+Usage:
+    python bench_handler.py --jobs 50 --exec-delay 0.5 --output-bytes 2000000 --output bench_output.json
+    python bench_handler.py --handlers rp_handler --instances 2 --concurrency 4 --error-rate 0.2
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import base64
+import random
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from rp_ledger import percentile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDLERS = ("rp_handler", "handlerCOMEXAMPLE")
+EXAMPLE_WORKFLOW = os.path.join(REPO_DIR, "FluxControlNetBlurSameAPI.json")
+
+
+def make_png(width=64, height=64):
+    """Build a small valid RGB PNG so inputs pass the handlers' size checks"""
+    raw = b"".join(
+        b"\x00" + bytes(random.randrange(256) for _ in range(width * 3)) for _ in range(height)
+    )
+
+    def chunk(tag, data):
+        return struct.pack("!I", len(data)) + tag + data + struct.pack("!I", zlib.crc32(tag + data))
+
+    header = struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def make_job_input(handler_name, image_b64):
+    """Representative job input for the given handler"""
+    if handler_name == "rp_handler":
+        return {"prompt": "A bearded man next to a flip chart, studio lighting", "image": image_b64}
+    with open(EXAMPLE_WORKFLOW) as f:
+        workflow = json.load(f)
+    image_name = workflow["1"]["inputs"]["image"]
+    return {"workflow": workflow, "images": [{"name": image_name, "image": image_b64}]}
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def load_handler(handler_name, comfy_host):
+    """Import a handler module and point it at the stub, or at several given comma-separated"""
+    hosts = comfy_host.split(",")
+    comfy_host = hosts[0]
+    os.environ["COMFY_HOST"] = comfy_host
+    module = __import__(handler_name)
+    # handlerCOMEXAMPLE hardcodes its host, both read the module global at call time
+    module.COMFY_HOST = comfy_host
+    if hasattr(module, "OBJECT_INFO"):
+        module.OBJECT_INFO.comfy_host = comfy_host
+    if hasattr(module, "MONITOR"):
+        # Started like the worker's __main__ does, so jobs read its snapshot too
+        module.MONITOR.hosts = hosts if hasattr(module, "INSTANCES") else [comfy_host]
+        module.MONITOR.start()
+    if hasattr(module, "INSTANCES"):
+        module.INSTANCES = type(module.INSTANCES).from_hosts(hosts, monitor=module.INSTANCES.monitor)
+        module.ADMISSION.comfy_hosts = module.INSTANCES.hosts
+    return module
+
+
+def run_worker(args):
+    """Child process: drive one handler through the configured number of jobs"""
+    os.environ.setdefault("COMFY_DIR", tempfile.mkdtemp(prefix="bench-comfy-"))
+    module = load_handler(args.worker, args.comfy_host)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    image_b64 = base64.b64encode(make_png()).decode("utf-8")
+    job_input = make_job_input(args.worker, image_b64)
+    latencies, errors = [], {}
+    sink = open(os.devnull, "w") if not args.verbose else sys.stderr
+
+    with contextlib.redirect_stdout(sink):
+        for i in range(args.warmup):
+            module.handler({"id": f"warmup-{i}", "input": json.loads(json.dumps(job_input))})
+        def run_job(i):
+            job = {"id": f"bench-{i}", "input": json.loads(json.dumps(job_input))}
+            t0 = time.perf_counter()
+            result = module.handler(job)
+            return time.perf_counter() - t0, result
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+            for latency, result in pool.map(run_job, range(args.jobs)):
+                latencies.append(latency)
+                if "error" in result:
+                    key = str(result["error"])[:120]
+                    errors[key] = errors.get(key, 0) + 1
+        wall = time.perf_counter() - started
+
+    overheads = [max(0.0, latency - args.exec_delay) for latency in latencies]
+    result = {
+        "jobs": args.jobs,
+        "errors": sum(errors.values()),
+        "error_mix": errors,
+        "wall_s": wall,
+        "throughput_jobs_per_s": args.jobs / wall if wall else None,
+        "latency_s": summarize(latencies),
+        "handler_overhead_s": summarize(overheads),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if hasattr(module, "INSTANCES") and len(module.INSTANCES.instances) > 1:
+        from rp_metrics import INSTANCE_JOBS
+        result["instances"] = {
+            instance.name: {
+                "jobs": INSTANCE_JOBS.value(instance=instance.name),
+                "resident_models": list(instance.resident),
+            }
+            for instance in module.INSTANCES.instances
+        }
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+
+
+def start_stub(exec_delay, output_bytes, images_per_output=1, error_rate=0.0):
+    """Start comfy_stub.py in a child process and return (process, host:port)"""
+    command = [
+        sys.executable, os.path.join(REPO_DIR, "comfy_stub.py"),
+        "--port", "0",
+        "--exec-delay", str(exec_delay),
+        "--output-bytes", str(output_bytes),
+        "--images-per-output", str(images_per_output),
+        "--error-rate", str(error_rate),
+    ]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = proc.stdout.readline()
+    if "listening on" not in line:
+        proc.kill()
+        raise RuntimeError(f"comfy_stub failed to start: {line!r}")
+    return proc, line.rsplit(" ", 1)[1].strip()
+
+
+def run_benchmark(args):
+    stubs, hosts = [], []
+    for _ in range(args.instances):
+        stub, host = start_stub(args.exec_delay, args.output_bytes, args.images_per_output, args.error_rate)
+        stubs.append(stub)
+        hosts.append(host)
+    comfy_host = ",".join(hosts)
+    results = {}
+    try:
+        for handler_name in args.handlers:
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+                result_file = tmp.name
+            command = [
+                sys.executable, os.path.abspath(__file__),
+                "--worker", handler_name,
+                "--comfy-host", comfy_host,
+                "--result-file", result_file,
+                "--jobs", str(args.jobs),
+                "--warmup", str(args.warmup),
+                "--exec-delay", str(args.exec_delay),
+                "--concurrency", str(args.concurrency),
+            ]
+            if args.verbose:
+                command.append("--verbose")
+            completed = subprocess.run(command, cwd=REPO_DIR)
+            if completed.returncode != 0:
+                results[handler_name] = {"failed": True, "returncode": completed.returncode}
+            else:
+                with open(result_file) as f:
+                    results[handler_name] = json.load(f)
+            os.remove(result_file)
+    finally:
+        for stub in stubs:
+            stub.terminate()
+            stub.wait(timeout=10)
+
+    return {
+        "benchmark": "handler_overhead",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "config": {
+            "jobs": args.jobs,
+            "warmup": args.warmup,
+            "exec_delay_s": args.exec_delay,
+            "output_bytes": args.output_bytes,
+            "images_per_output": args.images_per_output,
+            "instances": args.instances,
+            "concurrency": args.concurrency,
+            "error_rate": args.error_rate,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark handler overhead against comfy_stub.py")
+    parser.add_argument("--handlers", nargs="+", default=list(HANDLERS), choices=HANDLERS)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--exec-delay", type=float, default=0.5, help="Simulated execution seconds per job")
+    parser.add_argument("--output-bytes", type=int, default=1_000_000)
+    parser.add_argument("--images-per-output", type=int, default=1)
+    parser.add_argument("--instances", type=int, default=1, help="Stub ComfyUI servers rp_handler routes over")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Stub execution failure rate")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs run at the same time")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show handler logs")
+    # Internal: run a single handler in this process
+    parser.add_argument("--worker", choices=HANDLERS, help=argparse.SUPPRESS)
+    parser.add_argument("--comfy-host", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        return run_worker(args)
+
+    report = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,641 @@
+"""
+Stub ComfyUI server for benchmarking and load testing the handlers without a GPU.
+
+Implements the parts of ComfyUI's HTTP and websocket API the handlers talk to:
+/, /object_info, /prompt, /queue, /history/{id}, /view, /upload/image, /interrupt
+and /ws.
+Prompts are "executed" one at a time by a background thread that walks the graph
+in dependency order, sleeps for a configurable delay and emits the same
+status / execution_start / executing / executed / execution_success events as
+ComfyUI. Output nodes produce files of a configurable size served from /view;
+SaveImageWebsocket nodes send them as binary websocket frames instead.
+
+Usage:
+    python comfy_stub.py --port 8188 --exec-delay 2.0 --output-bytes 2000000
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+import collections
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Workflows whose node types the stub advertises through /object_info
+DEFAULT_SCHEMA_WORKFLOWS = [
+    os.path.join(REPO_DIR, "FluxControlNetBlurSameAPI.json"),
+    os.path.join(REPO_DIR, "FluxControlNetTileSamePOD.json"),
+]
+# Node types that write images and show up under "outputs" in /history
+OUTPUT_CLASS_TYPES = {"SaveImage", "SaveImagePlus", "PreviewImage"}
+# websocket_image_save's node: sends images as binary frames instead of saving them
+WEBSOCKET_SAVE_CLASS_TYPE = "SaveImageWebsocket"
+# Binary frame header for a PNG image (PREVIEW_IMAGE event, PNG format)
+_WS_IMAGE_HEADER = struct.pack(">II", 1, 2)
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def _is_link(value):
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], str)
+        and isinstance(value[1], int)
+    )
+
+
+def build_object_info(workflows):
+    """Derive a minimal /object_info schema from API-format workflows"""
+    object_info = {}
+    for workflow in workflows:
+        for node in workflow.values():
+            class_type = node.get("class_type")
+            if not class_type:
+                continue
+            entry = object_info.setdefault(class_type, {
+                "input": {"required": {}, "optional": {}},
+                "output": [],
+                "name": class_type,
+                "display_name": node.get("_meta", {}).get("title", class_type),
+                "category": "stub",
+                "output_node": class_type in OUTPUT_CLASS_TYPES,
+            })
+            required = entry["input"]["required"]
+            for name, value in node.get("inputs", {}).items():
+                if _is_link(value):
+                    required.setdefault(name, ["*"])
+                elif isinstance(value, bool):
+                    required.setdefault(name, ["BOOLEAN"])
+                elif isinstance(value, int):
+                    required.setdefault(name, ["INT", {"default": value}])
+                elif isinstance(value, float):
+                    required.setdefault(name, ["FLOAT", {"default": value}])
+                elif isinstance(value, str) and name in ("text", "clip_l", "t5xxl", "filename_prefix"):
+                    required.setdefault(name, ["STRING", {"default": value}])
+                else:
+                    # Anything else is treated like a combo (model names, enums, ...)
+                    spec = required.setdefault(name, [[]])
+                    if class_type == "LoadImage" and name == "image" and len(spec) == 1:
+                        # Job input images are uploaded with the job, like in ComfyUI
+                        spec.append({"image_upload": True})
+                    if value not in spec[0]:
+                        spec[0].append(value)
+    # Outputs are untyped; every slot some workflow links to exists
+    for workflow in workflows:
+        for node in workflow.values():
+            for value in node.get("inputs", {}).values():
+                source = workflow.get(value[0]) if _is_link(value) else None
+                if source and source.get("class_type") in object_info:
+                    outputs = object_info[source["class_type"]]["output"]
+                    outputs.extend(["*"] * (value[1] + 1 - len(outputs)))
+    return object_info
+
+
+def load_schema_workflows(paths=None):
+    workflows = []
+    for path in paths or DEFAULT_SCHEMA_WORKFLOWS:
+        try:
+            with open(path) as f:
+                workflows.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Stub could not load schema workflow {path}: {str(e)}")
+    return workflows
+
+
+def _topological_order(workflow):
+    """Return node ids so that every node comes after the nodes it links to"""
+    deps = {
+        node_id: {v[0] for v in node.get("inputs", {}).values() if _is_link(v) and v[0] in workflow}
+        for node_id, node in workflow.items()
+    }
+    order, done = [], set()
+    while len(order) < len(deps):
+        ready = [n for n, d in deps.items() if n not in done and d <= done]
+        if not ready:
+            # Cycle or dangling reference, keep the remaining nodes in file order
+            ready = [n for n in deps if n not in done]
+        for node_id in ready:
+            order.append(node_id)
+            done.add(node_id)
+    return order
+
+
+class _WebSocketClient:
+    """Server side of one websocket connection (text and binary frames only)"""
+
+    def __init__(self, client_id, rfile, wfile):
+        self.client_id = client_id
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def _send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(length)
+        elif length < 65536:
+            header.append(126)
+            header += struct.pack("!H", length)
+        else:
+            header.append(127)
+            header += struct.pack("!Q", length)
+        with self._lock:
+            if self.closed:
+                return False
+            try:
+                self.wfile.write(bytes(header) + payload)
+                self.wfile.flush()
+                return True
+            except OSError:
+                self.closed = True
+                return False
+
+    def send_json(self, message):
+        return self._send_frame(0x1, json.dumps(message).encode("utf-8"))
+
+    def send_binary(self, payload):
+        return self._send_frame(0x2, payload)
+
+    def close(self):
+        self._send_frame(0x8, b"")
+        self.closed = True
+
+    def serve(self):
+        """Read client frames until the connection closes"""
+        while not self.closed:
+            try:
+                head = self.rfile.read(2)
+                if len(head) < 2:
+                    break
+                opcode = head[0] & 0x0F
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.rfile.read(8))[0]
+                mask = self.rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(length)))
+            except (OSError, struct.error):
+                break
+            if opcode == 0x8:
+                self.close()
+                break
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+        self.closed = True
+
+
+class StubComfyUI:
+    """In-process fake ComfyUI server
+
+    Args:
+        port (int): Port to listen on, 0 picks a free one.
+        exec_delay_s (float): Simulated execution time per prompt, spread over its nodes.
+        output_bytes (int): Size of every generated output image.
+        images_per_output (int): Images produced by each output node.
+        error_rate (float): Fraction of prompts that fail with an execution_error.
+        schema_workflows (list): Paths of workflows used to build /object_info.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, exec_delay_s=0.5, output_bytes=1_000_000,
+                 images_per_output=1, error_rate=0.0, schema_workflows=None):
+        self.exec_delay_s = exec_delay_s
+        self.output_bytes = output_bytes
+        self.images_per_output = images_per_output
+        self.error_rate = error_rate
+        self.object_info = build_object_info(load_schema_workflows(schema_workflows))
+        self.object_info.setdefault(WEBSOCKET_SAVE_CLASS_TYPE, {
+            "input": {"required": {"images": ["IMAGE"]}, "optional": {}},
+            "output": [],
+            "name": WEBSOCKET_SAVE_CLASS_TYPE,
+            "display_name": WEBSOCKET_SAVE_CLASS_TYPE,
+            "category": "api node/image",
+            "output_node": True,
+        })
+        self.output_data = os.urandom(output_bytes)
+        self.uploads = {}
+        self.history = {}
+        self.outputs = {}
+        self.prompts_received = 0
+        self.frees = 0
+
+        self._lock = threading.Lock()
+        self._work_available = threading.Condition(self._lock)
+        self._pending = collections.deque()
+        self._running = None
+        self._interrupt = threading.Event()
+        self._number = 0
+        self._file_counter = 0
+        self._ws_clients = {}
+        self._stopping = False
+
+        handler_class = type("StubRequestHandler", (_StubRequestHandler,), {"stub": self})
+        self.server = ThreadingHTTPServer((host, port), handler_class)
+        self.server.daemon_threads = True
+        self._threads = []
+
+    @property
+    def host(self):
+        """host:port string in the format the handlers expect for COMFY_HOST"""
+        address, port = self.server.server_address[:2]
+        return f"{address}:{port}"
+
+    def start(self):
+        for target, name in ((self.server.serve_forever, "stub-http"), (self._executor, "stub-executor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Stub ComfyUI listening on {self.host}")
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._work_available.notify_all()
+            clients = [c for group in self._ws_clients.values() for c in group]
+        for client in clients:
+            client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- queue -------------------------------------------------------------
+
+    def queue_prompt(self, workflow, client_id=None):
+        prompt_id = str(uuid.uuid4())
+        with self._lock:
+            self._number += 1
+            self.prompts_received += 1
+            self._pending.append({
+                "prompt_id": prompt_id,
+                "number": self._number,
+                "prompt": workflow,
+                "client_id": client_id,
+            })
+            number = self._number
+            self._work_available.notify()
+        self._broadcast_status()
+        return {"prompt_id": prompt_id, "number": number, "node_errors": {}}
+
+    def queue_state(self):
+        def entry(item):
+            return [item["number"], item["prompt_id"], item["prompt"], {"client_id": item["client_id"]}, []]
+
+        with self._lock:
+            running = [entry(self._running)] if self._running else []
+            pending = [entry(item) for item in self._pending]
+        return {"queue_running": running, "queue_pending": pending}
+
+    def system_stats(self):
+        """/system_stats with a fake 24 GB GPU whose free VRAM drops while a prompt runs"""
+        vram_total = 24 * 1024 ** 3
+        with self._lock:
+            vram_used = (12 if self._running else 4) * 1024 ** 3
+        return {
+            "system": {
+                "os": "posix", "comfyui_version": "stub", "embedded_python": False,
+                "ram_total": 64 * 1024 ** 3, "ram_free": 48 * 1024 ** 3,
+            },
+            "devices": [{
+                "name": "cuda:0 comfy_stub", "type": "cuda", "index": 0,
+                "vram_total": vram_total, "vram_free": vram_total - vram_used,
+                "torch_vram_total": vram_used, "torch_vram_free": 0,
+            }],
+        }
+
+    def queue_remaining(self):
+        with self._lock:
+            return len(self._pending) + (1 if self._running else 0)
+
+    def delete_pending(self, prompt_ids=None):
+        """Drop pending prompts (all of them when prompt_ids is None), like POST /queue"""
+        with self._lock:
+            kept = [item for item in self._pending
+                    if prompt_ids is not None and item["prompt_id"] not in prompt_ids]
+            deleted = len(self._pending) - len(kept)
+            self._pending = collections.deque(kept)
+        if deleted:
+            self._broadcast_status()
+        return deleted
+
+    def interrupt(self, prompt_id=None):
+        """Stop the running prompt; with a prompt_id only if that prompt is running"""
+        with self._lock:
+            if self._running and (prompt_id is None or self._running["prompt_id"] == prompt_id):
+                self._interrupt.set()
+                return True
+        return False
+
+    # --- websocket ---------------------------------------------------------
+
+    def register_ws(self, client):
+        with self._lock:
+            self._ws_clients.setdefault(client.client_id, []).append(client)
+        client.send_json(self._status_message())
+
+    def unregister_ws(self, client):
+        with self._lock:
+            group = self._ws_clients.get(client.client_id, [])
+            if client in group:
+                group.remove(client)
+
+    def _status_message(self):
+        return {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}}}
+
+    def _send(self, client_id, message):
+        with self._lock:
+            clients = list(self._ws_clients.get(client_id, []))
+        for client in clients:
+            client.send_json(message)
+
+    def _send_binary(self, client_id, payload):
+        with self._lock:
+            clients = list(self._ws_clients.get(client_id, []))
+        for client in clients:
+            client.send_binary(payload)
+
+    def _broadcast_status(self):
+        message = self._status_message()
+        with self._lock:
+            clients = [c for group in self._ws_clients.values() for c in group]
+        for client in clients:
+            client.send_json(message)
+
+    # --- execution ---------------------------------------------------------
+
+    def _executor(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopping:
+                    self._work_available.wait()
+                if self._stopping:
+                    return
+                self._running = self._pending.popleft()
+                self._interrupt.clear()
+                item = self._running
+            try:
+                self._execute(item)
+            except Exception as e:
+                logger.error(f"Stub executor failed on {item['prompt_id']}: {str(e)}")
+            with self._lock:
+                self._running = None
+            self._broadcast_status()
+
+    def _execute(self, item):
+        prompt_id, client_id, workflow = item["prompt_id"], item["client_id"], item["prompt"]
+        messages = []
+
+        def emit(msg_type, data):
+            data = dict(data, prompt_id=prompt_id, timestamp=int(time.time() * 1000))
+            if msg_type.startswith("execution_"):
+                messages.append([msg_type, data])
+            self._send(client_id, {"type": msg_type, "data": data})
+
+        emit("execution_start", {})
+        emit("execution_cached", {"nodes": []})
+        order = _topological_order(workflow)
+        per_node_delay = self.exec_delay_s / max(1, len(order))
+        fail_at = random.randrange(len(order)) if order and random.random() < self.error_rate else None
+        outputs = {}
+
+        for index, node_id in enumerate(order):
+            node = workflow[node_id]
+            emit("executing", {"node": node_id, "display_node": node_id})
+            if per_node_delay:
+                self._interrupt.wait(per_node_delay)
+            if self._interrupt.is_set():
+                emit("execution_interrupted", {
+                    "node_id": node_id,
+                    "node_type": node.get("class_type"),
+                    "executed": list(outputs),
+                })
+                self._finish(prompt_id, workflow, outputs, messages, "error")
+                return
+            if index == fail_at:
+                emit("execution_error", {
+                    "node_id": node_id,
+                    "node_type": node.get("class_type"),
+                    "exception_message": "Simulated failure from comfy_stub",
+                    "exception_type": "RuntimeError",
+                    "traceback": [],
+                })
+                self._finish(prompt_id, workflow, outputs, messages, "error")
+                return
+            if node.get("class_type") == WEBSOCKET_SAVE_CLASS_TYPE:
+                for _ in range(self.images_per_output):
+                    self._send_binary(client_id, _WS_IMAGE_HEADER + self.output_data)
+            if node.get("class_type") in OUTPUT_CLASS_TYPES:
+                output = {"images": self._write_outputs(node)}
+                outputs[node_id] = output
+                emit("executed", {"node": node_id, "display_node": node_id, "output": output})
+
+        emit("executing", {"node": None})
+        emit("execution_success", {})
+        self._finish(prompt_id, workflow, outputs, messages, "success")
+
+    def _write_outputs(self, node):
+        prefix = str(node.get("inputs", {}).get("filename_prefix", "ComfyUI"))
+        file_type = "temp" if node.get("class_type") == "PreviewImage" else "output"
+        images = []
+        with self._lock:
+            for _ in range(self.images_per_output):
+                self._file_counter += 1
+                filename = f"{prefix}_{self._file_counter:05d}_.webp"
+                self.outputs[filename] = self.output_data
+                images.append({"filename": filename, "subfolder": "", "type": file_type})
+        return images
+
+    def _finish(self, prompt_id, workflow, outputs, messages, status_str):
+        with self._lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {}, list(outputs)],
+                "outputs": outputs,
+                "status": {
+                    "status_str": status_str,
+                    "completed": status_str == "success",
+                    "messages": messages,
+                },
+                "meta": {},
+            }
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        path = parsed.path
+
+        if path == "/ws":
+            return self._serve_websocket(query.get("clientId", [str(uuid.uuid4())])[0])
+        if path == "/":
+            return self._send_bytes(b"<html><body>comfy_stub</body></html>", "text/html")
+        if path == "/object_info":
+            return self._send_json(self.stub.object_info)
+        if path.startswith("/object_info/"):
+            class_type = urllib.parse.unquote(path[len("/object_info/"):])
+            info = self.stub.object_info.get(class_type)
+            return self._send_json({class_type: info} if info else {})
+        if path == "/queue":
+            return self._send_json(self.stub.queue_state())
+        if path == "/system_stats":
+            return self._send_json(self.stub.system_stats())
+        if path == "/prompt":
+            return self._send_json({"exec_info": {"queue_remaining": self.stub.queue_remaining()}})
+        if path.startswith("/history/"):
+            prompt_id = path[len("/history/"):]
+            with self.stub._lock:
+                entry = self.stub.history.get(prompt_id)
+            return self._send_json({prompt_id: entry} if entry else {})
+        if path == "/history":
+            with self.stub._lock:
+                return self._send_json(dict(self.stub.history))
+        if path == "/view":
+            filename = query.get("filename", [""])[0]
+            with self.stub._lock:
+                data = self.stub.outputs.get(filename) or self.stub.uploads.get(filename)
+            if data is None:
+                return self._send_bytes(b"Not Found", "text/plain", status=404)
+            return self._send_bytes(data, "image/webp")
+        self._send_bytes(b"Not Found", "text/plain", status=404)
+
+    def do_POST(self):
+        path = urllib.parse.urlparse(self.path).path
+        body = self._read_body()
+
+        if path == "/prompt":
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                return self._send_json({"error": "invalid json"}, status=400)
+            workflow = payload.get("prompt")
+            if not isinstance(workflow, dict) or not workflow:
+                return self._send_json({
+                    "error": {"type": "invalid_prompt", "message": "Prompt has no nodes"},
+                    "node_errors": {},
+                }, status=400)
+            return self._send_json(self.stub.queue_prompt(workflow, payload.get("client_id")))
+        if path == "/upload/image":
+            match = re.search(rb'name="image"; filename="([^"]*)"', body)
+            if not match:
+                return self._send_bytes(b"No image", "text/plain", status=400)
+            filename = match.group(1).decode("utf-8", "replace")
+            data_start = body.find(b"\r\n\r\n", match.end()) + 4
+            boundary_end = body.find(b"\r\n--", data_start)
+            with self.stub._lock:
+                self.stub.uploads[filename] = body[data_start:boundary_end if boundary_end > 0 else None]
+            return self._send_json({"name": filename, "subfolder": "", "type": "input"})
+        if path == "/free":
+            # ComfyUI only sets flags the prompt worker acts on between prompts
+            with self.stub._lock:
+                self.stub.frees += 1
+            return self._send_bytes(b"", "text/plain")
+        if path in ("/queue", "/interrupt"):
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                return self._send_json({"error": "invalid json"}, status=400)
+            if path == "/interrupt":
+                self.stub.interrupt(payload.get("prompt_id"))
+            elif payload.get("clear"):
+                self.stub.delete_pending()
+            elif payload.get("delete"):
+                self.stub.delete_pending(set(payload["delete"]))
+            return self._send_bytes(b"", "text/plain")
+        self._send_bytes(b"Not Found", "text/plain", status=404)
+
+    def _serve_websocket(self, client_id):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if not key or "websocket" not in (self.headers.get("Upgrade") or "").lower():
+            return self._send_bytes(b"Expected websocket upgrade", "text/plain", status=400)
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        client = _WebSocketClient(client_id, self.rfile, self.wfile)
+        self.stub.register_ws(client)
+        try:
+            client.serve()
+        finally:
+            self.stub.unregister_ws(client)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--exec-delay", type=float, default=0.5, help="Seconds of simulated execution per prompt")
+    parser.add_argument("--output-bytes", type=int, default=1_000_000, help="Size of each output image")
+    parser.add_argument("--images-per-output", type=int, default=1)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of prompts that fail")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    stub = StubComfyUI(
+        host=args.host,
+        port=args.port,
+        exec_delay_s=args.exec_delay,
+        output_bytes=args.output_bytes,
+        images_per_output=args.images_per_output,
+        error_rate=args.error_rate,
+    ).start()
+    # Parent processes (bench_handler.py) read the bound address from this line
+    print(f"comfy_stub listening on {stub.host}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
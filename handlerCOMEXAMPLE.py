@@ -5,14 +5,48 @@ import urllib.request
 import urllib.parse
 import time
 import os
+import random
 import requests
 import base64
-from io import BytesIO
 import websocket
 import uuid
 import tempfile
 import socket
-import traceback
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from rp_metrics import (
+    start_metrics_server,
+    JOBS,
+    ERRORS,
+    CACHE_HITS,
+    QUEUE_DEPTH,
+    STAGE_SECONDS,
+)
+from rp_trace import traced_stage, trace_for_job, attach_trace
+from rp_admission import AdmissionController, ADMISSION_PREFETCH
+from rp_health import HealthMonitor
+from rp_janitor import Janitor
+from rp_inputs import stage_images
+from rp_staging import StagingArea
+from rp_ws_output import output_mode, swap_save_nodes, WebsocketImageCollector
+from rp_workflow_opt import optimize_mode, optimize_workflow, record_report
+from rp_scheduler import PromptScheduler, job_priority, estimate_cost, tail_nodes
+from rp_schema import ObjectInfoCache, validate_with_refresh, VALIDATE_WORKFLOWS
+from rp_deadline import (
+    deadline_for_job,
+    release_deadline,
+    abort_prompt,
+    async_handler,
+)
+from rp_logging import configure_logging, job_context, set_prompt_id
+from rp_ledger import JobLedger, note, note_stage, note_cache_hits
+from rp_refresh import RefreshPolicy
+from rp_residency import ResidencyManager, RESIDENCY_MODEL_DIRS
+
+# Log records are formatted and written by a background thread (LOG_LEVEL, LOG_FORMAT)
+configure_logging()
+logger = logging.getLogger("worker-comfyui")
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
@@ -21,11 +55,23 @@ COMFY_API_AVAILABLE_MAX_RETRIES = 500
 # Websocket reconnection behaviour (can be overridden through environment variables)
 # NOTE: more attempts and diagnostics improve debuggability whenever ComfyUI crashes mid-job.
 #   • WEBSOCKET_RECONNECT_ATTEMPTS sets how many times we will try to reconnect.
-#   • WEBSOCKET_RECONNECT_DELAY_S sets the sleep in seconds between attempts.
+#   • WEBSOCKET_RECONNECT_BASE_DELAY_S is the first backoff step; it doubles per attempt
+#     and each sleep is drawn at random up to the current step (full jitter).
+#   • WEBSOCKET_RECONNECT_DELAY_S caps the backoff step in seconds.
 #
-# If the respective env-vars are not supplied we fall back to sensible defaults ("5" and "3").
-WEBSOCKET_RECONNECT_ATTEMPTS = int(os.environ.get("WEBSOCKET_RECONNECT_ATTEMPTS", 5))
-WEBSOCKET_RECONNECT_DELAY_S = int(os.environ.get("WEBSOCKET_RECONNECT_DELAY_S", 3))
+# If the respective env-vars are not supplied we fall back to sensible defaults ("8", "0.05" and "3").
+WEBSOCKET_RECONNECT_ATTEMPTS = int(os.environ.get("WEBSOCKET_RECONNECT_ATTEMPTS", 8))
+WEBSOCKET_RECONNECT_BASE_DELAY_S = float(
+    os.environ.get("WEBSOCKET_RECONNECT_BASE_DELAY_S", 0.05)
+)
+WEBSOCKET_RECONNECT_DELAY_S = float(os.environ.get("WEBSOCKET_RECONNECT_DELAY_S", 3))
+
+# Output images fetched, encoded and uploaded at the same time
+OUTPUT_CONCURRENCY = int(os.environ.get("OUTPUT_CONCURRENCY", 4))
+
+# Receive timeout while waiting for execution events; bounds how quickly a
+# cancelled or expired job notices and frees ComfyUI
+WEBSOCKET_RECV_TIMEOUT_S = 1.0
 
 # Extra verbose websocket trace logs (set WEBSOCKET_TRACE=true to enable)
 if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
@@ -35,19 +81,66 @@ if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
 
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
-# Enforce a clean state after each job is done
-# see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
-REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# ComfyUI install directory, whose input/output/temp folders the janitor keeps in check
+COMFY_DIR = os.environ.get("COMFY_DIR", "/comfyui")
+# Label used for this handler's metrics
+HANDLER_NAME = "handlerCOMEXAMPLE"
+# Polls /system_stats and /queue in the background so jobs and admission skip the round trips
+MONITOR = HealthMonitor([COMFY_HOST])
+# Decides per job whether to return refresh_worker, see REFRESH_WORKER in rp_refresh
+# and https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
+REFRESH = RefreshPolicy(monitor=MONITOR)
+# Frees ComfyUI's VRAM only when the next workflow's models don't fit next to the loaded ones
+RESIDENCY = ResidencyManager(RESIDENCY_MODEL_DIRS or [os.path.join(COMFY_DIR, "models")], monitor=MONITOR)
+# Queues prompts by priority, model residency and estimated cost instead of arrival order
+SCHEDULER = PromptScheduler(swap_rank=RESIDENCY.swap_rank)
+# Stops RunPod from sending more jobs while ComfyUI's queue is backed up or a refresh is due
+# (without prefetch when the worker is refreshed after every job, so no job runs on a used one)
+ADMISSION = AdmissionController(
+    COMFY_HOST, held_jobs=SCHEDULER.waiting, pause_reason=REFRESH.pending_reason,
+    prefetch=0 if REFRESH.exclusive else ADMISSION_PREFETCH,
+)
+
+
+def _on_health_poll(monitor):
+    """Feed the queue depth of every health poll into admission control"""
+    if monitor.any_reachable():
+        ADMISSION.observe_queue(*monitor.queue_totals())
+
+
+MONITOR.add_listener(_on_health_poll)
+# ComfyUI is started elsewhere, so its folders are only staged when COMFY_STAGING_DIR says
+# it was launched with them (python rp_staging.py prints the arguments)
+STAGING = StagingArea(COMFY_DIR, launches_comfyui=False)
+# Deletes delivered outputs and enforces disk quotas on ComfyUI's folders
+JANITOR = Janitor(COMFY_DIR, roots=STAGING.roots(), on_delete=STAGING.released)
+# ComfyUI's /object_info, fetched once and shared by validation, optimization and error hints
+OBJECT_INFO = ObjectInfoCache(COMFY_HOST)
+# Appends one SQLite row per job for capacity planning
+LEDGER = JobLedger()
 
 # ---------------------------------------------------------------------------
 # Helper: quick reachability probe of ComfyUI HTTP endpoint (port 8188)
 # ---------------------------------------------------------------------------
 
 
-def _comfy_server_status():
+def _request_timeout(deadline, default):
+    """Cap an HTTP or websocket timeout by the job's deadline, if there is one."""
+    return deadline.timeout(default) if deadline else default
+
+
+def _wait(deadline, seconds):
+    """Sleep, cut short when the job is cancelled or expires; True if the job should stop."""
+    if deadline:
+        return deadline.wait(seconds)
+    time.sleep(seconds)
+    return False
+
+
+def _comfy_server_status(deadline=None):
     """Return a dictionary with basic reachability info for the ComfyUI HTTP server."""
     try:
-        resp = requests.get(f"http://{COMFY_HOST}/", timeout=5)
+        resp = requests.get(f"http://{COMFY_HOST}/", timeout=_request_timeout(deadline, 5))
         return {
             "reachable": resp.status_code == 200,
             "status_code": resp.status_code,
@@ -56,15 +149,35 @@ def _comfy_server_status():
         return {"reachable": False, "error": str(exc)}
 
 
-def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
+def _reconnect_delay(attempt, base_s, max_s):
+    """
+    Jittered exponential backoff: a random delay up to base_s * 2**attempt, capped at max_s.
+
+    Args:
+        attempt (int): Zero-based index of the attempt that just failed.
+        base_s (float): First backoff step in seconds.
+        max_s (float): Largest backoff step in seconds.
+
+    Returns:
+        float: Seconds to sleep before the next attempt.
+    """
+    return random.uniform(0, min(max_s, base_s * (2**attempt)))
+
+
+def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error, deadline=None):
     """
     Attempts to reconnect to the WebSocket server after a disconnect.
 
+    The first attempt is immediate, later ones back off exponentially with jitter starting
+    at WEBSOCKET_RECONNECT_BASE_DELAY_S, so a brief drop costs milliseconds rather than seconds.
+
     Args:
         ws_url (str): The WebSocket URL (including client_id).
         max_attempts (int): Maximum number of reconnection attempts.
-        delay_s (int): Delay in seconds between attempts.
+        delay_s (float): Upper bound in seconds for the delay between attempts.
         initial_error (Exception): The error that triggered the reconnect attempt.
+        deadline (JobDeadline, optional): Caps each attempt's timeouts and stops the
+            retries once the job is cancelled or expired.
 
     Returns:
         websocket.WebSocket: The newly connected WebSocket object.
@@ -72,35 +185,39 @@ def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
     Raises:
         websocket.WebSocketConnectionClosedException: If reconnection fails after all attempts.
     """
-    print(
-        f"worker-comfyui - Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect..."
+    logger.warning(
+        f"Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect..."
     )
     last_reconnect_error = initial_error
     for attempt in range(max_attempts):
+        if deadline and deadline.stop_reason():
+            raise websocket.WebSocketConnectionClosedException(
+                f"Websocket reconnect abandoned: {deadline.describe()}"
+            )
         # Log current server status before each reconnect attempt so that we can
         # see whether ComfyUI is still alive (HTTP port 8188 responding) even if
         # the websocket dropped. This is extremely useful to differentiate
         # between a network glitch and an outright ComfyUI crash/OOM-kill.
-        srv_status = _comfy_server_status()
+        srv_status = _comfy_server_status(deadline)
         if not srv_status["reachable"]:
             # If ComfyUI itself is down there is no point in retrying the websocket –
             # bail out immediately so the caller gets a clear "ComfyUI crashed" error.
-            print(
-                f"worker-comfyui - ComfyUI HTTP unreachable – aborting websocket reconnect: {srv_status.get('error', 'status '+str(srv_status.get('status_code')))}"
+            logger.warning(
+                f"ComfyUI HTTP unreachable – aborting websocket reconnect: {srv_status.get('error', 'status '+str(srv_status.get('status_code')))}"
             )
             raise websocket.WebSocketConnectionClosedException(
                 "ComfyUI HTTP unreachable during websocket reconnect"
             )
 
         # Otherwise we proceed with reconnect attempts while server is up
-        print(
-            f"worker-comfyui - Reconnect attempt {attempt + 1}/{max_attempts}... (ComfyUI HTTP reachable, status {srv_status.get('status_code')})"
+        logger.info(
+            f"Reconnect attempt {attempt + 1}/{max_attempts}... (ComfyUI HTTP reachable, status {srv_status.get('status_code')})"
         )
         try:
             # Need to create a new socket object for reconnect
             new_ws = websocket.WebSocket()
-            new_ws.connect(ws_url, timeout=10)  # Use existing ws_url
-            print(f"worker-comfyui - Websocket reconnected successfully.")
+            new_ws.connect(ws_url, timeout=_request_timeout(deadline, 10))  # Use existing ws_url
+            logger.info(f"Websocket reconnected successfully.")
             return new_ws  # Return the new connected socket
         except (
             websocket.WebSocketException,
@@ -109,19 +226,22 @@ def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
             OSError,
         ) as reconn_err:
             last_reconnect_error = reconn_err
-            print(
-                f"worker-comfyui - Reconnect attempt {attempt + 1} failed: {reconn_err}"
+            logger.warning(
+                f"Reconnect attempt {attempt + 1} failed: {reconn_err}"
             )
             if attempt < max_attempts - 1:
-                print(
-                    f"worker-comfyui - Waiting {delay_s} seconds before next attempt..."
+                wait_s = _reconnect_delay(
+                    attempt, WEBSOCKET_RECONNECT_BASE_DELAY_S, delay_s
+                )
+                logger.debug(
+                    f"Waiting {wait_s:.3f} seconds before next attempt..."
                 )
-                time.sleep(delay_s)
+                _wait(deadline, wait_s)
             else:
-                print(f"worker-comfyui - Max reconnection attempts reached.")
+                logger.error(f"Max reconnection attempts reached.")
 
     # If loop completes without returning, raise an exception
-    print("worker-comfyui - Failed to reconnect websocket after connection closed.")
+    logger.error("Failed to reconnect websocket after connection closed.")
     raise websocket.WebSocketConnectionClosedException(
         f"Connection closed and failed to reconnect. Last error: {last_reconnect_error}"
     )
@@ -165,11 +285,25 @@ def validate_input(job_input):
                 "'images' must be a list of objects with 'name' and 'image' keys",
             )
 
+    # Validate 'output_mode', 'optimize' and 'priority', if provided
+    try:
+        mode = output_mode(job_input)
+        optimize = optimize_mode(job_input)
+        priority = job_priority(job_input)
+    except ValueError as e:
+        return None, str(e)
+
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return {
+        "workflow": workflow,
+        "images": images,
+        "output_mode": mode,
+        "optimize": optimize,
+        "priority": priority,
+    }, None
 
 
-def check_server(url, retries=500, delay=50):
+def check_server(url, retries=500, delay=50, deadline=None):
     """
     Check if a server is reachable via HTTP GET request
 
@@ -177,19 +311,20 @@ def check_server(url, retries=500, delay=50):
     - url (str): The URL to check
     - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
     - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+    - deadline (JobDeadline, optional): Caps each request and stops retrying once the job stops
 
     Returns:
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
 
-    print(f"worker-comfyui - Checking API server at {url}...")
+    logger.debug(f"Checking API server at {url}...")
     for i in range(retries):
         try:
-            response = requests.get(url, timeout=5)
+            response = requests.get(url, timeout=_request_timeout(deadline, 5))
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
-                print(f"worker-comfyui - API is reachable")
+                logger.debug(f"API is reachable")
                 return True
         except requests.Timeout:
             pass
@@ -197,20 +332,27 @@ def check_server(url, retries=500, delay=50):
             pass
 
         # Wait for the specified delay before retrying
-        time.sleep(delay / 1000)
+        if _wait(deadline, delay / 1000):
+            logger.warning(f"Stopped checking {url}: {deadline.describe()}")
+            return False
 
-    print(
-        f"worker-comfyui - Failed to connect to server at {url} after {retries} attempts."
+    logger.error(
+        f"Failed to connect to server at {url} after {retries} attempts."
     )
     return False
 
 
-def upload_images(images):
+def upload_images(images, deadline=None):
     """
-    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+    Upload a list of base64 encoded images to ComfyUI, all at the same time.
+
+    Images are written straight into ComfyUI's input folder (COMFY_DIR/input or the
+    staging area, see rp_staging) when it exists on this machine, otherwise they are posted to the /upload/image endpoint over pooled connections
+    (see INPUT_STAGING).
 
     Args:
         images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
+        deadline (JobDeadline, optional): Caps the upload timeouts.
 
     Returns:
         dict: A dictionary indicating success or error.
@@ -218,88 +360,48 @@ def upload_images(images):
     if not images:
         return {"status": "success", "message": "No images to upload", "details": []}
 
-    responses = []
-    upload_errors = []
-
-    print(f"worker-comfyui - Uploading {len(images)} image(s)...")
-
-    for image in images:
-        try:
-            name = image["name"]
-            image_data_uri = image["image"]  # Get the full string (might have prefix)
-
-            # --- Strip Data URI prefix if present ---
-            if "," in image_data_uri:
-                # Find the comma and take everything after it
-                base64_data = image_data_uri.split(",", 1)[1]
-            else:
-                # Assume it's already pure base64
-                base64_data = image_data_uri
-            # --- End strip ---
-
-            blob = base64.b64decode(base64_data)  # Decode the cleaned data
-
-            # Prepare the form data
-            files = {
-                "image": (name, BytesIO(blob), "image/png"),
-                "overwrite": (None, "true"),
-            }
-
-            # POST request to upload the image
-            response = requests.post(
-                f"http://{COMFY_HOST}/upload/image", files=files, timeout=30
-            )
-            response.raise_for_status()
+    logger.info(f"Uploading {len(images)} image(s)...")
 
-            responses.append(f"Successfully uploaded {name}")
-            print(f"worker-comfyui - Successfully uploaded {name}")
-
-        except base64.binascii.Error as e:
-            error_msg = f"Error decoding base64 for {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except requests.Timeout:
-            error_msg = f"Timeout uploading {image.get('name', 'unknown')}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except requests.RequestException as e:
-            error_msg = f"Error uploading {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except Exception as e:
-            error_msg = (
-                f"Unexpected error uploading {image.get('name', 'unknown')}: {e}"
-            )
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+    staged, upload_errors = stage_images(
+        images,
+        COMFY_HOST,
+        input_dir=STAGING.dir("input"),
+        timeout=_request_timeout(deadline, 30),
+        writer=STAGING.write_input,
+    )
+    for name in staged:
+        logger.debug(f"Successfully uploaded {name}")
+    for error_msg in upload_errors:
+        logger.error(error_msg)
 
     if upload_errors:
-        print(f"worker-comfyui - image(s) upload finished with errors")
+        logger.info(f"image(s) upload finished with errors")
         return {
             "status": "error",
             "message": "Some images failed to upload",
             "details": upload_errors,
         }
 
-    print(f"worker-comfyui - image(s) upload complete")
+    logger.info(f"image(s) upload complete")
     return {
         "status": "success",
         "message": "All images uploaded successfully",
-        "details": responses,
+        "details": [f"Successfully uploaded {name}" for name in staged],
     }
 
 
-def get_available_models():
+def get_available_models(deadline=None):
     """
-    Get list of available models from ComfyUI
+    Get list of available models from ComfyUI's cached /object_info
+
+    Args:
+        deadline (JobDeadline, optional): Caps the /object_info request if the cache refetches.
 
     Returns:
         dict: Dictionary containing available models by type
     """
     try:
-        response = requests.get(f"http://{COMFY_HOST}/object_info", timeout=10)
-        response.raise_for_status()
-        object_info = response.json()
+        object_info = OBJECT_INFO.get(timeout=_request_timeout(deadline, 10)) or {}
 
         # Extract available checkpoints from CheckpointLoaderSimple
         available_models = {}
@@ -314,17 +416,18 @@ def get_available_models():
 
         return available_models
     except Exception as e:
-        print(f"worker-comfyui - Warning: Could not fetch available models: {e}")
+        logger.warning(f"Could not fetch available models: {e}")
         return {}
 
 
-def queue_workflow(workflow, client_id):
+def queue_workflow(workflow, client_id, deadline=None):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
         workflow (dict): A dictionary containing the workflow to be processed
         client_id (str): The client ID for the websocket connection
+        deadline (JobDeadline, optional): Caps the request timeout
 
     Returns:
         dict: The JSON response from ComfyUI after processing the workflow
@@ -339,15 +442,21 @@ def queue_workflow(workflow, client_id):
     # Use requests for consistency and timeout
     headers = {"Content-Type": "application/json"}
     response = requests.post(
-        f"http://{COMFY_HOST}/prompt", data=data, headers=headers, timeout=30
+        f"http://{COMFY_HOST}/prompt",
+        data=data,
+        headers=headers,
+        timeout=_request_timeout(deadline, 30),
     )
 
     # Handle validation errors with detailed information
     if response.status_code == 400:
-        print(f"worker-comfyui - ComfyUI returned 400. Response body: {response.text}")
+        logger.warning(f"ComfyUI returned 400. Response body: {response.text}")
+        # The graph passed local validation, so the cached schema may be stale; rate limited
+        # like validate_with_refresh so a stream of bad jobs doesn't refetch /object_info each time
+        OBJECT_INFO.expire()
         try:
             error_data = response.json()
-            print(f"worker-comfyui - Parsed error data: {error_data}")
+            logger.debug(f"Parsed error data: {error_data}")
 
             # Try to extract meaningful error information
             error_message = "Workflow validation failed"
@@ -380,7 +489,7 @@ def queue_workflow(workflow, client_id):
                 # For this type of error, we need to parse the validation details from logs
                 # Since ComfyUI doesn't seem to include detailed validation errors in the response
                 # Let's provide a more helpful generic message
-                available_models = get_available_models()
+                available_models = get_available_models(deadline)
                 if available_models.get("checkpoints"):
                     error_message += f"\n\nThis usually means a required model or parameter is not available."
                     error_message += f"\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
@@ -401,7 +510,7 @@ def queue_workflow(workflow, client_id):
                     "not in list" in detail and "ckpt_name" in detail
                     for detail in error_details
                 ):
-                    available_models = get_available_models()
+                    available_models = get_available_models(deadline)
                     if available_models.get("checkpoints"):
                         detailed_message += f"\n\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
                     else:
@@ -423,23 +532,88 @@ def queue_workflow(workflow, client_id):
     return response.json()
 
 
-def get_history(prompt_id):
+def get_history(prompt_id, deadline=None):
     """
     Retrieve the history of a given prompt using its ID
 
     Args:
         prompt_id (str): The ID of the prompt whose history is to be retrieved
+        deadline (JobDeadline, optional): Caps the request timeout
 
     Returns:
         dict: The history of the prompt, containing all the processing steps and results
     """
     # Use requests for consistency and timeout
-    response = requests.get(f"http://{COMFY_HOST}/history/{prompt_id}", timeout=30)
+    response = requests.get(
+        f"http://{COMFY_HOST}/history/{prompt_id}", timeout=_request_timeout(deadline, 30)
+    )
     response.raise_for_status()
     return response.json()
 
 
-def get_image_data(filename, subfolder, image_type):
+def _history_error_details(prompt_history):
+    """
+    Summarise why a prompt failed from the status messages ComfyUI keeps in /history.
+
+    Args:
+        prompt_history (dict): The /history entry of a single prompt.
+
+    Returns:
+        str: A description of the error in the same format as websocket execution_error events.
+    """
+    for event, data in prompt_history.get("status", {}).get("messages", []):
+        if event in ("execution_error", "execution_interrupted"):
+            details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}"
+            if event == "execution_error":
+                return f"{details}, Message: {data.get('exception_message')}"
+            return f"{details}, Message: Execution was interrupted"
+    return "Workflow finished with status 'error'"
+
+
+def reconcile_prompt_state(prompt_id, deadline=None):
+    """
+    Work out what happened to a prompt while the websocket was down.
+
+    Events sent during a disconnect are lost, so after reconnecting the prompt's state is
+    read back from /history and /queue instead.
+
+    Args:
+        prompt_id (str): The ID of the queued prompt.
+        deadline (JobDeadline, optional): Caps the request timeouts.
+
+    Returns:
+        tuple: (state, error details) where state is 'success', 'error', 'running',
+               'pending' or 'lost' (ComfyUI no longer knows the prompt, e.g. after a restart).
+    """
+
+    def from_history():
+        prompt_history = get_history(prompt_id, deadline).get(prompt_id)
+        if not prompt_history:
+            return None
+        status = prompt_history.get("status", {})
+        if status.get("status_str") == "error":
+            return "error", _history_error_details(prompt_history)
+        if status.get("completed", True):
+            return "success", None
+        return None
+
+    state = from_history()
+    if state:
+        return state
+
+    response = requests.get(f"http://{COMFY_HOST}/queue", timeout=_request_timeout(deadline, 10))
+    response.raise_for_status()
+    queue = response.json()
+    if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+        return "running", None
+    if any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+        return "pending", None
+
+    # It may have finished between the two requests
+    return from_history() or ("lost", None)
+
+
+def get_image_data(filename, subfolder, image_type, deadline=None):
     """
     Fetch image bytes from the ComfyUI /view endpoint.
 
@@ -447,34 +621,146 @@ def get_image_data(filename, subfolder, image_type):
         filename (str): The filename of the image.
         subfolder (str): The subfolder where the image is stored.
         image_type (str): The type of the image (e.g., 'output').
+        deadline (JobDeadline, optional): Caps the request timeout.
 
     Returns:
         bytes: The raw image data, or None if an error occurs.
     """
-    print(
-        f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
+    logger.debug(
+        f"Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
     )
     data = {"filename": filename, "subfolder": subfolder, "type": image_type}
     url_values = urllib.parse.urlencode(data)
     try:
         # Use requests for consistency and timeout
-        response = requests.get(f"http://{COMFY_HOST}/view?{url_values}", timeout=60)
+        response = requests.get(
+            f"http://{COMFY_HOST}/view?{url_values}", timeout=_request_timeout(deadline, 60)
+        )
         response.raise_for_status()
-        print(f"worker-comfyui - Successfully fetched image data for {filename}")
+        logger.debug(f"Successfully fetched image data for {filename}")
         return response.content
     except requests.Timeout:
-        print(f"worker-comfyui - Timeout fetching image data for {filename}")
+        logger.error(f"Timeout fetching image data for {filename}")
         return None
     except requests.RequestException as e:
-        print(f"worker-comfyui - Error fetching image data for {filename}: {e}")
+        logger.error(f"Error fetching image data for {filename}: {e}")
         return None
     except Exception as e:
-        print(
-            f"worker-comfyui - Unexpected error fetching image data for {filename}: {e}"
+        logger.error(
+            f"Unexpected error fetching image data for {filename}: {e}"
         )
         return None
 
 
+def _deliver_image(job_id, image_info, trace=None, image_bytes=None, deadline=None):
+    """
+    Fetch one output image from ComfyUI and upload it to S3 or encode it as base64.
+
+    Runs in the output thread pool, so several images are transferred at once.
+
+    Args:
+        job_id (str): The RunPod job id, used as the S3 prefix.
+        image_info (dict): The ComfyUI image reference with filename, subfolder and type.
+        trace (JobTrace, optional): Collects the fetch/upload/encode spans.
+        image_bytes (bytes, optional): Image data already received over the websocket;
+            skips the /view download.
+        deadline (JobDeadline, optional): Caps the /view download.
+
+    Returns:
+        tuple: (output entry dict or None, error message or None).
+    """
+    filename = image_info.get("filename")
+    streamed = image_bytes is not None
+    if not streamed:
+        with traced_stage(HANDLER_NAME, "output_fetch", trace):
+            image_bytes = get_image_data(
+                filename, image_info.get("subfolder", ""), image_info.get("type"), deadline
+            )
+    if not image_bytes:
+        return None, f"Failed to fetch image data for {filename} from /view endpoint."
+
+    if os.environ.get("BUCKET_ENDPOINT_URL"):
+        file_extension = os.path.splitext(filename)[1] or ".png"
+        temp_file_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                suffix=file_extension, delete=False
+            ) as temp_file:
+                temp_file.write(image_bytes)
+                temp_file_path = temp_file.name
+            logger.debug(
+                f"Wrote image bytes to temporary file: {temp_file_path}"
+            )
+
+            logger.debug(f"Uploading {filename} to S3...")
+            with traced_stage(HANDLER_NAME, "output_upload", trace):
+                s3_url = rp_upload.upload_image(job_id, temp_file_path)
+            logger.info(f"Uploaded {filename} to S3: {s3_url}")
+            output_entry = {"filename": filename, "type": "s3_url", "data": s3_url}
+        except Exception as e:
+            error_msg = f"Error uploading {filename} to S3: {e}"
+            logger.error(error_msg)
+            return None, error_msg
+        finally:
+            # Clean up temp file
+            if temp_file_path and os.path.exists(temp_file_path):
+                try:
+                    os.remove(temp_file_path)
+                except OSError as rm_err:
+                    logger.error(
+                        f"Error removing temp file {temp_file_path}: {rm_err}"
+                    )
+    else:
+        # Return as base64 string
+        try:
+            with traced_stage(HANDLER_NAME, "output_encode", trace):
+                base64_image = base64.b64encode(image_bytes).decode("utf-8")
+            output_entry = {"filename": filename, "type": "base64", "data": base64_image}
+            logger.debug(f"Encoded {filename} as base64")
+        except Exception as e:
+            error_msg = f"Error encoding {filename} to base64: {e}"
+            logger.error(error_msg)
+            return None, error_msg
+
+    if not streamed:
+        JANITOR.discard_output(image_info)
+    return output_entry, None
+
+
+def _error_response(error_type, response):
+    """
+    Count an error by type in the metrics registry and pass the response through.
+
+    Args:
+        error_type (str): Short error category used as the metric label.
+        response (dict): The error response returned to RunPod.
+
+    Returns:
+        dict: The unchanged error response.
+    """
+    ERRORS.inc(handler=HANDLER_NAME, type=error_type)
+    note(error_type=error_type)
+    return response
+
+
+def _deadline_response(deadline, prompt_id=None):
+    """
+    Build the error for an expired or cancelled job, removing its prompt from ComfyUI first.
+
+    Args:
+        deadline (JobDeadline): The job's deadline, already expired or cancelled.
+        prompt_id (str, optional): The queued prompt to evict or interrupt.
+
+    Returns:
+        dict: The error response.
+    """
+    response = {"error": deadline.describe()}
+    if prompt_id:
+        response["comfyui_prompt"] = abort_prompt(COMFY_HOST, prompt_id)
+    logger.warning(f"Stopping job {deadline.job_id}: {response['error']}")
+    return _error_response(deadline.stop_reason(), response)
+
+
 def handler(job):
     """
     Handles a job using ComfyUI via websockets for status and image retrieval.
@@ -485,66 +771,181 @@ def handler(job):
     Returns:
         dict: A dictionary containing either an error message or a success status with generated images.
     """
+    trace = trace_for_job(job)
+    deadline = deadline_for_job(job)
+    result, error_type = None, "unexpected"
+    REFRESH.job_started()
+    try:
+        with job_context(job.get("id")), LEDGER.track(
+            HANDLER_NAME, job
+        ) as entry, traced_stage(HANDLER_NAME, "total", trace):
+            result = entry.result = _process_job(job, deadline, trace)
+            error_type = entry.fields.get("error_type")
+    except Exception:
+        # Crashed jobs never reach _error_response(), count them here before RunPod reports the exception
+        JOBS.inc(handler=HANDLER_NAME, outcome="error")
+        ERRORS.inc(handler=HANDLER_NAME, type="unexpected")
+        raise
+    finally:
+        release_deadline(deadline)
+        refresh_reason = REFRESH.job_finished(result, error_type)
+    JOBS.inc(
+        handler=HANDLER_NAME, outcome="error" if "error" in result else "success"
+    )
+    result = attach_trace(result, trace)
+    if refresh_reason:
+        # RunPod takes the key out of the output and restarts the worker after this job
+        result["refresh_worker"] = True
+    return result
+
+
+def _process_job(job, deadline, trace=None):
+    """
+    Runs a single job end to end; see handler() for arguments and return value.
+    The JobDeadline is checked between stages and while waiting on ComfyUI, and an
+    optional JobTrace collects stage and per-node timings.
+    """
     job_input = job["input"]
     job_id = job["id"]
 
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with traced_stage(HANDLER_NAME, "validation", trace):
+        validated_data, error_message = validate_input(job_input)
     if error_message:
-        return {"error": error_message}
+        return _error_response("validation", {"error": error_message})
 
     # Extract validated data
     workflow = validated_data["workflow"]
     input_images = validated_data.get("images")
+    if trace and isinstance(workflow, dict):
+        trace.set_workflow(workflow)
 
-    # Make sure that the ComfyUI HTTP API is available before proceeding
-    if not check_server(
+    # Make sure that the ComfyUI HTTP API is available before proceeding; the health
+    # monitor's snapshot answers that unless it is stale or failing
+    if not MONITOR.healthy(COMFY_HOST) and not check_server(
         f"http://{COMFY_HOST}/",
         COMFY_API_AVAILABLE_MAX_RETRIES,
         COMFY_API_AVAILABLE_INTERVAL_MS,
+        deadline,
     ):
-        return {
-            "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
-        }
+        return _error_response(
+            "comfyui_unavailable",
+            {
+                "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
+            },
+        )
+
+    # Reject graphs ComfyUI would refuse before uploading anything or queueing them
+    object_info = None
+    if VALIDATE_WORKFLOWS and isinstance(workflow, dict):
+        with traced_stage(HANDLER_NAME, "schema_validation", trace):
+            schema_errors = validate_with_refresh(
+                workflow, OBJECT_INFO, timeout=deadline.timeout(10)
+            )
+            object_info = OBJECT_INFO.get(timeout=deadline.timeout(10))
+        if schema_errors:
+            logger.warning(f"Workflow failed local validation: {schema_errors}")
+            return _error_response(
+                "validation",
+                {"error": "Workflow validation failed", "details": schema_errors},
+            )
+
+    # Bypass no-op nodes and drop nodes that don't reach an output
+    with traced_stage(HANDLER_NAME, "optimize", trace):
+        workflow, optimize_report = optimize_workflow(
+            workflow, validated_data["optimize"], object_info
+        )
+    optimize_summary = record_report(HANDLER_NAME, optimize_report)
+    if optimize_summary:
+        logger.info(optimize_summary)
+        if trace:
+            trace.instant("workflow_optimized", args=optimize_report)
+
+    # Stream outputs over the websocket instead of saving them and downloading them again
+    ws_collector = None
+    if validated_data["output_mode"] == "websocket" and isinstance(workflow, dict):
+        workflow, ws_prefixes = swap_save_nodes(workflow)
+        if ws_prefixes:
+            ws_collector = WebsocketImageCollector(ws_prefixes)
+            logger.info(
+                f"Streaming outputs of node(s) {list(ws_prefixes)} over the websocket"
+            )
+        else:
+            logger.warning(
+                "output_mode 'websocket' requested but the workflow has no save node to swap"
+            )
+    if deadline.stop_reason():
+        return _deadline_response(deadline)
 
     # Upload input images if they exist
     if input_images:
-        upload_result = upload_images(input_images)
+        with traced_stage(HANDLER_NAME, "input_upload", trace):
+            upload_result = upload_images(input_images, deadline)
         if upload_result["status"] == "error":
             # Return upload errors
-            return {
-                "error": "Failed to upload one or more input images",
-                "details": upload_result["details"],
-            }
+            return _error_response(
+                "input_upload",
+                {
+                    "error": "Failed to upload one or more input images",
+                    "details": upload_result["details"],
+                },
+            )
+
+    if deadline.stop_reason():
+        return _deadline_response(deadline)
+
+    # Higher-priority, resident and cheaper jobs overtake this one while ComfyUI is busy
+    models = RESIDENCY.demand(workflow)
+    with traced_stage(HANDLER_NAME, "schedule_wait", trace):
+        ticket = SCHEDULER.acquire(
+            COMFY_HOST,
+            estimate_cost(workflow) if isinstance(workflow, dict) else 0,
+            validated_data["priority"],
+            deadline,
+            models,
+            tail_nodes(workflow) if isinstance(workflow, dict) else None,
+        )
+    if ticket is None:
+        return _deadline_response(deadline)
 
     ws = None
     client_id = str(uuid.uuid4())
     prompt_id = None
     output_data = []
     errors = []
+    # ComfyUI failed the prompt itself, a worker-side failure unlike a missing output
+    execution_failed = False
 
     try:
+        RESIDENCY.prepare(COMFY_HOST, models)
+
         # Establish WebSocket connection
         ws_url = f"ws://{COMFY_HOST}/ws?clientId={client_id}"
-        print(f"worker-comfyui - Connecting to websocket: {ws_url}")
+        logger.debug(f"Connecting to websocket: {ws_url}")
         ws = websocket.WebSocket()
-        ws.connect(ws_url, timeout=10)
-        print(f"worker-comfyui - Websocket connected")
+        ws.connect(ws_url, timeout=deadline.timeout(10))
+        logger.debug(f"Websocket connected")
 
         # Queue the workflow
         try:
-            queued_workflow = queue_workflow(workflow, client_id)
+            queued_at = time.perf_counter()
+            with traced_stage(HANDLER_NAME, "prompt_queue", trace):
+                queued_workflow = queue_workflow(workflow, client_id, deadline)
             prompt_id = queued_workflow.get("prompt_id")
             if not prompt_id:
                 raise ValueError(
                     f"Missing 'prompt_id' in queue response: {queued_workflow}"
                 )
-            print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
+            set_prompt_id(prompt_id)
+            note(prompt_id=prompt_id)
+            logger.info(f"Queued workflow with ID: {prompt_id}")
+            if trace:
+                trace.prompt_id = prompt_id
         except requests.RequestException as e:
-            print(f"worker-comfyui - Error queuing workflow: {e}")
+            logger.error(f"Error queuing workflow: {e}")
             raise ValueError(f"Error queuing workflow: {e}")
         except Exception as e:
-            print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
+            logger.error(f"Unexpected error queuing workflow: {e}")
             # For ValueError exceptions from queue_workflow, pass through the original message
             if isinstance(e, ValueError):
                 raise e
@@ -552,42 +953,107 @@ def handler(job):
                 raise ValueError(f"Unexpected error queuing workflow: {e}")
 
         # Wait for execution completion via WebSocket
-        print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
+        logger.debug(f"Waiting for workflow execution ({prompt_id})...")
+        ws.settimeout(WEBSOCKET_RECV_TIMEOUT_S)
         execution_done = False
+        execution_started_at = None
+        idle_timeouts = 0
         while True:
+            if deadline.stop_reason():
+                return _deadline_response(deadline, prompt_id)
             try:
                 out = ws.recv()
                 if isinstance(out, str):
                     message = json.loads(out)
+                    if trace:
+                        trace.on_comfy_message(message)
+                    if ws_collector:
+                        ws_collector.on_message(message)
                     if message.get("type") == "status":
                         status_data = message.get("data", {}).get("status", {})
-                        print(
-                            f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
+                        queue_remaining = status_data.get("exec_info", {}).get(
+                            "queue_remaining"
+                        )
+                        if queue_remaining is not None:
+                            QUEUE_DEPTH.set(queue_remaining, state="remaining")
+                            ADMISSION.observe_queue_remaining(queue_remaining)
+                        logger.debug(
+                            f"Status update: {queue_remaining if queue_remaining is not None else 'N/A'} items remaining in queue"
                         )
-                    elif message.get("type") == "executing":
+                    elif message.get("type") == "execution_cached":
+                        data = message.get("data", {})
+                        if data.get("prompt_id") == prompt_id and data.get("nodes"):
+                            CACHE_HITS.inc(
+                                len(data["nodes"]),
+                                handler=HANDLER_NAME,
+                                cache="comfyui_node",
+                            )
+                            note_cache_hits(len(data["nodes"]))
+                    elif message.get("type") in ("execution_start", "executing"):
                         data = message.get("data", {})
-                        if (
-                            data.get("node") is None
-                            and data.get("prompt_id") == prompt_id
-                        ):
-                            print(
-                                f"worker-comfyui - Execution finished for prompt {prompt_id}"
+                        if data.get("prompt_id") != prompt_id:
+                            continue
+                        if data.get("node") is not None:
+                            # Once the tail runs the next job may queue its prompt
+                            SCHEDULER.node_started(ticket, data["node"])
+                        if execution_started_at is None:
+                            execution_started_at = time.perf_counter()
+                            STAGE_SECONDS.observe(
+                                execution_started_at - queued_at,
+                                handler=HANDLER_NAME,
+                                stage="queue_wait",
                             )
+                            note_stage("queue_wait", execution_started_at - queued_at)
+                            if trace:
+                                trace.add_span(
+                                    "queue_wait", queued_at, execution_started_at
+                                )
+                        if message.get("type") == "executing" and data.get("node") is None:
+                            logger.info(
+                                f"Execution finished for prompt {prompt_id}"
+                            )
+                            execution_finished_at = time.perf_counter()
+                            STAGE_SECONDS.observe(
+                                execution_finished_at - execution_started_at,
+                                handler=HANDLER_NAME,
+                                stage="execution",
+                            )
+                            note_stage(
+                                "execution", execution_finished_at - execution_started_at
+                            )
+                            ADMISSION.record_execution(
+                                execution_finished_at - execution_started_at
+                            )
+                            RESIDENCY.record_execution(
+                                COMFY_HOST, execution_finished_at - execution_started_at
+                            )
+                            if trace:
+                                trace.add_span(
+                                    "execution",
+                                    execution_started_at,
+                                    execution_finished_at,
+                                )
                             execution_done = True
                             break
                     elif message.get("type") == "execution_error":
                         data = message.get("data", {})
                         if data.get("prompt_id") == prompt_id:
                             error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
-                            print(
-                                f"worker-comfyui - Execution error received: {error_details}"
+                            logger.error(
+                                f"Execution error received: {error_details}"
                             )
                             errors.append(f"Workflow execution error: {error_details}")
+                            execution_failed = True
                             break
                 else:
+                    # Binary frames carry previews and SaveImageWebsocket outputs
+                    if ws_collector:
+                        ws_collector.on_binary(out)
                     continue
             except websocket.WebSocketTimeoutException:
-                print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
+                idle_timeouts += 1
+                if idle_timeouts % 10 == 0:
+                    logger.debug(f"Websocket receive timed out. Still waiting...")
                 continue
             except websocket.WebSocketConnectionClosedException as closed_err:
                 try:
@@ -597,172 +1063,178 @@ def handler(job):
                         WEBSOCKET_RECONNECT_ATTEMPTS,
                         WEBSOCKET_RECONNECT_DELAY_S,
                         closed_err,
+                        deadline,
                     )
 
-                    print(
-                        "worker-comfyui - Resuming message listening after successful reconnect."
+                    ws.settimeout(WEBSOCKET_RECV_TIMEOUT_S)
+                    # Events sent while disconnected are lost; catch up from /history and /queue
+                    if deadline.stop_reason():
+                        return _deadline_response(deadline, prompt_id)
+                    state, error_details = reconcile_prompt_state(prompt_id, deadline)
+                    logger.info(
+                        f"Prompt {prompt_id} is '{state}' after reconnect."
+                    )
+                    if state == "success":
+                        execution_done = True
+                        break
+                    if state == "error":
+                        errors.append(f"Workflow execution error: {error_details}")
+                        execution_failed = True
+                        break
+                    if state == "lost":
+                        errors.append(
+                            f"Prompt {prompt_id} is no longer known to ComfyUI (not queued, running or in history)."
+                        )
+                        execution_failed = True
+                        break
+                    logger.info(
+                        "Resuming message listening after successful reconnect."
                     )
                     continue
                 except (
                     websocket.WebSocketConnectionClosedException
                 ) as reconn_failed_err:
+                    # Reconnecting gave up because the job stopped, free ComfyUI from the prompt
+                    if deadline.stop_reason():
+                        return _deadline_response(deadline, prompt_id)
                     # If _attempt_websocket_reconnect fails, it raises this exception
                     # Let this exception propagate to the outer handler's except block
                     raise reconn_failed_err
 
             except json.JSONDecodeError:
-                print(f"worker-comfyui - Received invalid JSON message via websocket.")
+                logger.warning(f"Received invalid JSON message via websocket.")
+
+        # The prompt left ComfyUI's queue, the next job may go while outputs are fetched
+        SCHEDULER.release(ticket)
 
         if not execution_done and not errors:
             raise ValueError(
                 "Workflow monitoring loop exited without confirmation of completion or error."
             )
 
-        # Fetch history even if there were execution errors, some outputs might exist
-        print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
-        history = get_history(prompt_id)
-
-        if prompt_id not in history:
-            error_msg = f"Prompt ID {prompt_id} not found in history after execution."
-            print(f"worker-comfyui - {error_msg}")
-            if not errors:
-                return {"error": error_msg}
-            else:
-                errors.append(error_msg)
-                return {
-                    "error": "Job processing failed, prompt ID not found in history.",
-                    "details": errors,
-                }
-
-        prompt_history = history.get(prompt_id, {})
-        outputs = prompt_history.get("outputs", {})
-
-        if not outputs:
-            warning_msg = f"No outputs found in history for prompt {prompt_id}."
-            print(f"worker-comfyui - {warning_msg}")
-            if not errors:
+        if ws_collector:
+            # The images arrived as websocket frames, nothing to look up in /history
+            to_deliver = ws_collector.images()
+            missing_nodes = ws_collector.missing_nodes()
+            if missing_nodes and not errors:
+                warning_msg = f"No images received over the websocket from save node(s) {missing_nodes}."
+                logger.warning(warning_msg)
                 errors.append(warning_msg)
+            logger.info(
+                f"Received {len(to_deliver)} image(s) over the websocket"
+            )
+        else:
+            # Fetch history even if there were execution errors, some outputs might exist
+            logger.debug(f"Fetching history for prompt {prompt_id}...")
+            history = get_history(prompt_id, deadline)
+
+            if prompt_id not in history:
+                error_msg = f"Prompt ID {prompt_id} not found in history after execution."
+                logger.error(error_msg)
+                if not errors:
+                    return _error_response("history", {"error": error_msg})
+                else:
+                    errors.append(error_msg)
+                    return _error_response(
+                        "history",
+                        {
+                            "error": "Job processing failed, prompt ID not found in history.",
+                            "details": errors,
+                        },
+                    )
 
-        print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
-        for node_id, node_output in outputs.items():
-            if "images" in node_output:
-                print(
-                    f"worker-comfyui - Node {node_id} contains {len(node_output['images'])} image(s)"
-                )
-                for image_info in node_output["images"]:
-                    filename = image_info.get("filename")
-                    subfolder = image_info.get("subfolder", "")
-                    img_type = image_info.get("type")
-
-                    # skip temp images
-                    if img_type == "temp":
-                        print(
-                            f"worker-comfyui - Skipping image {filename} because type is 'temp'"
-                        )
-                        continue
-
-                    if not filename:
-                        warn_msg = f"Skipping image in node {node_id} due to missing filename: {image_info}"
-                        print(f"worker-comfyui - {warn_msg}")
-                        errors.append(warn_msg)
-                        continue
-
-                    image_bytes = get_image_data(filename, subfolder, img_type)
-
-                    if image_bytes:
-                        file_extension = os.path.splitext(filename)[1] or ".png"
-
-                        if os.environ.get("BUCKET_ENDPOINT_URL"):
-                            try:
-                                with tempfile.NamedTemporaryFile(
-                                    suffix=file_extension, delete=False
-                                ) as temp_file:
-                                    temp_file.write(image_bytes)
-                                    temp_file_path = temp_file.name
-                                print(
-                                    f"worker-comfyui - Wrote image bytes to temporary file: {temp_file_path}"
-                                )
+            prompt_history = history.get(prompt_id, {})
+            outputs = prompt_history.get("outputs", {})
+
+            if not outputs:
+                warning_msg = f"No outputs found in history for prompt {prompt_id}."
+                logger.warning(warning_msg)
+                if not errors:
+                    errors.append(warning_msg)
+
+            logger.info(f"Processing {len(outputs)} output nodes...")
+            to_deliver = []
+            for node_id, node_output in outputs.items():
+                if "images" in node_output:
+                    logger.debug(
+                        f"Node {node_id} contains {len(node_output['images'])} image(s)"
+                    )
+                    for image_info in node_output["images"]:
+                        filename = image_info.get("filename")
 
-                                print(f"worker-comfyui - Uploading {filename} to S3...")
-                                s3_url = rp_upload.upload_image(job_id, temp_file_path)
-                                os.remove(temp_file_path)  # Clean up temp file
-                                print(
-                                    f"worker-comfyui - Uploaded {filename} to S3: {s3_url}"
-                                )
-                                # Append dictionary with filename and URL
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "s3_url",
-                                        "data": s3_url,
-                                    }
-                                )
-                            except Exception as e:
-                                error_msg = f"Error uploading {filename} to S3: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                                if "temp_file_path" in locals() and os.path.exists(
-                                    temp_file_path
-                                ):
-                                    try:
-                                        os.remove(temp_file_path)
-                                    except OSError as rm_err:
-                                        print(
-                                            f"worker-comfyui - Error removing temp file {temp_file_path}: {rm_err}"
-                                        )
-                        else:
-                            # Return as base64 string
-                            try:
-                                base64_image = base64.b64encode(image_bytes).decode(
-                                    "utf-8"
-                                )
-                                # Append dictionary with filename and base64 data
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "base64",
-                                        "data": base64_image,
-                                    }
-                                )
-                                print(f"worker-comfyui - Encoded {filename} as base64")
-                            except Exception as e:
-                                error_msg = f"Error encoding {filename} to base64: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                    else:
-                        error_msg = f"Failed to fetch image data for {filename} from /view endpoint."
-                        errors.append(error_msg)
-
-            # Check for other output types
-            other_keys = [k for k in node_output.keys() if k != "images"]
-            if other_keys:
-                warn_msg = (
-                    f"Node {node_id} produced unhandled output keys: {other_keys}."
-                )
-                print(f"worker-comfyui - WARNING: {warn_msg}")
-                print(
-                    f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
-                )
+                        # skip temp images
+                        if image_info.get("type") == "temp":
+                            logger.debug(
+                                f"Skipping image {filename} because type is 'temp'"
+                            )
+                            continue
+
+                        if not filename:
+                            warn_msg = f"Skipping image in node {node_id} due to missing filename: {image_info}"
+                            logger.warning(warn_msg)
+                            errors.append(warn_msg)
+                            continue
+
+                        to_deliver.append(image_info)
+
+                # Check for other output types
+                other_keys = [k for k in node_output.keys() if k != "images"]
+                if other_keys:
+                    warn_msg = (
+                        f"Node {node_id} produced unhandled output keys: {other_keys}."
+                    )
+                    logger.warning(warn_msg)
+                    logger.warning(
+                        f"--> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+                    )
+
+        # Fetch, encode and upload all images concurrently, keeping the response in output order
+        if to_deliver:
+            with ThreadPoolExecutor(
+                max_workers=min(OUTPUT_CONCURRENCY, len(to_deliver))
+            ) as pool:
+                # Each image runs in a copy of the job's context so its logs keep job_id/prompt_id
+                futures = [
+                    pool.submit(
+                        contextvars.copy_context().run,
+                        _deliver_image,
+                        job_id,
+                        image_info,
+                        trace,
+                        image_info.get("data"),
+                        deadline,
+                    )
+                    for image_info in to_deliver
+                ]
+                delivered = [future.result() for future in futures]
+            for output_entry, error_msg in delivered:
+                if output_entry:
+                    output_data.append(output_entry)
+                if error_msg:
+                    errors.append(error_msg)
 
     except websocket.WebSocketException as e:
-        print(f"worker-comfyui - WebSocket Error: {e}")
-        print(traceback.format_exc())
-        return {"error": f"WebSocket communication error: {e}"}
+        logger.exception(f"WebSocket Error: {e}")
+        return _error_response(
+            "websocket", {"error": f"WebSocket communication error: {e}"}
+        )
     except requests.RequestException as e:
-        print(f"worker-comfyui - HTTP Request Error: {e}")
-        print(traceback.format_exc())
-        return {"error": f"HTTP communication error with ComfyUI: {e}"}
+        logger.exception(f"HTTP Request Error: {e}")
+        return _error_response(
+            "http", {"error": f"HTTP communication error with ComfyUI: {e}"}
+        )
     except ValueError as e:
-        print(f"worker-comfyui - Value Error: {e}")
-        print(traceback.format_exc())
-        return {"error": str(e)}
+        logger.exception(f"Value Error: {e}")
+        return _error_response("value", {"error": str(e)})
     except Exception as e:
-        print(f"worker-comfyui - Unexpected Handler Error: {e}")
-        print(traceback.format_exc())
-        return {"error": f"An unexpected error occurred: {e}"}
+        logger.exception(f"Unexpected Handler Error: {e}")
+        return _error_response(
+            "unexpected", {"error": f"An unexpected error occurred: {e}"}
+        )
     finally:
+        SCHEDULER.release(ticket)
         if ws and ws.connected:
-            print(f"worker-comfyui - Closing websocket connection.")
+            logger.debug(f"Closing websocket connection.")
             ws.close()
 
     final_result = {}
@@ -772,25 +1244,39 @@ def handler(job):
 
     if errors:
         final_result["errors"] = errors
-        print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
+        logger.warning(f"Job completed with errors/warnings: {errors}")
 
     if not output_data and errors:
-        print(f"worker-comfyui - Job failed with no output images.")
-        return {
-            "error": "Job processing failed",
-            "details": errors,
-        }
+        logger.error(f"Job failed with no output images.")
+        return _error_response(
+            "execution" if execution_failed else "no_output",
+            {
+                "error": "Job processing failed",
+                "details": errors,
+            },
+        )
     elif not output_data and not errors:
-        print(
-            f"worker-comfyui - Job completed successfully, but the workflow produced no images."
+        logger.warning(
+            f"Job completed successfully, but the workflow produced no images."
         )
         final_result["status"] = "success_no_images"
         final_result["images"] = []
 
-    print(f"worker-comfyui - Job completed. Returning {len(output_data)} image(s).")
+    logger.info(f"Job completed. Returning {len(output_data)} image(s).")
     return final_result
 
 
 if __name__ == "__main__":
-    print("worker-comfyui - Starting handler...")
-    runpod.serverless.start({"handler": handler})
+    logger.info("Starting handler...")
+    start_metrics_server()
+    MONITOR.start()
+    RESIDENCY.register_launch_workflows()
+    JANITOR.start()
+    LEDGER.start()
+    runpod.serverless.start(
+        {
+            # Runs the handler in a thread so RunPod cancellations reach it
+            "handler": async_handler(handler),
+            "concurrency_modifier": ADMISSION.concurrency_modifier,
+        }
+    )
@@ -0,0 +1,205 @@
+"""
+Replay captured job payloads against a handler to reproduce production load shapes.
+
+Reads a JSONL capture where each line is a RunPod job ({"id": ..., "input": {...}})
+or a bare job input ({"prompt": ..., "image": ...} / {"workflow": ..., "images": [...]}).
+Lines without a usable input (such as non-job records) are skipped and counted.
+Jobs are released at a constant or Poisson arrival rate into a fixed pool of
+concurrent handler calls, against comfy_stub.py (default) or a real local ComfyUI
+(--comfy-host, with COMFY_DIR set to its folder as for the worker, since the
+handler writes inputs there). Reports queueing delay (arrival to handler start), service time,
+end-to-end latency percentiles, achieved throughput and the error mix as JSON.
+
+Usage:
+    python replay_load.py captures.jsonl --rate 2 --concurrency 2 --jobs 100
+    COMFY_DIR=/comfyui python replay_load.py captures.jsonl --comfy-host 127.0.0.1:3001 --rate 0.2
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import contextlib
+
+from bench_handler import HANDLERS, load_handler, start_stub, summarize
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_captures(path):
+    """Return (jobs, skipped_lines) parsed from a JSONL capture"""
+    jobs, skipped = [], 0
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(record, dict):
+                skipped += 1
+                continue
+            if isinstance(record.get("input"), (dict, str)):
+                jobs.append({"id": str(record.get("id", f"line-{line_no}")), "input": record["input"]})
+            elif "workflow" in record or ("prompt" in record and "image" in record):
+                jobs.append({"id": f"line-{line_no}", "input": record})
+            else:
+                skipped += 1
+    return jobs, skipped
+
+
+def arrival_offsets(count, rate, process, seed=None):
+    """Seconds from start at which each job arrives"""
+    if not rate:
+        return [0.0] * count
+    rng = random.Random(seed)
+    offsets, t = [], 0.0
+    for _ in range(count):
+        offsets.append(t)
+        t += rng.expovariate(rate) if process == "poisson" else 1.0 / rate
+    return offsets
+
+
+def classify_error(result):
+    """Short, stable key for the error mix"""
+    error = str(result.get("error", ""))
+    for separator in (":", " - ", "("):
+        error = error.split(separator, 1)[0]
+    return error.strip()[:80] or "unknown"
+
+
+def replay(module, jobs, offsets, concurrency):
+    """Feed jobs to module.handler on schedule and collect per-job samples"""
+    pending = queue.Queue()
+    samples = []
+    samples_lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            job, arrived_at = item
+            started = time.perf_counter()
+            try:
+                result = module.handler(job)
+            except Exception as e:
+                result = {"error": f"Handler raised {type(e).__name__}: {e}"}
+            finished = time.perf_counter()
+            with samples_lock:
+                samples.append({
+                    "queue_delay": started - arrived_at,
+                    "service": finished - started,
+                    "latency": finished - arrived_at,
+                    "error": classify_error(result) if "error" in result else None,
+                })
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+
+    start = time.perf_counter()
+    for job, offset in zip(jobs, offsets):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pending.put((json.loads(json.dumps(job)), time.perf_counter()))
+    for _ in workers:
+        pending.put(None)
+    for thread in workers:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def build_report(samples, wall, args, skipped):
+    errors = {}
+    for sample in samples:
+        if sample["error"]:
+            errors[sample["error"]] = errors.get(sample["error"], 0) + 1
+    return {
+        "benchmark": "replay_load",
+        "timestamp": time.time(),
+        "config": {
+            "capture": os.path.abspath(args.capture),
+            "handler": args.handler,
+            "target": args.comfy_host or "comfy_stub",
+            "jobs": len(samples),
+            "rate_jobs_per_s": args.rate,
+            "arrival": args.arrival,
+            "concurrency": args.concurrency,
+            "skipped_capture_lines": skipped,
+        },
+        "wall_s": wall,
+        "throughput_jobs_per_s": len(samples) / wall if wall else None,
+        "queue_delay_s": summarize([s["queue_delay"] for s in samples]),
+        "service_s": summarize([s["service"] for s in samples]),
+        "latency_s": summarize([s["latency"] for s in samples]),
+        "errors": sum(errors.values()),
+        "error_mix": errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured jobs against a handler")
+    parser.add_argument("capture", nargs="?", default=os.path.join(REPO_DIR, "requests.jsonl"))
+    parser.add_argument("--handler", choices=HANDLERS, default="rp_handler")
+    parser.add_argument("--rate", type=float, default=1.0, help="Arrivals per second, 0 releases all at once")
+    parser.add_argument("--arrival", choices=("poisson", "constant"), default="poisson")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent handler calls")
+    parser.add_argument("--jobs", type=int, help="Number of jobs, cycling through the capture (default: one pass)")
+    parser.add_argument("--seed", type=int, help="Seed for Poisson arrivals")
+    parser.add_argument("--comfy-host", help="Use a real ComfyUI at host:port instead of the stub")
+    parser.add_argument("--exec-delay", type=float, default=0.5, help="Stub execution seconds per job")
+    parser.add_argument("--output-bytes", type=int, default=1_000_000, help="Stub output image size")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Stub execution failure rate")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show handler logs")
+    args = parser.parse_args(argv)
+
+    captures, skipped = load_captures(args.capture)
+    if not captures:
+        parser.error(f"No job payloads found in {args.capture} ({skipped} lines skipped)")
+    count = args.jobs or len(captures)
+    jobs = [
+        {"id": f"replay-{i}-{captures[i % len(captures)]['id']}", "input": captures[i % len(captures)]["input"]}
+        for i in range(count)
+    ]
+
+    stub = None
+    comfy_host = args.comfy_host
+    if not comfy_host:
+        stub, comfy_host = start_stub(args.exec_delay, args.output_bytes, error_rate=args.error_rate)
+        # The stub reads no files; a real ComfyUI reads inputs from the handler's COMFY_DIR
+        os.environ.setdefault("COMFY_DIR", tempfile.mkdtemp(prefix="replay-comfy-"))
+    try:
+        module = load_handler(args.handler, comfy_host)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        sink = sys.stderr if args.verbose else open(os.devnull, "w")
+        with contextlib.redirect_stdout(sink):
+            samples, wall = replay(
+                module, jobs, arrival_offsets(count, args.rate, args.arrival, args.seed), args.concurrency
+            )
+    finally:
+        if stub:
+            stub.terminate()
+            stub.wait(timeout=10)
+
+    report = json.dumps(build_report(samples, wall, args, skipped), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
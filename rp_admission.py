@@ -0,0 +1,140 @@
+"""
+Queue-depth-aware admission control for the ComfyUI worker.
+
+The handlers feed in the queue depth seen by their health monitor (rp_health),
+websocket queue_remaining updates and measured execution times. From these the
+controller estimates how long a newly pulled job would wait before it starts executing.
+RunPod's concurrency_modifier reads that estimate and returns 0 once it exceeds
+ADMISSION_MAX_WAIT_S, so the worker stops pulling jobs and they go to idle workers
+instead of piling up here. The modifier runs on RunPod's event loop, so it only
+reads the cached snapshot and never does network I/O.
+
+With several ComfyUI instances (see rp_instances) every one of them is polled, the
+backlog is shared across them and the concurrency scales with their number. Jobs the
+prompt scheduler (rp_scheduler) holds back count as pending too. ADMISSION_PREFETCH
+extra jobs per instance are pulled on top of the configured concurrency so the next
+job is validated and staged while the GPU works on the current one. Intake stays
+closed while a worker refresh (rp_refresh) waits for the jobs in flight, and the
+handlers pass prefetch=0 with REFRESH_WORKER=always so each job gets a fresh worker.
+"""
+import os
+import time
+import logging
+import threading
+
+from rp_metrics import ADMISSION_ESTIMATED_WAIT, ADMISSION_OPEN
+
+logger = logging.getLogger(__name__)
+
+# Stop pulling jobs once the estimated ComfyUI queue wait exceeds this budget
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "120"))
+# Concurrency returned to RunPod while admission is open, per ComfyUI instance
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "1"))
+# Jobs per instance pulled early and prepared while the GPU is busy, on top of the concurrency
+ADMISSION_PREFETCH = int(os.getenv("ADMISSION_PREFETCH", "1"))
+# Execution time assumed until real jobs have been measured
+ADMISSION_DEFAULT_JOB_S = float(os.getenv("ADMISSION_DEFAULT_JOB_S", "30"))
+# Snapshots older than this are ignored so a stuck poller can't block the worker forever
+ADMISSION_STALE_AFTER_S = float(os.getenv("ADMISSION_STALE_AFTER_S", "30"))
+
+# Weight of the newest sample in the execution time moving average
+_EWMA_ALPHA = 0.2
+
+
+class AdmissionController:
+    """Tracks ComfyUI's backlog and decides whether the worker should take more jobs"""
+
+    def __init__(self, comfy_host, max_wait_s=ADMISSION_MAX_WAIT_S,
+                 max_concurrency=ADMISSION_MAX_CONCURRENCY, default_job_s=ADMISSION_DEFAULT_JOB_S,
+                 stale_after_s=ADMISSION_STALE_AFTER_S, held_jobs=None, pause_reason=None,
+                 prefetch=ADMISSION_PREFETCH):
+        # One host or a list of hosts of equivalent ComfyUI instances
+        self.comfy_hosts = [comfy_host] if isinstance(comfy_host, str) else list(comfy_host)
+        self.max_wait_s = max_wait_s
+        self.max_concurrency = max_concurrency
+        self.prefetch = prefetch
+        self.stale_after_s = stale_after_s
+        # Returns how many jobs the worker holds back before queueing them in ComfyUI
+        self.held_jobs = held_jobs
+        # Returns why intake must stay closed regardless of the backlog, or None
+        self.pause_reason = pause_reason
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self._pending = 0
+        self._updated_at = None
+        self._avg_job_s = default_job_s
+        self._samples = 0
+        self._admitting = True
+
+    # --- inputs ------------------------------------------------------------
+
+    def observe_queue(self, running, pending):
+        """Record queue depth as reported by /queue"""
+        with self._lock:
+            self._running, self._pending = running, pending
+            self._updated_at = time.monotonic()
+
+    def observe_queue_remaining(self, remaining):
+        """Record queue depth from a websocket status message (running + pending)"""
+        with self._lock:
+            self._running = min(1, remaining)
+            self._pending = max(0, remaining - 1)
+            self._updated_at = time.monotonic()
+
+    def record_execution(self, seconds):
+        """Feed a measured prompt execution time into the moving average"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            if self._samples == 0:
+                self._avg_job_s = seconds
+            else:
+                self._avg_job_s += _EWMA_ALPHA * (seconds - self._avg_job_s)
+            self._samples += 1
+
+    # --- decisions ---------------------------------------------------------
+
+    def estimated_wait_s(self):
+        """Seconds a job queued now would wait before ComfyUI starts it"""
+        held = self.held_jobs() if self.held_jobs else 0
+        with self._lock:
+            if self._updated_at is None or time.monotonic() - self._updated_at > self.stale_after_s:
+                return 0.0
+            # The running prompt is on average half done; instances work through the backlog in parallel
+            return (self._pending + held + 0.5 * self._running) * self._avg_job_s / len(self.comfy_hosts)
+
+    def should_admit(self):
+        wait = self.estimated_wait_s()
+        paused = self.pause_reason() if self.pause_reason else None
+        admitting = wait <= self.max_wait_s and not paused
+        ADMISSION_ESTIMATED_WAIT.set(wait)
+        ADMISSION_OPEN.set(1 if admitting else 0)
+        if admitting != self._admitting:
+            if admitting:
+                logger.info(f"Admission reopened (estimated ComfyUI wait {wait:.1f}s)")
+            elif paused:
+                logger.warning(f"Pausing job intake: {paused}")
+            else:
+                logger.warning(
+                    f"Pausing job intake: estimated ComfyUI wait {wait:.1f}s exceeds budget {self.max_wait_s:.1f}s"
+                )
+            self._admitting = admitting
+        return admitting
+
+    def concurrency_modifier(self, current_concurrency):
+        """RunPod concurrency_modifier: 0 pauses job intake, otherwise the configured concurrency plus prefetch"""
+        return (self.max_concurrency + self.prefetch) * len(self.comfy_hosts) if self.should_admit() else 0
+
+    def status(self):
+        with self._lock:
+            snapshot = {
+                "running": self._running,
+                "pending": self._pending,
+                "avg_job_s": self._avg_job_s,
+                "age_s": None if self._updated_at is None else time.monotonic() - self._updated_at,
+            }
+        snapshot["estimated_wait_s"] = self.estimated_wait_s()
+        snapshot["paused_by"] = self.pause_reason() if self.pause_reason else None
+        snapshot["admitting"] = snapshot["estimated_wait_s"] <= self.max_wait_s and not snapshot["paused_by"]
+        return snapshot
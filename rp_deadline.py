@@ -0,0 +1,174 @@
+"""
+Per-job deadlines and cancellation for the ComfyUI worker.
+
+Each job gets a JobDeadline from its "deadline_s" input field or JOB_DEADLINE_S.
+Handlers check it between stages, cap HTTP timeouts with it and poll it while
+waiting on ComfyUI. When it expires, or RunPod cancels the job, the handler calls
+abort_prompt() which removes the prompt from ComfyUI's pending queue or, if it is
+already running, calls /interrupt so the GPU is freed for the next job.
+
+RunPod delivers cancellations by cancelling the job's asyncio task, which never
+reaches a synchronous handler blocking the event loop. async_handler() runs the
+handler in a thread and turns that task cancellation into cancel_job().
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+
+from rp_metrics import PROMPT_ABORTS
+
+logger = logging.getLogger(__name__)
+
+# Default per-job budget in seconds, 0 disables the deadline
+JOB_DEADLINE_S = float(os.getenv("JOB_DEADLINE_S", "0"))
+# Smallest timeout handed to an HTTP call so an almost-expired job still gets an answer
+MIN_REQUEST_TIMEOUT_S = 0.5
+
+# Cancellations that arrive before the job registered; bounded so unknown ids can't pile up
+_CANCELLED_EARLY_MAX = 256
+
+_active = {}
+_cancelled_early = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+class JobDeadline:
+    """Deadline and cancellation flag for a single job"""
+
+    def __init__(self, job_id, budget_s=None):
+        self.job_id = job_id
+        self.budget_s = budget_s or None
+        self.expires_at = time.monotonic() + budget_s if budget_s else None
+        self._cancelled = threading.Event()
+
+    def remaining(self):
+        """Seconds left, or None without a deadline"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def stop_reason(self):
+        """"cancelled", "deadline" or None if the job may continue"""
+        if self._cancelled.is_set():
+            return "cancelled"
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            return "deadline"
+        return None
+
+    def timeout(self, default):
+        """Cap an HTTP timeout so it never outlives the deadline"""
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return max(MIN_REQUEST_TIMEOUT_S, min(default, remaining))
+
+    def wait(self, seconds):
+        """Sleep up to seconds (never past the deadline); True if the job should stop"""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._cancelled.wait(seconds)
+        return self.stop_reason() is not None
+
+    def describe(self):
+        if self.stop_reason() == "cancelled":
+            return "Job was cancelled"
+        return f"Job exceeded its deadline of {self.budget_s:g}s"
+
+
+def deadline_for_job(job):
+    """Create and register the deadline for a job"""
+    job_input = job.get("input")
+    budget = JOB_DEADLINE_S
+    if isinstance(job_input, dict) and job_input.get("deadline_s") is not None:
+        try:
+            requested = float(job_input["deadline_s"])
+            if requested > 0:
+                budget = requested
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid deadline_s: {job_input['deadline_s']!r}")
+    deadline = JobDeadline(job.get("id", "unknown"), budget)
+    with _registry_lock:
+        _active[deadline.job_id] = deadline
+        if deadline.job_id in _cancelled_early:
+            del _cancelled_early[deadline.job_id]
+            deadline.cancel()
+    return deadline
+
+
+def release_deadline(deadline):
+    with _registry_lock:
+        if _active.get(deadline.job_id) is deadline:
+            del _active[deadline.job_id]
+
+
+def cancel_job(job_id):
+    """Flag a job as cancelled; True if it was running in this worker"""
+    with _registry_lock:
+        deadline = _active.get(job_id)
+        if deadline is None:
+            _cancelled_early[job_id] = True
+            if len(_cancelled_early) > _CANCELLED_EARLY_MAX:
+                _cancelled_early.popitem(last=False)
+            return False
+    logger.info(f"Cancelling job {job_id}")
+    deadline.cancel()
+    return True
+
+
+def abort_prompt(comfy_host, prompt_id, timeout=5):
+    """Drop a prompt from ComfyUI: delete it if pending, interrupt it if running
+
+    Returns "evicted", "interrupted", "not_found" when ComfyUI no longer has it, or
+    "failed" when ComfyUI couldn't be asked and the prompt may still be running.
+    """
+    try:
+        queue_req = requests.get(f"http://{comfy_host}/queue", timeout=timeout)
+        queue_req.raise_for_status()
+        queue = queue_req.json()
+        if any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+            requests.post(
+                f"http://{comfy_host}/queue", json={"delete": [prompt_id]}, timeout=timeout
+            ).raise_for_status()
+            action = "evicted"
+        elif any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            # Recent ComfyUI builds only interrupt the given prompt, older ones ignore the body
+            requests.post(
+                f"http://{comfy_host}/interrupt", json={"prompt_id": prompt_id}, timeout=timeout
+            ).raise_for_status()
+            action = "interrupted"
+        else:
+            return "not_found"
+    except (requests.RequestException, ValueError, IndexError, TypeError) as e:
+        logger.warning(f"Could not abort prompt {prompt_id}: {str(e)}")
+        PROMPT_ABORTS.inc(action="failed")
+        return "failed"
+    PROMPT_ABORTS.inc(action=action)
+    logger.info(f"Prompt {prompt_id} {action}")
+    return action
+
+
+def async_handler(handler):
+    """Wrap a sync handler so RunPod task cancellation reaches it as cancel_job()"""
+    async def run(job):
+        try:
+            return await asyncio.to_thread(handler, job)
+        except asyncio.CancelledError:
+            cancel_job(job.get("id"))
+            raise
+
+    run.__name__ = getattr(handler, "__name__", "handler")
+    run.__doc__ = handler.__doc__
+    return run
@@ -6,91 +6,78 @@ import os
 import base64
 import random
 import logging
+import threading
+import uuid
+import urllib.parse
+import shlex
+import websocket
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from rp_metrics import (
+    start_metrics_server, JOBS, ERRORS, CACHE_HITS, STAGE_SECONDS
+)
+from rp_trace import traced_stage, trace_for_job, attach_trace
+from rp_supervisor import ComfySupervisor, COMFY_LOG_BUFFER_LINES
+from rp_instances import InstancePool, ComfyInstance, plan_slots, COMFY_HOSTS
+from rp_admission import AdmissionController, ADMISSION_PREFETCH
+from rp_health import HealthMonitor
+from rp_janitor import Janitor
+from rp_inputs import stage_images
+from rp_ws_output import output_mode, swap_save_nodes, WebsocketImageCollector
+from rp_workflow_opt import optimize_mode, optimize_workflow, record_report
+from rp_scheduler import PromptScheduler, job_priority, estimate_cost, tail_nodes
+from rp_schema import ObjectInfoCache, validate_with_refresh, VALIDATE_WORKFLOWS
+from rp_deadline import deadline_for_job, release_deadline, abort_prompt, async_handler
+from rp_logging import configure_logging, job_context, set_prompt_id
+from rp_ledger import JobLedger, note, note_stage, note_cache_hits
+from rp_refresh import RefreshPolicy
+from rp_residency import ResidencyManager, RESIDENCY_MODEL_DIRS
+from rp_launch_profile import launch_args, record_boot
+from rp_staging import StagingArea
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; records are written by a background thread
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Configuration from environment variables
 COMFY_HOST = os.getenv("COMFY_HOST", "127.0.0.1:3001")  # Updated to match install script
 MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE_MB", "20")) * 1024 * 1024  # 20MB default
-COMFY_DIR = "/workspace/ComfyUI"
+COMFY_DIR = os.getenv("COMFY_DIR", "/workspace/ComfyUI")
+# Output images downloaded and encoded at the same time
+OUTPUT_CONCURRENCY = int(os.getenv("OUTPUT_CONCURRENCY", "4"))
+# The workflow's SaveImagePlus node, returned first so clients keep getting the final image at images[0]
+SAVE_IMAGE_NODE_ID = "95"
+# Seconds between /history checks once the websocket reported the prompt done
+HISTORY_CATCH_UP_S = 0.05
+# Label used for this handler's metrics
+HANDLER_NAME = "rp_handler"
+# Polls every ComfyUI server in the background; health checks, routing and admission read its snapshot
+MONITOR = HealthMonitor(COMFY_HOSTS.split(",") if COMFY_HOSTS else [COMFY_HOST])
+# ComfyUI servers jobs are routed to; initialize_comfyui() replaces it with the instances it launches
+INSTANCES = InstancePool.from_hosts(MONITOR.hosts, monitor=MONITOR)
+# Knows each workflow's models and frees ComfyUI's VRAM only when the next set doesn't fit
+RESIDENCY = ResidencyManager(RESIDENCY_MODEL_DIRS or [os.path.join(COMFY_DIR, "models")], monitor=MONITOR)
+# Orders prompts by priority, model residency and cost, holding them back until ComfyUI's queue drains
+SCHEDULER = PromptScheduler(swap_rank=RESIDENCY.swap_rank)
+# Decides per job whether RunPod should restart the worker, see rp_refresh
+REFRESH = RefreshPolicy(monitor=MONITOR)
+# Backpressure: tells RunPod to stop sending jobs while ComfyUI is backed up or a refresh is due
+# (without prefetch when the worker is refreshed after every job, so no job runs on a used one)
+ADMISSION = AdmissionController(
+    INSTANCES.hosts, held_jobs=SCHEDULER.waiting, pause_reason=REFRESH.pending_reason,
+    prefetch=0 if REFRESH.exclusive else ADMISSION_PREFETCH,
+)
+# ComfyUI's input/output/temp on a RAM-backed folder when this worker launches it, see rp_staging
+STAGING = StagingArea(COMFY_DIR, launches_comfyui=not COMFY_HOSTS)
+# Deletes delivered outputs and keeps ComfyUI's input/output/temp folders within quota
+JANITOR = Janitor(COMFY_DIR, roots=STAGING.roots(), on_delete=STAGING.released)
+# ComfyUI's /object_info, fetched once and reused to validate and optimize every job
+OBJECT_INFO = ObjectInfoCache(INSTANCES.primary.host)
+# One SQLite row per job for capacity planning, see rp_ledger
+LEDGER = JobLedger()
 
-def check_comfyui_health():
-    """Check if ComfyUI is running and accessible"""
-    try:
-        response = requests.get(f"http://{COMFY_HOST}/", timeout=5)
-        return response.status_code == 200
-    except requests.RequestException:
-        return False
-
-def wait_for_comfyui(timeout=60):
-    """Wait for ComfyUI to be ready"""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        if check_comfyui_health():
-            logger.info("ComfyUI is ready")
-            return True
-        logger.info("Waiting for ComfyUI to start...")
-        time.sleep(2)
-    return False
-
-def handler(job):
-    try:
-        logger.info(f"Starting job processing: {job.get('id', 'unknown')}")
-        
-        # === FILESYSTEM DEBUG START ===
-        logger.info(f"Contents of /runpod-volume: {os.listdir('/runpod-volume') if os.path.exists('/runpod-volume') else 'Directory not found'}")
-        if os.path.exists('/runpod-volume/ComfyUI/models'):
-            logger.info(f"Contents of /runpod-volume/ComfyUI/models: {os.listdir('/runpod-volume/ComfyUI/models')}")
-            # Check each model subdirectory
-            model_subdirs = ['checkpoints', 'vae', 'controlnet', 'clip', 'upscale_models', 'text_encoders']
-            for subdir in model_subdirs:
-                subdir_path = f'/runpod-volume/ComfyUI/models/{subdir}'
-                if os.path.exists(subdir_path):
-                    files = os.listdir(subdir_path)
-                    logger.info(f"Contents of {subdir_path}: {files}")
-                else:
-                    logger.info(f"{subdir_path}: Directory not found")
-        else:
-            logger.info("/runpod-volume/ComfyUI/models: Directory not found")
-        logger.info("=== FILESYSTEM DEBUG END ===")
-        # Check if ComfyUI is ready
-        if not check_comfyui_health():
-            logger.error("ComfyUI is not accessible")
-            if not wait_for_comfyui():
-                return {"error": "ComfyUI service is not available"}
-        
-        job_input = job["input"]
-
-        # --- 1. Get Your API Inputs ---
-        # We expect a 'prompt' and a base64 'image' from the API call
-        prompt_text = job_input.get("prompt")
-        image_base64 = job_input.get("image")
-        
-        # Validate required inputs
-        if not prompt_text or not isinstance(prompt_text, str):
-            return {"error": "Missing or invalid 'prompt' parameter - must be a non-empty string"}
-        
-        if not image_base64 or not isinstance(image_base64, str):
-            return {"error": "Missing or invalid 'image' parameter - must be a base64 encoded string"}
-            
-        # Validate prompt length
-        if len(prompt_text.strip()) == 0:
-            return {"error": "Prompt cannot be empty"}
-            
-        if len(prompt_text) > 2000:
-            return {"error": "Prompt too long (max 2000 characters)"}
-            
-        logger.info(f"Processing prompt: {prompt_text[:100]}...")
-        
-    except Exception as e:
-        logger.error(f"Error in input validation: {str(e)}")
-        return {"error": f"Input validation failed: {str(e)}"}
-
-    # --- 2. Load Your Workflow ---
-    # This is the static workflow from your file.
-    workflow_api_json = """
+# The static workflow from your file; also decides which custom nodes the minimal launch profile loads
+WORKFLOW_API_JSON = """
    {
   "1": {
     "inputs": {
@@ -455,8 +442,242 @@ def handler(job):
     }
   }
 }
+"""
+
+def check_comfyui_health(host=None):
+    """Check if ComfyUI is running and accessible"""
+    try:
+        response = requests.get(f"http://{host or INSTANCES.primary.host}/", timeout=5)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+def wait_for_comfyui(timeout=60, host=None):
+    """Wait for ComfyUI to be ready"""
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if check_comfyui_health(host):
+            logger.info("ComfyUI is ready")
+            return True
+        logger.info("Waiting for ComfyUI to start...")
+        time.sleep(2)
+    return False
+
+def _error(error_type, message, include_logs=False, comfy=None):
+    """Count an error by type and build the error response, optionally with recent ComfyUI output"""
+    ERRORS.inc(handler=HANDLER_NAME, type=error_type)
+    note(error_type=error_type)
+    response = {"error": message}
+    supervisor = (comfy or INSTANCES.primary).supervisor
+    if include_logs and supervisor:
+        response["comfyui_log_tail"] = supervisor.recent_output()
+    return response
+
+def _deadline_error(deadline, prompt_id=None, comfy=None):
+    """Build the error for an expired or cancelled job, freeing ComfyUI from its prompt first"""
+    response = _error(deadline.stop_reason(), deadline.describe())
+    if prompt_id:
+        response["comfyui_prompt"] = abort_prompt((comfy or INSTANCES.primary).host, prompt_id)
+    logger.warning(f"Stopping job {deadline.job_id}: {response['error']}")
+    return response
+
+def _comfyui_exited_error(prompt_id, comfy):
+    """Error for jobs whose ComfyUI process died underneath them"""
+    status = comfy.supervisor.status()
+    logger.error(f"ComfyUI exited while processing prompt {prompt_id}: {status}")
+    return _error(
+        "comfyui_crashed",
+        f"ComfyUI exited (code {status['last_exit_code']}) while processing prompt {prompt_id}; it is being restarted",
+        include_logs=True,
+        comfy=comfy,
+    )
+
+def _on_health_poll(monitor):
+    """Feed every health poll's queue depth into admission control"""
+    if monitor.any_reachable():
+        ADMISSION.observe_queue(*monitor.queue_totals())
+
+MONITOR.add_listener(_on_health_poll)
+
+def _record_execution_timings(history, queued_at, trace=None, host=None):
+    """Derive queue wait, execution time and cached nodes from ComfyUI's status messages"""
+    events = {}
+    for message in history.get("status", {}).get("messages", []):
+        if isinstance(message, list) and len(message) == 2 and isinstance(message[1], dict):
+            events[message[0]] = message[1]
+
+    started = events.get("execution_start", {}).get("timestamp")
+    finished = events.get("execution_success", {}).get("timestamp")
+    if started is not None:
+        STAGE_SECONDS.observe(max(0.0, started / 1000 - queued_at), handler=HANDLER_NAME, stage="queue_wait")
+        note_stage("queue_wait", max(0.0, started / 1000 - queued_at))
+        if finished is not None:
+            STAGE_SECONDS.observe(max(0.0, (finished - started) / 1000), handler=HANDLER_NAME, stage="execution")
+            note_stage("execution", max(0.0, (finished - started) / 1000))
+            ADMISSION.record_execution((finished - started) / 1000)
+            RESIDENCY.record_execution(host, (finished - started) / 1000)
+        if trace:
+            # ComfyUI reports wall-clock milliseconds, the trace runs on perf_counter
+            offset = time.perf_counter() - time.time()
+            trace.add_span("queue_wait", queued_at + offset, started / 1000 + offset)
+            if finished is not None:
+                trace.add_span("execution", started / 1000 + offset, finished / 1000 + offset)
+    else:
+        # Older ComfyUI builds don't report timestamps, fall back to the wall clock
+        STAGE_SECONDS.observe(time.time() - queued_at, handler=HANDLER_NAME, stage="execution")
+        note_stage("execution", time.time() - queued_at)
+
+    cached_nodes = events.get("execution_cached", {}).get("nodes", [])
+    if cached_nodes:
+        CACHE_HITS.inc(len(cached_nodes), handler=HANDLER_NAME, cache="comfyui_node")
+        note_cache_hits(len(cached_nodes))
+
+def _open_ws_listener(comfy, client_id, trace=None, collector=None, on_node=None, finished=None):
+    """Connect to ComfyUI's websocket and feed its events into the job trace, image collector and/or on_node(node_id)
+
+    finished (a threading.Event) is set once the prompt succeeded, failed or was
+    interrupted, so the handler can check /history right away.
     """
-    workflow = json.loads(workflow_api_json)
+    ws = websocket.WebSocket()
+    ws.connect(f"ws://{comfy.host}/ws?clientId={client_id}", timeout=10)
+
+    def listen():
+        while True:
+            try:
+                out = ws.recv()
+            except (websocket.WebSocketException, OSError):
+                # Closed by the handler once the outputs are in; otherwise the /history poll carries on
+                return
+            if not isinstance(out, str):
+                if collector:
+                    collector.on_binary(out)
+                continue
+            try:
+                message = json.loads(out)
+            except ValueError:
+                continue
+            if trace:
+                trace.on_comfy_message(message)
+            if collector:
+                collector.on_message(message)
+            data = message.get("data") or {}
+            if on_node and message.get("type") == "executing" and data.get("node") is not None:
+                on_node(data["node"])
+            # The socket only carries this job's prompt, its client_id is unique to the job
+            if message.get("type") in ("execution_success", "execution_error", "execution_interrupted") or (
+                message.get("type") == "executing" and data.get("node") is None and data.get("prompt_id")
+            ):
+                if finished:
+                    finished.set()
+                return
+
+    listener = threading.Thread(target=contextvars.copy_context().run, args=(listen,), name="ws-listener", daemon=True)
+    listener.start()
+    return ws, listener
+
+def _close_ws_listener(ws, listener):
+    try:
+        ws.close()
+    except (websocket.WebSocketException, OSError):
+        pass
+    listener.join(timeout=1)
+
+def handler(job):
+    """Process one job and record its outcome in the metrics registry"""
+    trace = trace_for_job(job)
+    deadline = deadline_for_job(job)
+    result, error_type = None, "unexpected"
+    REFRESH.job_started()
+    try:
+        with job_context(job.get("id")), LEDGER.track(HANDLER_NAME, job) as entry, \
+                traced_stage(HANDLER_NAME, "total", trace):
+            result = entry.result = _process_job(job, deadline, trace)
+            error_type = entry.fields.get("error_type")
+    except Exception:
+        # Crashed jobs never reach _error(), count them here before RunPod reports the exception
+        JOBS.inc(handler=HANDLER_NAME, outcome="error")
+        ERRORS.inc(handler=HANDLER_NAME, type="unexpected")
+        raise
+    finally:
+        release_deadline(deadline)
+        refresh_reason = REFRESH.job_finished(result, error_type)
+    JOBS.inc(handler=HANDLER_NAME, outcome="error" if "error" in result else "success")
+    result = attach_trace(result, trace)
+    if refresh_reason:
+        # RunPod takes the key out of the output and restarts the worker after this job
+        result["refresh_worker"] = True
+    return result
+
+def _process_job(job, deadline, trace=None):
+    """Route the job to the least-loaded ComfyUI instance and process it there"""
+    job_input = job.get("input")
+    # Arbitrary API-format workflows skip the built-in graph entirely
+    generic = isinstance(job_input, dict) and "workflow" in job_input
+    with INSTANCES.acquire(_routing_workflow(job_input) if generic else json.loads(WORKFLOW_API_JSON)) as comfy:
+        note(instance=comfy.name)
+        if generic:
+            logger.info(f"Starting workflow job processing: {job.get('id', 'unknown')}")
+            return _ensure_comfyui(deadline, comfy) or _process_workflow_job(job_input, deadline, trace, comfy)
+        return _process_builtin_job(job, deadline, trace, comfy)
+
+
+def _routing_workflow(job_input):
+    """The job's workflow as a dict for the scheduler, None if it isn't valid JSON (validation reports it)"""
+    workflow = job_input.get("workflow")
+    if isinstance(workflow, str):
+        try:
+            workflow = json.loads(workflow)
+        except ValueError:
+            return None
+    return workflow if isinstance(workflow, dict) else None
+
+
+def _process_builtin_job(job, deadline, trace, comfy):
+    try:
+        logger.info(f"Starting job processing: {job.get('id', 'unknown')}")
+        
+        comfyui_error = _ensure_comfyui(deadline, comfy)
+        if comfyui_error:
+            return comfyui_error
+        
+        job_input = job["input"]
+
+        with traced_stage(HANDLER_NAME, "validation", trace):
+            # --- 1. Get Your API Inputs ---
+            # We expect a 'prompt' and a base64 'image' from the API call
+            prompt_text = job_input.get("prompt")
+            image_base64 = job_input.get("image")
+        
+            # Validate required inputs
+            if not prompt_text or not isinstance(prompt_text, str):
+                return _error("validation", "Missing or invalid 'prompt' parameter - must be a non-empty string")
+        
+            if not image_base64 or not isinstance(image_base64, str):
+                return _error("validation", "Missing or invalid 'image' parameter - must be a base64 encoded string")
+            
+            # Validate prompt length
+            if len(prompt_text.strip()) == 0:
+                return _error("validation", "Prompt cannot be empty")
+            
+            if len(prompt_text) > 2000:
+                return _error("validation", "Prompt too long (max 2000 characters)")
+            
+            mode = output_mode(job_input)
+            optimize = optimize_mode(job_input)
+            priority = job_priority(job_input)
+            logger.debug(f"Processing prompt: {prompt_text[:100]}...")
+        
+    except Exception as e:
+        logger.error(f"Error in input validation: {str(e)}")
+        return _error("validation", f"Input validation failed: {str(e)}")
+
+    if deadline.stop_reason():
+        return _deadline_error(deadline)
+
+    # --- 2. Load Your Workflow ---
+    workflow = json.loads(WORKFLOW_API_JSON)
+    if trace:
+        trace.set_workflow(workflow)
 
     # --- 3. Modify the Workflow with Your Inputs ---
     # Update the correct node IDs based on your actual workflow
@@ -466,8 +687,9 @@ def handler(job):
         workflow["56"]["inputs"]["text"] = prompt_text
 
     # Set the image filename in the LoadImage node (node "1")
-    # We'll save the uploaded image as 'input.png'
-    workflow["1"]["inputs"]["image"] = "input.png"
+    # Each job gets its own file since several jobs (and instances) share the input folder
+    input_filename = f"input_{uuid.uuid4().hex}.png"
+    workflow["1"]["inputs"]["image"] = input_filename
 
     # Randomize the seed in RandomNoise node (node "39")
     workflow["39"]["inputs"]["noise_seed"] = random.randint(0, 2147483647)
@@ -485,154 +707,415 @@ def handler(job):
             
         # Validate base64 format
         try:
-            image_data = base64.b64decode(base64_data, validate=True)
+            with traced_stage(HANDLER_NAME, "input_decode", trace):
+                image_data = base64.b64decode(base64_data, validate=True)
         except Exception as e:
             logger.error(f"Invalid base64 image data: {str(e)}")
-            return {"error": "Invalid base64 image data"}
+            return _error("input_image", "Invalid base64 image data")
             
         # Check image size (optional but recommended)
         if len(image_data) > MAX_IMAGE_SIZE:
-            return {"error": f"Image too large (max {MAX_IMAGE_SIZE // (1024*1024)}MB)"}
+            return _error("input_image", f"Image too large (max {MAX_IMAGE_SIZE // (1024*1024)}MB)")
             
         if len(image_data) < 100:  # Minimum reasonable image size
-            return {"error": "Image data too small - likely corrupted"}
+            return _error("input_image", "Image data too small - likely corrupted")
             
-        # Ensure input directory exists
-        input_dir = os.path.join(COMFY_DIR, "input")
-        os.makedirs(input_dir, exist_ok=True)
-        
-        input_path = os.path.join(input_dir, "input.png")
-        with open(input_path, "wb") as f:
-            f.write(image_data)
+        # Into the staging area, or onto disk once it's full
+        with traced_stage(HANDLER_NAME, "input_write", trace):
+            STAGING.write_input(input_filename, image_data)
             
-        logger.info(f"Successfully saved input image ({len(image_data)} bytes)")
+        logger.debug(f"Successfully saved input image ({len(image_data)} bytes)")
         
     except Exception as e:
         logger.error(f"Failed to process input image: {str(e)}")
-        return {"error": f"Failed to process input image: {str(e)}"}
+        return _error("input_image", f"Failed to process input image: {str(e)}")
 
-    # --- Debug: Check available nodes ---
+    # --- Check available nodes and validate the workflow against the cached schema ---
+    available_nodes = OBJECT_INFO.get(timeout=deadline.timeout(10))
+    if available_nodes is None:
+        logger.warning("Could not check available nodes, /object_info unavailable")
+    else:
+        required_nodes = ["GetImageSize", "ColorMatch", "NunchakuFluxDiTLoader", "ImageResizeKJv2", "SaveImagePlus"]
+        missing_nodes = [node for node in required_nodes if node not in available_nodes]
+        if missing_nodes:
+            logger.error(f"Missing custom nodes: {missing_nodes}")
+            return _error("missing_nodes", f"Missing required custom nodes: {missing_nodes}. Please ensure all custom nodes are properly installed and loaded.")
+    schema_error = _validate_schema(workflow, deadline, trace)
+    if schema_error:
+        return schema_error
+
+    # --- 5. Queue the Prompt & Get the Output ---
     try:
-        logger.info("Checking available ComfyUI nodes...")
-        nodes_req = requests.get(f"http://{COMFY_HOST}/object_info", timeout=10)
-        if nodes_req.status_code == 200:
-            available_nodes = nodes_req.json()
-            required_nodes = ["GetImageSize", "ColorMatch", "NunchakuFluxDiTLoader", "ImageResizeKJv2", "SaveImagePlus"]
-            missing_nodes = []
-            for node in required_nodes:
-                if node not in available_nodes:
-                    missing_nodes.append(node)
-                    logger.warning(f"Missing required node: {node}")
-                else:
-                    logger.info(f"Found required node: {node}")
-            
-            if missing_nodes:
-                logger.error(f"Missing custom nodes: {missing_nodes}")
-                return {"error": f"Missing required custom nodes: {missing_nodes}. Please ensure all custom nodes are properly installed and loaded."}
+        return _run_workflow(comfy, workflow, deadline, trace, mode=mode, optimize=optimize, priority=priority)
+    finally:
+        JANITOR.discard_output({"filename": input_filename, "type": "input"})
+
+
+def _validate_schema(workflow, deadline, trace=None):
+    """Check the workflow against the cached /object_info; returns an error response or None"""
+    if not VALIDATE_WORKFLOWS:
+        return None
+    with traced_stage(HANDLER_NAME, "schema_validation", trace):
+        errors = validate_with_refresh(workflow, OBJECT_INFO, timeout=deadline.timeout(10))
+    if not errors:
+        return None
+    logger.error(f"Workflow failed validation: {errors}")
+    response = _error("validation", "Workflow validation failed")
+    response["details"] = errors
+    return response
+
+
+def _ensure_comfyui(deadline, comfy):
+    """Wait for the instance if it is not answering; returns an error response or None"""
+    # The health monitor's snapshot saves a request per job; ask directly only when it is stale or failing
+    if MONITOR.healthy(comfy.host):
+        return None
+    if not check_comfyui_health(comfy.host):
+        logger.error(f"ComfyUI is not accessible at {comfy.host}")
+        if not wait_for_comfyui(timeout=deadline.timeout(60), host=comfy.host):
+            if deadline.stop_reason():
+                return _deadline_error(deadline)
+            return _error("comfyui_unavailable", "ComfyUI service is not available", include_logs=True, comfy=comfy)
+    return None
+
+
+def _process_workflow_job(job_input, deadline, trace, comfy):
+    """Run an arbitrary API-format workflow with named input images
+
+    Expects {"workflow": {...}, "images": [{"name": ..., "image": <base64>}, ...]}; the
+    names are what the workflow's LoadImage nodes reference.
+    """
+    with traced_stage(HANDLER_NAME, "validation", trace):
+        workflow = job_input.get("workflow")
+        if isinstance(workflow, str):
+            try:
+                workflow = json.loads(workflow)
+            except ValueError:
+                return _error("validation", "Invalid JSON in 'workflow'")
+        if not isinstance(workflow, dict) or not workflow or not all(
+            isinstance(node, dict) and "class_type" in node for node in workflow.values()
+        ):
+            return _error("validation", "'workflow' must be an API-format workflow (node id -> {class_type, inputs})")
+
+        images = job_input.get("images") or []
+        if not isinstance(images, list) or not all(
+            isinstance(image, dict) and isinstance(image.get("name"), str) and isinstance(image.get("image"), str)
+            for image in images
+        ):
+            return _error("validation", "'images' must be a list of objects with 'name' and 'image' keys")
+        try:
+            mode = output_mode(job_input)
+            optimize = optimize_mode(job_input)
+            priority = job_priority(job_input)
+        except ValueError as e:
+            return _error("validation", str(e))
+        logger.info(f"Processing workflow with {len(workflow)} nodes and {len(images)} input image(s)")
+    if trace:
+        trace.set_workflow(workflow)
+    if deadline.stop_reason():
+        return _deadline_error(deadline)
+    schema_error = _validate_schema(workflow, deadline, trace)
+    if schema_error:
+        return schema_error
+
+    if images:
+        with traced_stage(HANDLER_NAME, "input_write", trace):
+            _, staging_errors = stage_images(
+                images,
+                comfy.host,
+                input_dir=STAGING.dir("input"),
+                max_bytes=MAX_IMAGE_SIZE,
+                timeout=deadline.timeout(30),
+                writer=STAGING.write_input,
+            )
+        if staging_errors:
+            logger.error(f"Failed to stage input images: {staging_errors}")
+            return _error("input_image", f"Failed to stage input images: {staging_errors}")
+
+    return _run_workflow(
+        comfy, workflow, deadline, trace, generic=True, mode=mode, optimize=optimize, priority=priority
+    )
+
+
+def _run_workflow(comfy, workflow, deadline, trace=None, generic=False, mode="history", optimize="all", priority=0):
+    """Optimize and queue a prepared workflow, listening on the websocket when the job needs it
+
+    Traced jobs listen so per-node timings can be captured; in websocket output mode
+    the save nodes are swapped for SaveImageWebsocket and the images come in as frames.
+    The prompt is queued once the scheduler gives the job its turn on the instance, and
+    with early release its node events hand that turn on once its tail nodes start.
+    """
+    with traced_stage(HANDLER_NAME, "optimize", trace):
+        workflow, report = optimize_workflow(workflow, optimize, OBJECT_INFO.get(timeout=deadline.timeout(10)))
+    summary = record_report(HANDLER_NAME, report)
+    if summary:
+        logger.info(summary)
+        if trace:
+            trace.instant("workflow_optimized", args=report)
+
+    collector = None
+    if mode == "websocket":
+        workflow, prefixes = swap_save_nodes(workflow)
+        if prefixes:
+            collector = WebsocketImageCollector(prefixes)
+            logger.info(f"Streaming outputs of node(s) {list(prefixes)} over the websocket")
         else:
-            logger.warning(f"Could not check available nodes (status: {nodes_req.status_code})")
-    except requests.RequestException as e:
-        logger.warning(f"Could not check available nodes: {str(e)}")
+            logger.warning("output_mode 'websocket' requested but the workflow has no save node to swap")
 
-    # --- 5. Queue the Prompt & Get the Output ---
+    # Higher-priority, resident and cheaper jobs overtake this one while ComfyUI is busy
+    models = RESIDENCY.demand(workflow)
+    with traced_stage(HANDLER_NAME, "schedule_wait", trace):
+        ticket = SCHEDULER.acquire(comfy.host, estimate_cost(workflow), priority, deadline, models, tail_nodes(workflow))
+    if ticket is None:
+        return _deadline_error(deadline)
+
+    client_id = str(uuid.uuid4())
+    ws_listener = None
+    # Set by the listener when the prompt is done, so completion isn't left to the /history poll
+    finished = None
+    # Node events let the next job queue its prompt while this one decodes and saves
+    on_node = (lambda node: SCHEDULER.node_started(ticket, node)) if SCHEDULER.wants_node_events(ticket) else None
+    try:
+        if RESIDENCY.prepare(comfy.host, models) == "swap":
+            # ComfyUI unloads everything else, routing shouldn't count on it any more
+            comfy.resident.clear()
+        if trace or collector or on_node:
+            try:
+                finished = threading.Event()
+                ws_listener = _open_ws_listener(comfy, client_id, trace, collector, on_node, finished)
+            except (websocket.WebSocketException, OSError) as e:
+                if collector:
+                    logger.error(f"Could not open websocket for streamed outputs: {str(e)}")
+                    return _error("websocket", f"Could not open websocket for streamed outputs: {str(e)}")
+                logger.warning(f"Could not open websocket for node events, node timings and early release unavailable: {str(e)}")
+                finished = None
+
+        return _queue_and_collect(comfy, workflow, client_id, deadline, trace, generic, collector, ticket, finished)
+    finally:
+        SCHEDULER.release(ticket)
+        if ws_listener:
+            _close_ws_listener(*ws_listener)
+
+def _queue_and_collect(comfy, workflow, client_id, deadline, trace=None, generic=False, collector=None, ticket=None,
+                       finished=None):
+    """Queue the workflow, wait for it to finish and return the job result
+
+    Generic workflows return their images in output order under ComfyUI's filenames;
+    the built-in graph returns node "95" first, named after the prompt. With a
+    collector the images were streamed over the websocket and nothing is downloaded.
+    With a websocket listener's finished event /history is checked as soon as the
+    prompt is done instead of on the next one second poll.
+    """
+    if deadline.stop_reason():
+        return _deadline_error(deadline)
+    # The prompt only lives as long as this ComfyUI process does
+    supervisor = comfy.supervisor
+    comfy_generation = supervisor.generation if supervisor else None
     try:
-        logger.info("Queuing workflow to ComfyUI...")
-        req = requests.post(f"http://{COMFY_HOST}/prompt", json={"prompt": workflow}, timeout=30)
-        req.raise_for_status()
-        response_data = req.json()
+        logger.debug("Queuing workflow to ComfyUI...")
+        queued_at = time.time()
+        with traced_stage(HANDLER_NAME, "prompt_queue", trace):
+            req = requests.post(f"http://{comfy.host}/prompt", json={"prompt": workflow, "client_id": client_id}, timeout=deadline.timeout(30))
+            req.raise_for_status()
+            response_data = req.json()
         prompt_id = response_data.get('prompt_id')
         if not prompt_id:
             logger.error(f"No prompt_id in ComfyUI response: {response_data}")
-            return {"error": f"No prompt_id in response: {response_data}"}
+            return _error("queue", f"No prompt_id in response: {response_data}")
+        set_prompt_id(prompt_id)
+        note(prompt_id=prompt_id)
         logger.info(f"Workflow queued successfully with prompt_id: {prompt_id}")
+        if trace:
+            trace.prompt_id = prompt_id
     except requests.RequestException as e:
         logger.error(f"Failed to queue workflow: {str(e)}")
-        return {"error": f"Failed to queue workflow: {str(e)}"}
+        return _error("queue", f"Failed to queue workflow: {str(e)}", include_logs=True, comfy=comfy)
 
-    output_image = None
-    # Just keep checking until RunPod kills us or we get results
-    # Keep these variables for progress tracking (not timeout!)
+    outputs = None
+    # Keep checking until we get results, the job's deadline passes or it is cancelled
+    # Keep these variables for progress tracking
     check_count = 0
-    start_time = time.time()  # Just for progress logging, not timeout
+    start_time = time.time()  # Just for progress logging, the deadline enforces the timeout
 
-    while output_image is None:
+    while outputs is None:
         check_count += 1
         
-        # Log progress every 10 seconds (but don't timeout!)
+        # Log progress every 10 seconds
         if check_count % 10 == 0:
             elapsed_time = time.time() - start_time  # Calculate how long we've been waiting
             logger.info(f"Still waiting for completion... ({elapsed_time:.1f}s elapsed)")
                 
+        if supervisor and supervisor.has_exited_since(comfy_generation):
+            return _comfyui_exited_error(prompt_id, comfy)
+        if deadline.stop_reason():
+            return _deadline_error(deadline, prompt_id, comfy)
+
         try:
-            history_req = requests.get(f"http://{COMFY_HOST}/history/{prompt_id}", timeout=60)
+            history_req = requests.get(f"http://{comfy.host}/history/{prompt_id}", timeout=deadline.timeout(60))
             history_req.raise_for_status()
             history = history_req.json().get(prompt_id, {})
         except requests.RequestException as e:
+            if supervisor and supervisor.has_exited_since(comfy_generation):
+                return _comfyui_exited_error(prompt_id, comfy)
             logger.error(f"Failed to check workflow status: {str(e)}")
-            return {"error": f"Failed to check workflow status: {str(e)}"}
+            return _error("status_check", f"Failed to check workflow status: {str(e)}", include_logs=True, comfy=comfy)
             
         # Check for errors in the workflow execution
         if 'status' in history and history['status'].get('status_str') == 'error':
             error_details = history['status'].get('messages', [])
             logger.error(f"Workflow execution failed: {error_details}")
-            return {"error": f"Workflow execution failed: {error_details}"}
+            return _error("execution", f"Workflow execution failed: {error_details}", include_logs=True, comfy=comfy)
             
-        # Check if the job is done and has outputs
-        if history.get('outputs'):
-            outputs = history['outputs']
+        # Check if the job is done and has outputs (streamed outputs don't show up in history)
+        if history.get('outputs') or (collector and history.get('status', {}).get('completed')):
+            outputs = history.get('outputs', {})
             logger.info("Workflow completed, processing outputs...")
-            # Find your "SaveImagePlus" node's output (node "95")
-            save_image_node_id = "95" 
-            if save_image_node_id in outputs:
-                node_output = outputs[save_image_node_id]
-                if 'images' in node_output and len(node_output['images']) > 0:
-                    image_data = node_output['images'][0]
-                    image_url = f"http://{COMFY_HOST}/view?filename={image_data['filename']}&subfolder={image_data.get('subfolder', '')}&type={image_data.get('type', 'output')}"
-                    try:
-                        logger.info(f"Downloading output image: {image_data['filename']}")
-                        response = requests.get(image_url, timeout=30)
-                        response.raise_for_status()
-                        output_image = response.content
-                        logger.info(f"Successfully downloaded output image ({len(output_image)} bytes)")
-                    except requests.RequestException as e:
-                        logger.error(f"Failed to download output image: {str(e)}")
-                        return {"error": f"Failed to download output image: {str(e)}"}
-                else:
-                    logger.error("No images found in SaveImagePlus node output")
-                    return {"error": "No images generated by the workflow"}
-            else:
-                logger.error(f"SaveImagePlus node (ID: {save_image_node_id}) not found in outputs")
-                return {"error": "Expected output node not found"}
-            # If we have outputs but not the one we want, something is wrong, stop waiting.
-            break 
+            # The outputs are fetched while the next job's prompt runs
+            if ticket:
+                SCHEDULER.release(ticket)
+            _record_execution_timings(history, queued_at, trace, comfy.host)
+            # Only now are the models known to be loaded there, for routing later jobs
+            comfy.executed(workflow)
+            break
                 
-        time.sleep(1.0)  # Wait 1 second between checks
+        if finished is not None and not finished.is_set():
+            # Woken by the listener the moment the prompt is done; an exited ComfyUI or a
+            # cancelled job is noticed on the next check, within the second
+            finished.wait(deadline.timeout(1.0))
+            continue
+        # Wait 1 second between checks, waking early if ComfyUI exits or the job is cancelled;
+        # once the websocket reported the prompt done, /history only trails it by milliseconds
+        pause = HISTORY_CATCH_UP_S if finished is not None else 1.0
+        if supervisor:
+            supervisor.wait_for_exit(comfy_generation, timeout=deadline.timeout(pause))
+        else:
+            deadline.wait(pause)
 
-    # --- 6. Return the Final Image ---
-    if output_image:
-        image_base64_out = base64.b64encode(output_image).decode('utf-8')
-        return {
-            "images": [
-                {
-                    "filename": f"FormDez_{prompt_id}.webp",
-                    "type": "base64",
-                    "data": image_base64_out
-                }
-            ]
-        }
-    else:
-        return {"error": "Failed to generate image."}
+    if collector:
+        return _streamed_result(collector, prompt_id, deadline, generic, trace)
+
+    # --- 6. Fetch every output image concurrently and return them ---
+    images = _collect_output_images(outputs, primary_node=None if generic else SAVE_IMAGE_NODE_ID)
+    if not images:
+        logger.error(f"No images found in workflow outputs (nodes: {list(outputs)})")
+        return _error("output", "No images generated by the workflow")
+
+    logger.info(f"Downloading {len(images)} output image(s)...")
+    with ThreadPoolExecutor(max_workers=min(OUTPUT_CONCURRENCY, len(images))) as pool:
+        # Each fetch runs in a copy of the job's context so its logs keep job_id/prompt_id;
+        # results stay in the same order as the workflow's outputs
+        futures = [
+            pool.submit(contextvars.copy_context().run, _fetch_output_image, comfy, image, deadline, trace)
+            for image in images
+        ]
+        results = [future.result() for future in futures]
+
+    failed = [error for _, error in results if error]
+    if failed:
+        logger.error(f"Failed to download output image: {failed[0]}")
+        return _error("output", f"Failed to download output image: {failed[0]}")
+
+    delivered = []
+    for index, (image_data, _) in enumerate(results):
+        if generic:
+            filename = image_data['filename']
+        else:
+            # The first image keeps the name clients already expect
+            extension = os.path.splitext(image_data['filename'])[1] or ".webp"
+            suffix = "" if index == 0 else f"_{index}"
+            filename = f"FormDez_{prompt_id}{suffix}{extension}"
+        delivered.append({
+            "filename": filename,
+            "type": "base64",
+            "data": image_data["base64"],
+        })
+    for image_data in images:
+        JANITOR.discard_output(comfy.output_image(image_data))
+    return {"images": delivered}
+
+
+def _streamed_result(collector, prompt_id, deadline, generic=False, trace=None):
+    """Build the job result from images received as websocket frames"""
+    # History can be written before the last frames have been read off the socket
+    if not collector.wait_done(deadline.timeout(10)):
+        logger.warning("Execution finished without an end-of-execution event on the websocket")
+    missing = collector.missing_nodes()
+    if missing:
+        logger.error(f"No images received over the websocket from save node(s) {missing}")
+        return _error("output", f"No images received over the websocket from save node(s) {missing}")
+
+    delivered = []
+    with traced_stage(HANDLER_NAME, "output_encode", trace):
+        for index, image in enumerate(collector.images()):
+            if generic:
+                filename = image['filename']
+            else:
+                extension = os.path.splitext(image['filename'])[1]
+                suffix = "" if index == 0 else f"_{index}"
+                filename = f"FormDez_{prompt_id}{suffix}{extension}"
+            delivered.append({
+                "filename": filename,
+                "type": "base64",
+                "data": base64.b64encode(image['data']).decode('utf-8'),
+            })
+    logger.info(f"Received {len(delivered)} output image(s) over the websocket")
+    return {"images": delivered}
+
+
+def _collect_output_images(outputs, primary_node=None):
+    """All non-temp images across the output nodes, primary_node's first"""
+    node_ids = sorted(outputs, key=lambda node_id: node_id != primary_node)
+    return [
+        image
+        for node_id in node_ids
+        for image in outputs[node_id].get('images', [])
+        if image.get('filename') and image.get('type', 'output') != 'temp'
+    ]
+
+
+def _fetch_output_image(comfy, image_data, deadline, trace=None):
+    """Download and base64-encode one output image; returns (result, error message)"""
+    params = urllib.parse.urlencode({
+        "filename": image_data['filename'],
+        "subfolder": image_data.get('subfolder', ''),
+        "type": image_data.get('type', 'output'),
+    })
+    try:
+        logger.debug(f"Downloading output image: {image_data['filename']}")
+        with traced_stage(HANDLER_NAME, "output_fetch", trace):
+            response = requests.get(f"http://{comfy.host}/view?{params}", timeout=deadline.timeout(30))
+            response.raise_for_status()
+        logger.debug(f"Successfully downloaded output image ({len(response.content)} bytes)")
+    except requests.RequestException as e:
+        return None, f"{image_data['filename']}: {str(e)}"
+    with traced_stage(HANDLER_NAME, "output_encode", trace):
+        encoded = base64.b64encode(response.content).decode('utf-8')
+    return {"filename": image_data['filename'], "base64": encoded}, None
 
 
 def health_check():
     """Health check endpoint for RunPod"""
     try:
-        comfy_healthy = check_comfyui_health()
-        return {
+        # Read from the health monitor's snapshot, a probe never waits on ComfyUI
+        healthy_hosts = [host for host in INSTANCES.hosts if MONITOR.healthy(host)]
+        comfy_healthy = bool(healthy_hosts)
+        status = {
             "status": "healthy" if comfy_healthy else "unhealthy",
             "comfyui": "running" if comfy_healthy else "not_running",
             "timestamp": time.time()
         }
+        status["comfyui_health"] = MONITOR.status()
+        if INSTANCES.primary.supervisor:
+            status["comfyui_process"] = INSTANCES.primary.supervisor.status()
+        if len(INSTANCES.instances) > 1:
+            status["comfyui_instances"] = INSTANCES.status()
+            status["comfyui_instances_healthy"] = len(healthy_hosts)
+        status["scheduler"] = SCHEDULER.status()
+        status["janitor"] = JANITOR.status()
+        status["refresh"] = REFRESH.status()
+        status["residency"] = RESIDENCY.status()
+        status["staging"] = STAGING.status()
+        return status
     except Exception as e:
         return {
             "status": "unhealthy",
@@ -641,45 +1124,106 @@ def health_check():
         }
 
 
+def log_model_directories():
+    """Log what the network volume holds, once at startup rather than on every job"""
+    volume_models = '/runpod-volume/ComfyUI/models'
+    logger.info(f"Contents of /runpod-volume: {os.listdir('/runpod-volume') if os.path.exists('/runpod-volume') else 'Directory not found'}")
+    if not os.path.exists(volume_models):
+        logger.info(f"{volume_models}: Directory not found")
+        return
+    logger.info(f"Contents of {volume_models}: {os.listdir(volume_models)}")
+    for subdir in ['checkpoints', 'vae', 'controlnet', 'clip', 'upscale_models', 'text_encoders']:
+        subdir_path = f'{volume_models}/{subdir}'
+        if os.path.exists(subdir_path):
+            logger.info(f"Contents of {subdir_path}: {os.listdir(subdir_path)}")
+        else:
+            logger.info(f"{subdir_path}: Directory not found")
+
 def initialize_comfyui():
-    """Initialize ComfyUI server on startup"""
-    import subprocess
-    import threading
-    
-    def start_comfyui():
-        """Start ComfyUI server in background"""
-        try:
-            # Start ComfyUI server using the virtual environment
-            # This matches your install script setup
-            command = [
-                "/bin/bash", "-c",
-                f"cd {COMFY_DIR} && source venv/bin/activate && python main.py --listen --port 3001"
-            ]
-            subprocess.run(command, check=False)
-        except Exception as e:
-            logger.error(f"Failed to start ComfyUI: {str(e)}")
-    
-    logger.info("Starting ComfyUI server...")
-    # Start ComfyUI in a separate thread
-    comfyui_thread = threading.Thread(target=start_comfyui, daemon=True)
-    comfyui_thread.start()
-    
-    # Wait for ComfyUI to be ready
-    if wait_for_comfyui(timeout=120):  # Wait up to 2 minutes for startup
-        logger.info("ComfyUI initialization complete")
-        return True
-    else:
-        logger.error("ComfyUI failed to start within timeout period")
+    """Initialize the ComfyUI server(s) on startup: one per GPU, see rp_instances"""
+    global INSTANCES
+
+    if COMFY_HOSTS:
+        # Servers managed outside this worker, just wait for them
+        logger.info(f"Using existing ComfyUI servers {INSTANCES.hosts}")
+        return all(wait_for_comfyui(timeout=120, host=host) for host in INSTANCES.hosts)
+
+    # Custom nodes and performance flags depend on COMFY_LAUNCH_PROFILE
+    try:
+        extra_args, plan = launch_args(COMFY_DIR, [json.loads(WORKFLOW_API_JSON)])
+    except ValueError as e:
+        logger.error(f"Invalid launch profile: {str(e)}")
         return False
+    if plan["skipped"]:
+        logger.info(f"Launch profile '{plan['profile']}' loads custom nodes {plan['loaded']}, skips {plan['skipped']}")
+
+    slots = plan_slots(COMFY_HOST)
+    instances = []
+    started = time.time()
+    for slot in slots:
+        args = ["--port", str(slot["port"])]
+        if slot["device"] is not None:
+            args += ["--cuda-device", slot["device"]]
+        # Staged input/output/temp folders; output counters are per folder, so instances
+        # sharing one would overwrite each other's images
+        args += STAGING.launch_args(slot["output_subfolder"])
+        # Start ComfyUI server using the virtual environment
+        # This matches your install script setup; exec hands the Popen handle to ComfyUI itself
+        command = [
+            "/bin/bash", "-c",
+            f"cd {COMFY_DIR} && source venv/bin/activate && exec python main.py --listen "
+            + " ".join(shlex.quote(arg) for arg in args + extra_args)
+        ]
+        name = "ComfyUI" if len(slots) == 1 else f"ComfyUI[{slot['index']}]"
+        logger.info(f"Starting {name} on port {slot['port']} (device {slot['device']})...")
+        try:
+            supervisor = ComfySupervisor(command, name=name).start()
+        except OSError as e:
+            logger.error(f"Failed to start {name}: {str(e)}")
+            return False
+        instances.append(ComfyInstance(slot["host"], slot["index"], slot["device"], supervisor, slot["output_subfolder"]))
+
+    INSTANCES = InstancePool(instances, monitor=MONITOR)
+    MONITOR.hosts = INSTANCES.hosts
+    ADMISSION.comfy_hosts = INSTANCES.hosts
+    OBJECT_INFO.comfy_host = INSTANCES.primary.host
+
+    # Wait for every instance to be ready
+    for comfy in instances:
+        if not wait_for_comfyui(timeout=max(1, 120 - (time.time() - started)), host=comfy.host):  # Wait up to 2 minutes for startup
+            logger.error(f"ComfyUI at {comfy.host} failed to start within timeout period")
+            return False
+    boot = record_boot(
+        COMFY_DIR, plan, time.time() - started, INSTANCES.primary.supervisor.recent_output(COMFY_LOG_BUFFER_LINES)
+    )
+    logger.info(
+        f"ComfyUI initialization complete in {boot['boot_s']}s ({len(instances)} instance(s), {boot['profile']} profile, "
+        f"skipped {len(boot['skipped'])} custom node package(s) worth {boot['skipped_import_s']}s of imports"
+        + (f", {boot['saved_s']}s faster than the last full boot" if "saved_s" in boot else "")
+        + ")"
+    )
+    if boot["unmeasured"]:
+        logger.info(f"No import times recorded yet for skipped packages {boot['unmeasured']}")
+    return True
 
 if __name__ == "__main__":
+    log_model_directories()
     # Initialize ComfyUI on startup
     if not initialize_comfyui():
         logger.error("Failed to initialize ComfyUI - exiting")
         exit(1)
     
+    start_metrics_server()
+    # Replaces the admission controller's own /queue poller
+    MONITOR.start()
+    RESIDENCY.register("builtin", json.loads(WORKFLOW_API_JSON))
+    RESIDENCY.register_launch_workflows()
+    JANITOR.start()
+    LEDGER.start()
     logger.info("Starting RunPod serverless handler...")
     runpod.serverless.start({
-        "handler": handler,
+        # Runs the handler in a thread so RunPod cancellations reach it
+        "handler": async_handler(handler),
+        "concurrency_modifier": ADMISSION.concurrency_modifier,
         "rp_healthcheck": health_check
     })
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""
+Background health monitor for the ComfyUI server(s).
+
+Health probes used to make an HTTP request to ComfyUI every time they ran and each
+job checked reachability again before it started. HealthMonitor instead polls
+/system_stats and /queue of every server from a daemon thread every
+HEALTH_POLL_INTERVAL_S and keeps the latest snapshot: reachability, VRAM and RAM,
+queue depth and the time of the last successful poll. Health probes, the per-job
+readiness check, instance routing and admission control read that snapshot without
+any network I/O.
+
+A server is healthy while its last successful poll is at most HEALTH_STALE_AFTER_S
+old; callers fall back to a direct check when it isn't (or before the first poll).
+"""
+import os
+import time
+import logging
+import threading
+
+import requests
+
+from rp_metrics import COMFYUI_MEMORY_BYTES, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Seconds between polls of every ComfyUI server
+HEALTH_POLL_INTERVAL_S = float(os.getenv("HEALTH_POLL_INTERVAL_S", "2"))
+# A server whose last successful poll is older than this counts as unhealthy
+HEALTH_STALE_AFTER_S = float(os.getenv("HEALTH_STALE_AFTER_S", "10"))
+
+
+def _system_stats(host, timeout):
+    response = requests.get(f"http://{host}/system_stats", timeout=timeout)
+    response.raise_for_status()
+    stats = response.json()
+    system = stats.get("system", {})
+    devices = stats.get("devices") or [{}]
+    return {
+        "ram_total": system.get("ram_total"),
+        "ram_free": system.get("ram_free"),
+        # The first device is the one ComfyUI runs on
+        "device": devices[0].get("name"),
+        "vram_total": devices[0].get("vram_total"),
+        "vram_free": devices[0].get("vram_free"),
+    }
+
+
+def _queue(host, timeout):
+    response = requests.get(f"http://{host}/queue", timeout=timeout)
+    response.raise_for_status()
+    queue = response.json()
+    return {
+        "running": len(queue.get("queue_running", [])),
+        "pending": len(queue.get("queue_pending", [])),
+    }
+
+
+class HealthMonitor:
+    """Polls every ComfyUI server in the background and serves the last snapshot"""
+
+    def __init__(self, hosts, interval_s=HEALTH_POLL_INTERVAL_S, stale_after_s=HEALTH_STALE_AFTER_S):
+        self.hosts = list(hosts)
+        self.interval_s = interval_s
+        self.stale_after_s = stale_after_s
+        # host -> snapshot dict; snapshots are replaced, never modified, so readers need no lock
+        self._snapshots = {}
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_listener(self, listener):
+        """Call listener(monitor) after every polling round"""
+        self._listeners.append(listener)
+
+    def poll_host(self, host):
+        """Poll one server and store its snapshot"""
+        previous = self._snapshots.get(host) or {}
+        timeout = max(0.5, min(5.0, self.interval_s))
+        snapshot = {"host": host, "polled_at": time.time()}
+        try:
+            snapshot.update(_queue(host, timeout))
+            snapshot.update(_system_stats(host, timeout))
+            snapshot["reachable"] = True
+            snapshot["last_success"] = snapshot["polled_at"]
+            snapshot["_last_success_mono"] = time.monotonic()
+        except (requests.RequestException, ValueError, AttributeError) as e:
+            if previous.get("reachable", True):
+                logger.warning(f"ComfyUI at {host} failed its health poll: {str(e)}")
+            snapshot.update({
+                "reachable": False,
+                "error": str(e),
+                "last_success": previous.get("last_success"),
+                "_last_success_mono": previous.get("_last_success_mono"),
+            })
+        else:
+            if previous and not previous.get("reachable"):
+                logger.info(f"ComfyUI at {host} is reachable again")
+            for kind in ("vram_total", "vram_free", "ram_total", "ram_free"):
+                if snapshot.get(kind) is not None:
+                    COMFYUI_MEMORY_BYTES.set(snapshot[kind], host=host, kind=kind)
+        self._snapshots[host] = snapshot
+        return snapshot
+
+    def poll_once(self):
+        for host in list(self.hosts):
+            self.poll_host(host)
+        running, pending = self.queue_totals()
+        QUEUE_DEPTH.set(running, state="running")
+        QUEUE_DEPTH.set(pending, state="pending")
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception:
+                logger.exception("Health monitor listener failed")
+
+    # --- O(1) readers ------------------------------------------------------
+
+    def snapshot(self, host=None):
+        """The last snapshot of a server (the first one by default), None before its first poll"""
+        return self._snapshots.get(host or self.hosts[0])
+
+    def healthy(self, host=None):
+        snapshot = self.snapshot(host)
+        if not snapshot or snapshot.get("_last_success_mono") is None:
+            return False
+        return snapshot["reachable"] and time.monotonic() - snapshot["_last_success_mono"] <= self.stale_after_s
+
+    def any_reachable(self):
+        return any((self._snapshots.get(host) or {}).get("reachable") for host in self.hosts)
+
+    def queue_totals(self):
+        """(running, pending) summed over the servers that answered their last poll"""
+        snapshots = [self._snapshots.get(host) or {} for host in self.hosts]
+        return (
+            sum(s.get("running", 0) for s in snapshots if s.get("reachable")),
+            sum(s.get("pending", 0) for s in snapshots if s.get("reachable")),
+        )
+
+    def status(self):
+        now = time.monotonic()
+        servers = []
+        for host in self.hosts:
+            snapshot = self._snapshots.get(host)
+            if snapshot is None:
+                servers.append({"host": host, "healthy": False, "polled": False})
+                continue
+            entry = {k: v for k, v in snapshot.items() if not k.startswith("_")}
+            entry["healthy"] = self.healthy(host)
+            if snapshot.get("_last_success_mono") is not None:
+                entry["last_success_age_s"] = round(now - snapshot["_last_success_mono"], 1)
+            servers.append(entry)
+        return servers
+
+    # --- background polling ------------------------------------------------
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.poll_once()
+
+    def start(self):
+        """Poll in a daemon thread; the first round runs before this returns"""
+        if self._thread is None:
+            self.poll_once()
+            self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
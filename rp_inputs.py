@@ -0,0 +1,140 @@
+"""
+Input image staging for ComfyUI workflows.
+
+Jobs carry their input images as base64 strings named after the LoadImage inputs
+that reference them. stage_images() puts them where ComfyUI can read them, all at
+once instead of one after another: when ComfyUI's input directory is on this
+machine the decoded bytes are written straight into it, otherwise they are posted
+to /upload/image over a shared pool of keep-alive connections.
+"""
+import os
+import base64
+import logging
+import binascii
+import tempfile
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Input images decoded and written/uploaded at the same time
+INPUT_CONCURRENCY = int(os.getenv("INPUT_CONCURRENCY", "4"))
+# "auto" writes into COMFY_DIR/input when it exists, "filesystem" always does, "upload" always uses /upload/image
+INPUT_STAGING = os.getenv("INPUT_STAGING", "auto").lower()
+
+# Keep-alive connections to ComfyUI shared by all upload threads
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max(1, INPUT_CONCURRENCY)))
+
+
+class InputImageError(ValueError):
+    """An input image could not be decoded or staged"""
+
+
+def decode_image(data):
+    """Decode a base64 string, with or without a data URI prefix"""
+    if "," in data:
+        data = data.split(",", 1)[1]
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError) as e:
+        raise InputImageError(f"Error decoding base64: {e}")
+
+
+def _check_name(name):
+    """Refuse names that would land outside ComfyUI's input directory"""
+    normalized = os.path.normpath(name) if name else ""
+    if not normalized or normalized == "." or os.path.isabs(normalized) or normalized.split(os.sep)[0] == "..":
+        raise InputImageError(f"Invalid image name {name!r}")
+    return normalized
+
+
+def input_path(input_dir, name):
+    """Resolve name inside input_dir, refusing names that escape it through symlinked folders.
+    A symlink in place of the file itself (a spilled input, see rp_staging) is replaced, not followed"""
+    root = os.path.realpath(input_dir)
+    parent, filename = os.path.split(os.path.join(root, name))
+    path = os.path.join(os.path.realpath(parent), filename)
+    if not filename or os.path.commonpath([root, path]) != root or path == root:
+        raise InputImageError(f"Invalid image name {name!r}")
+    return path
+
+
+def write_image(input_dir, name, blob):
+    """Write an image into input_dir atomically; returns its path"""
+    path = input_path(input_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so a concurrent job never reads a half-written file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def _upload_image(comfy_host, name, blob, timeout):
+    subfolder, filename = os.path.split(name)
+    files = {
+        "image": (filename, blob, "image/png"),
+        "overwrite": (None, "true"),
+    }
+    if subfolder:
+        files["subfolder"] = (None, subfolder)
+    response = _session.post(f"http://{comfy_host}/upload/image", files=files, timeout=timeout)
+    response.raise_for_status()
+
+
+def staging_mode(input_dir):
+    """"filesystem" or "upload", resolving INPUT_STAGING=auto against input_dir"""
+    if INPUT_STAGING in ("filesystem", "upload"):
+        return INPUT_STAGING
+    return "filesystem" if input_dir and os.path.isdir(input_dir) else "upload"
+
+
+def stage_images(images, comfy_host, input_dir=None, max_bytes=None, timeout=30,
+                 max_workers=INPUT_CONCURRENCY, writer=None):
+    """Decode and stage [{"name", "image"}] input images concurrently
+
+    writer(name, blob) replaces writing into input_dir, e.g. rp_staging's StagingArea.write_input.
+    Returns (staged names, error messages), both in input order.
+    """
+    if not images:
+        return [], []
+    mode = staging_mode(input_dir)
+
+    def stage(image):
+        name = image.get("name", "unknown")
+        try:
+            name = _check_name(name)
+            blob = decode_image(image["image"])
+            if max_bytes and len(blob) > max_bytes:
+                raise InputImageError(f"Image too large (max {max_bytes // (1024 * 1024)}MB)")
+            if mode == "filesystem":
+                (writer or partial(write_image, input_dir))(name, blob)
+            else:
+                _upload_image(comfy_host, name, blob, timeout)
+        except InputImageError as e:
+            return None, f"{name}: {e}"
+        except requests.Timeout:
+            return None, f"Timeout uploading {name}"
+        except (requests.RequestException, OSError) as e:
+            return None, f"Error staging {name}: {e}"
+        return name, None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(images)))) as pool:
+        # A copy of the caller's context per image keeps the job_id/prompt_id on the workers' logs
+        futures = [pool.submit(contextvars.copy_context().run, stage, image) for image in images]
+        results = [future.result() for future in futures]
+    logger.info(f"Staged {len(images)} input image(s) via {mode}")
+    staged = [name for name, error in results if name]
+    errors = [error for _, error in results if error]
+    return staged, errors
@@ -0,0 +1,253 @@
+"""
+Multi-instance ComfyUI: one server per GPU (or per configured slot) behind one worker.
+
+plan_slots() decides how many ComfyUI instances to run and on which device, and
+InstancePool routes each job to the least-loaded one. An instance's load is the
+larger of the jobs this worker has in flight on it and the queue depth it last
+reported through /queue, read from the health monitor's snapshot (rp_health) when
+there is one. Instances that already hold the job's models in memory are
+preferred: a cold instance is charged COMFY_MODEL_LOAD_PENALTY extra jobs, scaled by
+the fraction of the job's models it would have to load. Instances whose process has
+exited or whose /queue stops answering are only used when no healthy one is left.
+An instance only counts a job's models as loaded once its prompt ran successfully
+there (executed()), so failed, cancelled and expired jobs don't attract affinity.
+
+Every instance shares COMFY_DIR's models and input folder. Instances after the first
+save into output/instance-<n> so their output counters never collide.
+"""
+import os
+import time
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import requests
+
+from rp_metrics import INSTANCE_JOBS
+
+logger = logging.getLogger(__name__)
+
+# "auto" runs one instance per visible GPU, a number runs that many slots spread over the GPUs
+COMFY_INSTANCES = os.getenv("COMFY_INSTANCES", "auto").lower()
+# Comma-separated CUDA device ids to use; defaults to CUDA_VISIBLE_DEVICES or every GPU nvidia-smi lists
+COMFY_GPU_DEVICES = os.getenv("COMFY_GPU_DEVICES", "")
+# Comma-separated hosts of already running ComfyUI servers; when set nothing is launched
+COMFY_HOSTS = os.getenv("COMFY_HOSTS", "")
+# Extra jobs' worth of load charged to an instance that has none of the job's models loaded
+COMFY_MODEL_LOAD_PENALTY = float(os.getenv("COMFY_MODEL_LOAD_PENALTY", "1.0"))
+# Model names remembered per instance as resident
+COMFY_RESIDENT_MODELS = int(os.getenv("COMFY_RESIDENT_MODELS", "8"))
+# Seconds a /queue reading is reused before the scheduler polls the instance again
+COMFY_QUEUE_POLL_S = float(os.getenv("COMFY_QUEUE_POLL_S", "1.0"))
+
+# File extensions of model weights
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".sft", ".gguf", ".onnx")
+
+
+def visible_devices():
+    """CUDA device ids available to this worker, [None] if there is no GPU to pin to"""
+    configured = COMFY_GPU_DEVICES or os.getenv("CUDA_VISIBLE_DEVICES", "")
+    if configured:
+        return [device.strip() for device in configured.split(",") if device.strip()]
+    try:
+        result = subprocess.run(
+            ["nvidia-smi", "--query-gpu=index", "--format=csv,noheader"],
+            capture_output=True, text=True, timeout=10,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return [None]
+    devices = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+    return devices if result.returncode == 0 and devices else [None]
+
+
+def plan_slots(comfy_host, devices=None, instances=COMFY_INSTANCES):
+    """[{"index", "host", "port", "device", "output_subfolder"}] for the instances to launch"""
+    devices = devices or visible_devices()
+    count = len(devices) if instances == "auto" else max(1, int(instances))
+    address, base_port = comfy_host.rsplit(":", 1)
+    slots = []
+    for index in range(count):
+        port = int(base_port) + index
+        slots.append({
+            "index": index,
+            "host": f"{address}:{port}",
+            "port": port,
+            # Slots beyond the device count share GPUs round-robin
+            "device": devices[index % len(devices)],
+            "output_subfolder": "" if index == 0 else f"instance-{index}",
+        })
+    return slots
+
+
+def workflow_models(workflow):
+    """Model files a workflow loads: literal inputs ending in a model file extension
+
+    Other loader inputs such as weight_dtype or a CLIP type ("flux", "default") are
+    options shared by unrelated workflows, not models.
+    """
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, str) and value.lower().endswith(MODEL_EXTENSIONS):
+                models.add(value)
+    return models
+
+
+class ComfyInstance:
+    """One ComfyUI server and what the scheduler knows about it"""
+
+    def __init__(self, host, index=0, device=None, supervisor=None, output_subfolder=""):
+        self.host = host
+        self.index = index
+        self.device = device
+        self.supervisor = supervisor
+        self.output_subfolder = output_subfolder
+        self.in_flight = 0
+        self.running = 0
+        self.pending = 0
+        self.reachable = True
+        self.polled_at = None
+        self.resident = OrderedDict()
+
+    @property
+    def name(self):
+        return f"instance-{self.index}"
+
+    def healthy(self):
+        if self.supervisor and not self.supervisor.is_running():
+            return False
+        return self.reachable
+
+    def load(self):
+        # Our own queued jobs also show up in /queue, so the larger of the two counts
+        return max(self.in_flight, self.running + self.pending)
+
+    def residency(self, models):
+        """Fraction of models already loaded on this instance"""
+        if not models:
+            return 1.0
+        return sum(1 for model in models if model in self.resident) / len(models)
+
+    def executed(self, workflow):
+        """Record the models of a workflow whose prompt completed on this instance"""
+        if isinstance(workflow, dict):
+            self.remember_models(workflow_models(workflow))
+
+    def remember_models(self, models, limit=COMFY_RESIDENT_MODELS):
+        for model in models:
+            self.resident.pop(model, None)
+            self.resident[model] = True
+        while len(self.resident) > limit:
+            self.resident.popitem(last=False)
+
+    def poll_queue(self, timeout=2):
+        """Refresh queue depth and reachability from /queue"""
+        try:
+            response = requests.get(f"http://{self.host}/queue", timeout=timeout)
+            response.raise_for_status()
+            queue = response.json()
+            self.running = len(queue.get("queue_running", []))
+            self.pending = len(queue.get("queue_pending", []))
+            self.reachable = True
+        except (requests.RequestException, ValueError) as e:
+            logger.debug(f"Could not poll {self.name} ({self.host}) /queue: {str(e)}")
+            self.reachable = False
+        self.polled_at = time.monotonic()
+        return self.reachable
+
+    def observe(self, snapshot):
+        """Take queue depth and reachability from a health monitor snapshot"""
+        self.running = snapshot.get("running", self.running)
+        self.pending = snapshot.get("pending", self.pending)
+        self.reachable = snapshot.get("reachable", False)
+        self.polled_at = time.monotonic()
+
+    def output_image(self, image):
+        """A /history image reference relative to the shared output folder (for the janitor)"""
+        if not self.output_subfolder or image.get("type", "output") != "output":
+            return image
+        return dict(image, subfolder=os.path.join(self.output_subfolder, image.get("subfolder") or ""))
+
+    def status(self):
+        return {
+            "host": self.host,
+            "device": self.device,
+            "healthy": self.healthy(),
+            "in_flight": self.in_flight,
+            "running": self.running,
+            "pending": self.pending,
+            "resident_models": list(self.resident),
+            "process": self.supervisor.status() if self.supervisor else None,
+        }
+
+
+class InstancePool:
+    """Routes jobs to the least-loaded ComfyUI instance"""
+
+    def __init__(self, instances, model_load_penalty=COMFY_MODEL_LOAD_PENALTY,
+                 poll_interval_s=COMFY_QUEUE_POLL_S, monitor=None):
+        self.instances = list(instances)
+        self.model_load_penalty = model_load_penalty
+        self.poll_interval_s = poll_interval_s
+        # An rp_health.HealthMonitor whose snapshots replace polling /queue here
+        self.monitor = monitor
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_hosts(cls, hosts, **kwargs):
+        return cls([ComfyInstance(host, index) for index, host in enumerate(hosts)], **kwargs)
+
+    @property
+    def primary(self):
+        return self.instances[0]
+
+    @property
+    def hosts(self):
+        return [instance.host for instance in self.instances]
+
+    def _refresh(self):
+        now = time.monotonic()
+        for instance in self.instances:
+            snapshot = self.monitor.snapshot(instance.host) if self.monitor else None
+            if snapshot:
+                instance.observe(snapshot)
+            elif not self.monitor and (instance.polled_at is None or now - instance.polled_at >= self.poll_interval_s):
+                instance.poll_queue()
+
+    def _cost(self, instance, models):
+        return instance.load() + (1.0 - instance.residency(models)) * self.model_load_penalty
+
+    def choose(self, workflow=None):
+        """Reserve the best instance for a job; release() it when the job is done"""
+        models = workflow_models(workflow) if isinstance(workflow, dict) else set()
+        self._refresh()
+        with self._lock:
+            candidates = [i for i in self.instances if i.healthy()] or self.instances
+            instance = min(candidates, key=lambda i: (self._cost(i, models), i.in_flight, i.index))
+            instance.in_flight += 1
+        INSTANCE_JOBS.inc(instance=instance.name)
+        if len(self.instances) > 1:
+            logger.info(
+                f"Routing job to {instance.name} ({instance.host}, load {instance.load() - 1}, "
+                f"{instance.residency(models) * 100:.0f}% of models resident)"
+            )
+        return instance
+
+    def release(self, instance):
+        with self._lock:
+            instance.in_flight = max(0, instance.in_flight - 1)
+
+    @contextmanager
+    def acquire(self, workflow=None):
+        instance = self.choose(workflow)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
+
+    def status(self):
+        return [instance.status() for instance in self.instances]
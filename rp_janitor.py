@@ -0,0 +1,269 @@
+"""
+Disk janitor for ComfyUI's input, output and temp directories.
+
+Delivered outputs are handed to discard_output() and deleted by the janitor's
+background thread, so the handler never waits on the filesystem. The same thread
+periodically sweeps each directory, deletes files older than JANITOR_MAX_AGE_S and
+then the oldest files until the directory is under JANITOR_MAX_DIR_MB. Files younger
+than JANITOR_MIN_AGE_S are never swept so inputs and outputs of jobs still in
+flight survive. With a RAM-backed staging area (rp_staging) the janitor manages the
+staged folders and their spill folders under COMFY_DIR; deleting a spilled file's
+symlink deletes the file on disk too, and links whose file is gone are removed.
+Bytes reclaimed, files deleted, directory sizes and scan time are
+exported as metrics and logged after each sweep.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+
+from rp_metrics import (
+    JANITOR_BYTES_RECLAIMED, JANITOR_FILES_DELETED, JANITOR_DIR_BYTES, JANITOR_SCAN_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds between quota sweeps, 0 disables the janitor
+JANITOR_INTERVAL_S = float(os.getenv("JANITOR_INTERVAL_S", "300"))
+# Size quota per directory, 0 disables the size limit
+JANITOR_MAX_DIR_MB = float(os.getenv("JANITOR_MAX_DIR_MB", "2048"))
+# Files older than this are deleted on the next sweep, 0 disables the age limit
+JANITOR_MAX_AGE_S = float(os.getenv("JANITOR_MAX_AGE_S", "86400"))
+# Files younger than this may belong to a running job and are never swept
+JANITOR_MIN_AGE_S = float(os.getenv("JANITOR_MIN_AGE_S", "600"))
+# Delete outputs as soon as the handler has delivered them
+JANITOR_DELETE_DELIVERED = os.getenv("JANITOR_DELETE_DELIVERED", "true").lower() == "true"
+
+# ComfyUI's folder types, as used in the "type" field of /view and /history
+DEFAULT_DIRS = ("input", "output", "temp")
+
+
+class Janitor:
+    """Deletes delivered outputs and keeps ComfyUI's working directories within quota"""
+
+    def __init__(self, comfy_dir, dirs=DEFAULT_DIRS, interval_s=JANITOR_INTERVAL_S,
+                 max_dir_bytes=JANITOR_MAX_DIR_MB * 1024 * 1024, max_age_s=JANITOR_MAX_AGE_S,
+                 min_age_s=JANITOR_MIN_AGE_S, delete_delivered=JANITOR_DELETE_DELIVERED, roots=None,
+                 on_delete=None):
+        self.comfy_dir = comfy_dir
+        # Directory name -> path, e.g. StagingArea.roots(); defaults to the dirs under comfy_dir
+        self.roots = dict(roots) if roots else {name: os.path.join(comfy_dir, name) for name in dirs}
+        self.dirs = tuple(self.roots)
+        # Called with (path, bytes) for every regular file deleted, e.g. StagingArea.released
+        self.on_delete = on_delete
+        self.interval_s = interval_s
+        self.max_dir_bytes = max_dir_bytes
+        self.max_age_s = max_age_s
+        self.min_age_s = min_age_s
+        self.delete_delivered = delete_delivered
+
+        self._delivered = queue.Queue()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_sweep = None
+
+    def _root(self, folder_type):
+        return os.path.realpath(self.roots[folder_type])
+
+    def _managed(self, path):
+        """Whether a path lies in one of the janitor's directories"""
+        path = os.path.realpath(path)
+        for name in self.dirs:
+            root = self._root(name)
+            if os.path.commonpath([root, path]) == root:
+                return True
+        return False
+
+    def output_path(self, image):
+        """Local path of a ComfyUI image reference, or None if it points outside the managed dirs"""
+        folder_type = image.get("type", "output")
+        if folder_type not in self.dirs or not image.get("filename"):
+            return None
+        root = self._root(folder_type)
+        parent, filename = os.path.split(os.path.join(root, image.get("subfolder") or "", image["filename"]))
+        # The file itself may be a spilled input or output's symlink, which _delete() follows
+        path = os.path.join(os.path.realpath(parent), filename)
+        if not filename or os.path.commonpath([root, path]) != root:
+            return None
+        return path
+
+    # --- delivered outputs -------------------------------------------------
+
+    def discard_output(self, image):
+        """Queue a delivered ComfyUI image ({"filename", "subfolder", "type"}) for deletion"""
+        if not self.delete_delivered or self._thread is None:
+            return
+        path = self.output_path(image)
+        if path:
+            self._delivered.put((image.get("type", "output"), path))
+            self._wake.set()
+
+    def delete_delivered_now(self):
+        """Delete everything queued by discard_output(); returns bytes reclaimed"""
+        reclaimed = 0
+        while True:
+            try:
+                folder_type, path = self._delivered.get_nowait()
+            except queue.Empty:
+                return reclaimed
+            reclaimed += self._delete(folder_type, path, "delivered") or 0
+
+    def _delete(self, folder_type, path, reason, size=None):
+        """Remove one file; returns its size, or None if it could not be deleted"""
+        try:
+            if os.path.islink(path):
+                # A spilled file, whose copy on disk goes with its link
+                target = os.path.realpath(path)
+                if self._managed(target) and os.path.isfile(target):
+                    size = os.path.getsize(target)
+                    os.remove(target)
+                size = size or 0
+                os.remove(path)
+            else:
+                if size is None:
+                    size = os.path.getsize(path)
+                os.remove(path)
+                if self.on_delete:
+                    self.on_delete(path, size)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Janitor could not delete {path}: {str(e)}")
+            return None
+        JANITOR_BYTES_RECLAIMED.inc(size, dir=folder_type, reason=reason)
+        JANITOR_FILES_DELETED.inc(dir=folder_type, reason=reason)
+        return size
+
+    # --- quota sweeps ------------------------------------------------------
+
+    def _scan(self, root):
+        """(mtime, size, path) for every file below root, and the paths of links to deleted files
+
+        Links to spilled files count with size 0, their bytes are in the spill folder.
+        """
+        files = []
+        orphans = []
+        pending = [root]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_symlink():
+                                target = os.path.realpath(entry.path)
+                                if not self._managed(target):
+                                    continue
+                                if not os.path.exists(target):
+                                    orphans.append(entry.path)
+                                    continue
+                                files.append((entry.stat(follow_symlinks=False).st_mtime, 0, entry.path))
+                            elif entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                stat = entry.stat(follow_symlinks=False)
+                                files.append((stat.st_mtime, stat.st_size, entry.path))
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return files, orphans
+
+    def sweep_dir(self, folder_type):
+        """Enforce age and size quotas on one directory; returns (bytes_reclaimed, files_deleted)"""
+        root = self._root(folder_type)
+        if not os.path.isdir(root):
+            return 0, 0
+        with JANITOR_SCAN_SECONDS.time(dir=folder_type):
+            files, orphans = self._scan(root)
+            files.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        reclaimed = deleted = 0
+        for path in orphans:
+            if self._delete(folder_type, path, "orphan", 0) is not None:
+                deleted += 1
+        for mtime, size, path in files:
+            age = now - mtime
+            if age < self.min_age_s:
+                # Sorted oldest first, so everything after this is in flight too
+                break
+            if self.max_age_s and age > self.max_age_s:
+                reason = "age"
+            elif self.max_dir_bytes and total > self.max_dir_bytes:
+                reason = "quota"
+            else:
+                break
+            freed = self._delete(folder_type, path, reason, size)
+            if freed is not None:
+                total -= freed
+                reclaimed += freed
+                deleted += 1
+        JANITOR_DIR_BYTES.set(total, dir=folder_type)
+        if self.max_dir_bytes and total > self.max_dir_bytes:
+            logger.warning(
+                f"Janitor: {root} holds {total / 1024 / 1024:.1f} MB of recent files, over its "
+                f"{self.max_dir_bytes / 1024 / 1024:.1f} MB quota"
+            )
+        return reclaimed, deleted
+
+    def sweep(self):
+        """Delete delivered outputs and enforce quotas on every directory"""
+        started = time.perf_counter()
+        reclaimed = self.delete_delivered_now()
+        deleted = 0
+        for folder_type in self.dirs:
+            dir_reclaimed, dir_deleted = self.sweep_dir(folder_type)
+            reclaimed += dir_reclaimed
+            deleted += dir_deleted
+        self.last_sweep = {
+            "at": time.time(),
+            "duration_s": time.perf_counter() - started,
+            "bytes_reclaimed": reclaimed,
+            "files_deleted": deleted,
+        }
+        if reclaimed:
+            logger.info(
+                f"Janitor reclaimed {reclaimed / 1024 / 1024:.1f} MB in "
+                f"{self.last_sweep['duration_s'] * 1000:.0f} ms"
+            )
+        return self.last_sweep
+
+    # --- background thread -------------------------------------------------
+
+    def _run(self):
+        next_sweep = time.monotonic()
+        while not self._stop.is_set():
+            if time.monotonic() >= next_sweep:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Janitor sweep failed: {str(e)}")
+                next_sweep = time.monotonic() + self.interval_s
+            else:
+                self.delete_delivered_now()
+            self._wake.wait(max(0.0, next_sweep - time.monotonic()))
+            self._wake.clear()
+        self.delete_delivered_now()
+
+    def start(self):
+        """Run the janitor in a daemon thread; no-op when JANITOR_INTERVAL_S is 0"""
+        if not self.interval_s:
+            logger.info("Disk janitor disabled (JANITOR_INTERVAL_S=0)")
+            return self
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="disk-janitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def status(self):
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "delivered_pending": self._delivered.qsize(),
+            "last_sweep": self.last_sweep,
+        }
@@ -0,0 +1,260 @@
+"""
+ComfyUI launch profiles.
+
+The "full" profile starts ComfyUI as before: every custom node package is imported
+and ComfyUI-Manager refreshes its remote lists and runs its security scan on boot.
+The "minimal" profile loads only the custom node packages that define a class_type
+used by the registered workflows (the built-in workflow plus LAUNCH_PROFILE_WORKFLOWS),
+turns ComfyUI-Manager's network access off and adds the performance flags below.
+
+Packages are found by scanning custom_nodes/ for the node class mappings that register
+each class_type, without importing anything. If a class_type can't be resolved to core
+ComfyUI or a package, the profile falls back to loading everything so no job breaks.
+
+Import times printed by every boot are kept in LAUNCH_PROFILE_STATS, which is how a
+minimal boot reports the import time of the packages it skipped.
+"""
+import os
+import re
+import json
+import shlex
+import logging
+import configparser
+
+logger = logging.getLogger(__name__)
+
+# "full" loads every custom node package, "minimal" only those the registered workflows need
+COMFY_LAUNCH_PROFILE = os.getenv("COMFY_LAUNCH_PROFILE", "full").lower()
+# Extra API-format workflows whose nodes the minimal profile must load, separated by os.pathsep
+LAUNCH_PROFILE_WORKFLOWS = [p for p in os.getenv("LAUNCH_PROFILE_WORKFLOWS", "").split(os.pathsep) if p]
+# Custom node packages (folder or file names under custom_nodes/) always loaded by the minimal profile
+LAUNCH_PROFILE_PACKAGES = [p for p in os.getenv("LAUNCH_PROFILE_PACKAGES", "").split(",") if p.strip()]
+# Performance flags of the minimal profile; an empty value leaves ComfyUI's default
+COMFY_PREVIEW_METHOD = os.getenv("COMFY_PREVIEW_METHOD", "none")
+COMFY_VRAM_MODE = os.getenv("COMFY_VRAM_MODE", "")  # gpu-only, highvram, normalvram, lowvram, novram or cpu
+COMFY_DISABLE_METADATA = os.getenv("COMFY_DISABLE_METADATA", "true").lower() == "true"
+# Any other ComfyUI arguments, added in every profile
+COMFY_EXTRA_ARGS = os.getenv("COMFY_EXTRA_ARGS", "")
+# Where import times and boot durations of previous boots are kept
+LAUNCH_PROFILE_STATS = os.getenv("LAUNCH_PROFILE_STATS", "")
+
+PROFILES = ("full", "minimal")
+VRAM_MODES = ("gpu-only", "highvram", "normalvram", "lowvram", "novram", "cpu")
+
+# Loaded when installed whatever the registered workflows use: jobs with output_mode
+# "websocket" need SaveImageWebsocket
+OPTIONAL_CLASS_TYPES = {"SaveImageWebsocket"}
+# Core ComfyUI sources that register built-in nodes
+_CORE_SOURCES = ("nodes.py", "comfy_extras", "comfy_api_nodes")
+_SKIP_DIRS = {".git", "__pycache__", "node_modules", "tests", "test", "web", "js"}
+_IMPORT_TIME = re.compile(r"^\s*([\d.]+) seconds(?: \(IMPORT FAILED\))?: (.+?)\s*$")
+
+
+def required_class_types(workflows):
+    """Every class_type used by the given API-format workflows"""
+    class_types = set()
+    for workflow in workflows:
+        class_types.update(
+            node["class_type"] for node in workflow.values()
+            if isinstance(node, dict) and node.get("class_type")
+        )
+    return class_types
+
+
+def load_workflows(paths):
+    """Load API-format workflows from JSON files, skipping unreadable ones"""
+    workflows = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                workflows.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Launch profile: could not read workflow {path}: {str(e)}")
+    return workflows
+
+
+def _registration_pattern(class_types):
+    names = "|".join(re.escape(name) for name in sorted(class_types))
+    # "Name": Class in NODE_CLASS_MAPPINGS, MAPPINGS["Name"] = Class, or node_id="Name" (v3 schema)
+    return re.compile(
+        rf"""(["'])({names})\1\s*[:\]]|node_id\s*=\s*(["'])({names})\3"""
+    )
+
+
+def _python_files(path):
+    if os.path.isfile(path):
+        if path.endswith(".py"):
+            yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in _SKIP_DIRS and not d.startswith(".")]
+        for name in files:
+            if name.endswith(".py"):
+                yield os.path.join(root, name)
+
+
+def _registered_in(paths, pattern):
+    """Class types the Python files below paths register"""
+    found = set()
+    for path in paths:
+        for py_file in _python_files(path):
+            try:
+                with open(py_file, encoding="utf-8", errors="replace") as f:
+                    source = f.read()
+            except OSError:
+                continue
+            for match in pattern.finditer(source):
+                found.add(match.group(2) or match.group(4))
+    return found
+
+
+def list_packages(comfy_dir):
+    """Custom node packages ComfyUI would try to load, as named under custom_nodes/"""
+    custom_nodes = os.path.join(comfy_dir, "custom_nodes")
+    try:
+        entries = sorted(os.listdir(custom_nodes))
+    except OSError:
+        return []
+    return [
+        name for name in entries
+        if not name.startswith(".") and name != "__pycache__" and not name.endswith(".disabled")
+        and (name.endswith(".py") or os.path.isdir(os.path.join(custom_nodes, name)))
+    ]
+
+
+def resolve_packages(class_types, comfy_dir):
+    """Map class types to custom node packages
+
+    Returns (packages, unresolved class types). Class types registered by core ComfyUI
+    need no package.
+    """
+    pattern = _registration_pattern(class_types)
+    core = _registered_in([os.path.join(comfy_dir, source) for source in _CORE_SOURCES], pattern)
+    pending = set(class_types) - core
+    packages = set()
+    for package in list_packages(comfy_dir):
+        if not pending:
+            break
+        registered = _registered_in([os.path.join(comfy_dir, "custom_nodes", package)], pattern)
+        if registered & pending:
+            packages.add(package)
+            pending -= registered
+    return packages, pending
+
+
+def disable_manager_network(comfy_dir):
+    """Set ComfyUI-Manager's network_mode to offline, keeping its other settings"""
+    candidates = [
+        os.path.join(comfy_dir, "user", "default", "ComfyUI-Manager", "config.ini"),
+        os.path.join(comfy_dir, "user", "__manager", "config.ini"),
+    ]
+    paths = [p for p in candidates if os.path.isdir(os.path.dirname(p))] or candidates[:1]
+    for path in paths:
+        config = configparser.ConfigParser()
+        try:
+            config.read(path)
+            if not config.has_section("default"):
+                config.add_section("default")
+            config.set("default", "network_mode", "offline")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                config.write(f)
+        except (OSError, configparser.Error) as e:
+            logger.warning(f"Launch profile: could not configure ComfyUI-Manager at {path}: {str(e)}")
+
+
+def performance_args():
+    """ComfyUI arguments for the configured performance flags"""
+    args = []
+    if COMFY_PREVIEW_METHOD:
+        args += ["--preview-method", COMFY_PREVIEW_METHOD]
+    if COMFY_VRAM_MODE:
+        if COMFY_VRAM_MODE not in VRAM_MODES:
+            raise ValueError(f"Unknown COMFY_VRAM_MODE {COMFY_VRAM_MODE!r}, expected one of {list(VRAM_MODES)}")
+        args.append(f"--{COMFY_VRAM_MODE}")
+    if COMFY_DISABLE_METADATA:
+        args.append("--disable-metadata")
+    return args
+
+
+def launch_args(comfy_dir, workflows, profile=COMFY_LAUNCH_PROFILE):
+    """Extra ComfyUI arguments for a launch profile
+
+    Returns (args, plan) where plan records the packages loaded and skipped.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown COMFY_LAUNCH_PROFILE {profile!r}, expected one of {list(PROFILES)}")
+    extra = shlex.split(COMFY_EXTRA_ARGS)
+    all_packages = list_packages(comfy_dir)
+    plan = {"profile": profile, "loaded": all_packages, "skipped": []}
+    if profile == "full":
+        return extra, plan
+
+    class_types = required_class_types(workflows + load_workflows(LAUNCH_PROFILE_WORKFLOWS))
+    packages, unresolved = resolve_packages(class_types | OPTIONAL_CLASS_TYPES, comfy_dir)
+    unresolved -= OPTIONAL_CLASS_TYPES
+    if unresolved:
+        logger.warning(
+            f"Launch profile: no custom node package registers {sorted(unresolved)}, loading all packages"
+        )
+        # The same arguments as an explicit full profile, so its boots compare like for like
+        plan["profile"] = "full"
+        return extra, plan
+    packages.update(p.strip() for p in LAUNCH_PROFILE_PACKAGES)
+    disable_manager_network(comfy_dir)
+
+    plan["loaded"] = sorted(packages)
+    plan["skipped"] = [p for p in all_packages if p not in packages]
+    args = ["--disable-all-custom-nodes"] + performance_args() + extra
+    if packages:
+        # Last, because the option takes every following value
+        args += ["--whitelist-custom-nodes"] + sorted(packages)
+    return args, plan
+
+
+def parse_import_times(lines):
+    """{package: seconds} from the prestartup and import time blocks of ComfyUI's output"""
+    times = {}
+    for line in lines:
+        match = _IMPORT_TIME.match(line)
+        if match:
+            package = os.path.basename(match.group(2).rstrip("/"))
+            times[package] = round(times.get(package, 0.0) + float(match.group(1)), 2)
+    return times
+
+
+def _stats_path(comfy_dir):
+    return LAUNCH_PROFILE_STATS or os.path.join(comfy_dir, "user", "launch_profile_stats.json")
+
+
+def record_boot(comfy_dir, plan, boot_s, output_lines):
+    """Store this boot's import times and duration; returns a summary of the time saved"""
+    path = _stats_path(comfy_dir)
+    try:
+        with open(path) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        stats = {}
+    import_times = stats.setdefault("import_times", {})
+    import_times.update(parse_import_times(output_lines))
+    boots = stats.setdefault("boot_s", {})
+    previous_full = boots.get("full")
+    boots[plan["profile"]] = round(boot_s, 2)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+    except OSError as e:
+        logger.warning(f"Launch profile: could not save boot stats to {path}: {str(e)}")
+
+    summary = {
+        "profile": plan["profile"],
+        "boot_s": round(boot_s, 2),
+        "loaded": plan["loaded"],
+        "skipped": plan["skipped"],
+        "skipped_import_s": round(sum(import_times.get(p, 0.0) for p in plan["skipped"]), 2),
+        "unmeasured": [p for p in plan["skipped"] if p not in import_times],
+    }
+    if plan["profile"] == "minimal" and previous_full is not None:
+        summary["saved_s"] = round(previous_full - boot_s, 2)
+    return summary
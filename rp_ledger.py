@@ -0,0 +1,391 @@
+"""
+Persistent per-job ledger in SQLite, for capacity planning.
+
+Every job the handlers process appends one row: which workflow and preset it ran,
+input and output sizes, its stage timings, ComfyUI queue wait and execution time,
+cached nodes and the outcome. The handler thread only puts the finished row on a
+queue; a background thread writes rows in batched transactions, so a slow disk
+(or network volume) never delays a job. When the writer falls behind, rows are
+dropped and counted rather than blocking.
+
+Each worker writes its own file, JOB_LEDGER_DIR/<worker>.sqlite3, so many workers
+can share a directory on /runpod-volume without contending for SQLite's locks.
+
+Jobs are grouped by their "workflow_name" input, "builtin" for the built-in graph,
+or a short hash of the graph's nodes; clients may label jobs with a "preset" too.
+Stages timed on helper threads (such as parallel output downloads) are not split
+out, they count towards the job's total only.
+
+Query one or more ledgers from the command line:
+    python rp_ledger.py /runpod-volume/comfy-ledger/*.sqlite3 --since 24h --by workflow
+    python rp_ledger.py ledger.sqlite3 --since 7d --by preset --bucket 1d
+"""
+import os
+import sys
+import json
+import math
+import time
+import queue
+import atexit
+import socket
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from rp_metrics import LEDGER_ROWS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# Directory of the ledger files; put it on /runpod-volume to keep it across workers, empty disables the ledger
+JOB_LEDGER_DIR = os.getenv("JOB_LEDGER_DIR", "/tmp/comfy-ledger")
+# Rows written per transaction, and the longest a row waits for its batch
+JOB_LEDGER_BATCH_SIZE = int(os.getenv("JOB_LEDGER_BATCH_SIZE", "50"))
+JOB_LEDGER_FLUSH_S = float(os.getenv("JOB_LEDGER_FLUSH_S", "5"))
+# Rows buffered for the writer before new ones are dropped
+JOB_LEDGER_QUEUE_SIZE = int(os.getenv("JOB_LEDGER_QUEUE_SIZE", "10000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    finished_at REAL NOT NULL,
+    worker TEXT,
+    handler TEXT,
+    job_id TEXT,
+    prompt_id TEXT,
+    instance TEXT,
+    workflow TEXT,
+    preset TEXT,
+    input_images INTEGER,
+    input_bytes INTEGER,
+    output_images INTEGER,
+    output_bytes INTEGER,
+    total_s REAL,
+    queue_wait_s REAL,
+    execution_s REAL,
+    cache_hits INTEGER,
+    stages TEXT,
+    outcome TEXT,
+    error_type TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+"""
+_COLUMNS = (
+    "finished_at", "worker", "handler", "job_id", "prompt_id", "instance", "workflow", "preset",
+    "input_images", "input_bytes", "output_images", "output_bytes", "total_s", "queue_wait_s",
+    "execution_s", "cache_hits", "stages", "outcome", "error_type", "error",
+)
+_MAX_ERROR_CHARS = 500
+
+_current = contextvars.ContextVar("ledger_entry", default=None)
+
+
+def worker_name():
+    return os.getenv("RUNPOD_POD_ID") or socket.gethostname()
+
+
+def _decoded_size(data):
+    """Bytes a base64 string decodes to (data URIs included)"""
+    if not isinstance(data, str):
+        return 0
+    data = data.split(",", 1)[1] if data.startswith("data:") else data
+    return max(0, len(data) * 3 // 4 - data[-2:].count("="))
+
+
+def workflow_label(job_input):
+    """Name a job's workflow for grouping"""
+    if not isinstance(job_input, dict):
+        return None
+    if isinstance(job_input.get("workflow_name"), str):
+        return job_input["workflow_name"]
+    workflow = job_input.get("workflow")
+    if workflow is None:
+        return "builtin"
+    if isinstance(workflow, str):
+        try:
+            workflow = json.loads(workflow)
+        except ValueError:
+            return None
+    if not isinstance(workflow, dict):
+        return None
+    # Same nodes and classes hash alike whatever their inputs
+    nodes = sorted((str(node_id), str(node.get("class_type")))
+                   for node_id, node in workflow.items() if isinstance(node, dict))
+    return "workflow-" + hashlib.sha1(json.dumps(nodes).encode("utf-8")).hexdigest()[:10]
+
+
+class LedgerEntry:
+    """What one job did, filled in while it runs"""
+
+    def __init__(self, handler, job):
+        self.handler = handler
+        self.job = job
+        self.stages = {}
+        self.cache_hits = 0
+        self.fields = {}
+        self.result = None
+        self._started = time.perf_counter()
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = round(self.stages.get(stage, 0.0) + seconds, 4)
+
+    def row(self, exception=None):
+        job_input = self.job.get("input")
+        job_input = job_input if isinstance(job_input, dict) else {}
+        inputs = [job_input.get("image")] + [
+            image.get("image") for image in job_input.get("images") or [] if isinstance(image, dict)
+        ]
+        inputs = [data for data in inputs if isinstance(data, str)]
+        result = self.result if isinstance(self.result, dict) else {}
+        outputs = [image for image in result.get("images") or [] if isinstance(image, dict)]
+        error = str(exception) if exception else result.get("error")
+        if exception:
+            outcome = "exception"
+        elif error:
+            outcome = "error"
+        else:
+            outcome = "success"
+        return {
+            "finished_at": time.time(),
+            "worker": worker_name(),
+            "handler": self.handler,
+            "job_id": self.job.get("id"),
+            "prompt_id": self.fields.get("prompt_id"),
+            "instance": self.fields.get("instance"),
+            "workflow": workflow_label(job_input),
+            "preset": job_input.get("preset") if isinstance(job_input.get("preset"), str) else None,
+            "input_images": len(inputs),
+            "input_bytes": sum(_decoded_size(data) for data in inputs),
+            "output_images": len(outputs),
+            "output_bytes": sum(_decoded_size(image.get("data")) for image in outputs if image.get("type") == "base64"),
+            "total_s": round(time.perf_counter() - self._started, 4),
+            "queue_wait_s": self.stages.get("queue_wait"),
+            "execution_s": self.stages.get("execution"),
+            "cache_hits": self.cache_hits,
+            "stages": json.dumps(self.stages, sort_keys=True),
+            "outcome": outcome,
+            "error_type": self.fields.get("error_type"),
+            "error": str(error)[:_MAX_ERROR_CHARS] if error else None,
+        }
+
+
+def note_stage(stage, seconds):
+    """Add a stage duration to the current job's row"""
+    entry = _current.get()
+    if entry is not None:
+        entry.add_stage(stage, seconds)
+
+
+def note_cache_hits(count):
+    entry = _current.get()
+    if entry is not None:
+        entry.cache_hits += count
+
+
+def note(**fields):
+    """Set prompt_id, instance or error_type on the current job's row; the first error_type sticks"""
+    entry = _current.get()
+    if entry is None:
+        return
+    for name, value in fields.items():
+        if name == "error_type" and entry.fields.get(name):
+            continue
+        entry.fields[name] = value
+
+
+class JobLedger:
+    """Appends job rows to a SQLite file from a background thread"""
+
+    def __init__(self, directory=JOB_LEDGER_DIR, batch_size=JOB_LEDGER_BATCH_SIZE,
+                 flush_s=JOB_LEDGER_FLUSH_S, queue_size=JOB_LEDGER_QUEUE_SIZE):
+        self.path = os.path.join(directory, f"{worker_name()}.sqlite3") if directory else None
+        self.batch_size = batch_size
+        self.flush_s = flush_s
+        self._rows = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    @contextmanager
+    def track(self, handler, job):
+        """Collect the row for the job processed inside the block; set entry.result to its result"""
+        entry = LedgerEntry(handler, job)
+        token = _current.set(entry)
+        try:
+            yield entry
+        except Exception as e:
+            self._append(entry.row(exception=e))
+            raise
+        finally:
+            _current.reset(token)
+        self._append(entry.row())
+
+    def _append(self, row):
+        if self._thread is None:
+            return
+        try:
+            self._rows.put_nowait(row)
+        except queue.Full:
+            LEDGER_ROWS_DROPPED.inc()
+
+    def start(self):
+        if not self.path:
+            logger.info("Job ledger disabled (JOB_LEDGER_DIR is empty)")
+            return self
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with sqlite3.connect(self.path) as conn:
+                conn.executescript(_SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Job ledger disabled, could not open {self.path}: {str(e)}")
+            return self
+        self._thread = threading.Thread(target=self._run, name="job-ledger", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"Recording jobs to {self.path}")
+        return self
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        insert = f"INSERT INTO jobs ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})"
+        while True:
+            batch = [self._rows.get()]
+            # Let the batch fill up for a moment, a lone row waits at most flush_s
+            deadline = time.monotonic() + self.flush_s
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._rows.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            rows = [row for row in batch if row is not None]
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany(insert, [tuple(row[c] for c in _COLUMNS) for row in rows])
+                except sqlite3.Error as e:
+                    LEDGER_ROWS_DROPPED.inc(len(rows))
+                    logger.warning(f"Could not write {len(rows)} job ledger row(s): {str(e)}")
+            if batch[-1] is None:
+                conn.close()
+                return
+
+    def stop(self, timeout=10):
+        """Write out queued rows and stop the writer"""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            # Blocks until the writer makes room, so stopping never loses the queued rows
+            self._rows.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+
+# --- command line report -----------------------------------------------------
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+GROUP_COLUMNS = ("workflow", "preset", "handler", "worker", "instance", "outcome")
+
+
+def parse_duration(text):
+    """Seconds in "90s", "30m", "24h", "7d" or a plain number of seconds"""
+    text = text.strip().lower()
+    if text and text[-1] in _DURATION_UNITS:
+        return float(text[:-1]) * _DURATION_UNITS[text[-1]]
+    return float(text)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile: the smallest value with at least pct percent of values at or below it"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct * len(ordered) / 100.0))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def load_rows(paths, since=None, until=None):
+    """Job rows from one or more ledger files, optionally within [since, until)"""
+    rows = []
+    for path in paths:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows += [dict(row) for row in conn.execute(
+                "SELECT * FROM jobs WHERE finished_at >= ? AND finished_at < ? ORDER BY finished_at",
+                (since or 0, until or float("inf")),
+            )]
+        finally:
+            conn.close()
+    return rows
+
+
+def report(rows, by="workflow", bucket_s=None):
+    """Throughput and latency percentiles per group (and time bucket)"""
+    groups = {}
+    for row in rows:
+        bucket = int(row["finished_at"] // bucket_s * bucket_s) if bucket_s else None
+        groups.setdefault((bucket, row.get(by)), []).append(row)
+
+    summary = []
+    for (bucket, group), group_rows in sorted(groups.items(), key=lambda item: (item[0][0] or 0, str(item[0][1]))):
+        started = min(row["finished_at"] - (row["total_s"] or 0) for row in group_rows)
+        span_s = bucket_s or max(row["finished_at"] for row in group_rows) - started
+        ok = [row for row in group_rows if row["outcome"] == "success"]
+        entry = {
+            by: group,
+            "jobs": len(group_rows),
+            "errors": len(group_rows) - len(ok),
+            "jobs_per_hour": round(len(group_rows) * 3600 / span_s, 1) if span_s > 0 else None,
+            "output_mb": round(sum(row["output_bytes"] or 0 for row in group_rows) / 1e6, 1),
+        }
+        if bucket is not None:
+            entry = {"bucket": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(bucket)), **entry}
+        for field in ("total_s", "queue_wait_s", "execution_s"):
+            values = [row[field] for row in ok if row[field] is not None]
+            for pct in (50, 90, 99):
+                value = percentile(values, pct)
+                entry[f"{field[:-2]}_p{pct}"] = None if value is None else round(value, 2)
+        summary.append(entry)
+    return summary
+
+
+def _format_table(summary):
+    if not summary:
+        return "No jobs in the selected window"
+    columns = list(summary[0])
+    cells = [[("-" if row[c] is None else str(row[c])) for c in columns] for row in summary]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths)).rstrip()]
+    lines += ["  ".join(v.ljust(w) for v, w in zip(r, widths)).rstrip() for r in cells]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput and latency by workflow from job ledgers")
+    parser.add_argument("ledgers", nargs="+", help="Ledger files written by the workers")
+    parser.add_argument("--by", choices=GROUP_COLUMNS, default="workflow", help="Group jobs by this column")
+    parser.add_argument("--since", default="24h", help="Window start, as a duration ago (30m, 24h, 7d)")
+    parser.add_argument("--until", help="Window end, as a duration ago (default: now)")
+    parser.add_argument("--bucket", help="Also split the window into buckets of this duration (1h, 1d)")
+    parser.add_argument("--json", action="store_true", help="Print JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    now = time.time()
+    rows = load_rows(
+        args.ledgers,
+        since=now - parse_duration(args.since),
+        until=now - parse_duration(args.until) if args.until else None,
+    )
+    summary = report(rows, by=args.by, bucket_s=parse_duration(args.bucket) if args.bucket else None)
+    print(json.dumps(summary, indent=2) if args.json else _format_table(summary))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
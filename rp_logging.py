@@ -0,0 +1,167 @@
+"""
+Non-blocking, structured logging for the handlers.
+
+configure_logging() replaces the root handlers with a QueueHandler: the thread that
+logs only puts the record on a bounded queue, and a background QueueListener formats
+it (JSON by default) and writes it to stdout. When the writer falls behind, records
+are dropped and counted instead of stalling the job.
+
+Records carry the job_id and prompt_id of the job being processed (job_context()
+and set_prompt_id()). DEBUG records are kept for every job when LOG_LEVEL=DEBUG and
+otherwise for a LOG_DEBUG_SAMPLE_RATE fraction of jobs, so verbose per-job logs stay
+available without paying for them on every job.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+
+from rp_metrics import LOG_RECORDS_DROPPED
+
+# Minimum level written for every job
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" writes one object per line, "text" a human readable line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Fraction of jobs whose DEBUG records are written even though LOG_LEVEL is higher
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+# Records buffered for the writer thread before new ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+_job_id = contextvars.ContextVar("log_job_id", default=None)
+_prompt_id = contextvars.ContextVar("log_prompt_id", default=None)
+_debug_sampled = contextvars.ContextVar("log_debug_sampled", default=False)
+
+_listener = None
+
+
+@contextmanager
+def job_context(job_id):
+    """Tag records logged inside the block with job_id and decide whether its DEBUG records are kept"""
+    tokens = (
+        _job_id.set(job_id),
+        _prompt_id.set(None),
+        _debug_sampled.set(random.random() < LOG_DEBUG_SAMPLE_RATE),
+    )
+    try:
+        yield
+    finally:
+        for var, token in zip((_job_id, _prompt_id, _debug_sampled), tokens):
+            var.reset(token)
+
+
+def set_prompt_id(prompt_id):
+    """Tag the current job's remaining records with its ComfyUI prompt_id"""
+    _prompt_id.set(prompt_id)
+
+
+class _ContextFilter(logging.Filter):
+    """Runs in the logging thread: drops unsampled DEBUG records and captures the job context"""
+
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        if record.levelno < self.level and not _debug_sampled.get():
+            return False
+        record.job_id = _job_id.get()
+        record.prompt_id = _prompt_id.get()
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the arguments here; formatting happens on the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(level=record.levelname)
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Blocks until the writer makes room, so stopping never loses the queued records
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record with the job context as fields"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in ("job_id", "prompt_id"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s%(context)s - %(message)s")
+
+    def format(self, record):
+        ids = [str(value) for value in (getattr(record, "job_id", None), getattr(record, "prompt_id", None)) if value]
+        record.context = f" [{' '.join(ids)}]" if ids else ""
+        return super().format(record)
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Route all logging through the background writer; safe to call more than once"""
+    global _listener
+    if _listener is not None:
+        return
+    level = logging.getLevelName(level) if isinstance(level, str) else level
+    if not isinstance(level, int):
+        level = logging.INFO
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else _TextFormatter())
+    records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = _NonBlockingQueueHandler(records)
+    handler.addFilter(_ContextFilter(level))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    # DEBUG records must reach the filter for sampled jobs
+    root.setLevel(logging.DEBUG if LOG_DEBUG_SAMPLE_RATE > 0 else level)
+    # ...but connection-level chatter from HTTP clients is not worth sampling
+    for name in ("urllib3", "websocket"):
+        logging.getLogger(name).setLevel(max(level, logging.INFO))
+
+    _listener = _Listener(records, stream)
+    _listener.start()
+    atexit.register(flush_logging)
+
+
+def flush_logging():
+    """Write out everything still queued and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
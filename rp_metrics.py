@@ -0,0 +1,351 @@
+"""
+Prometheus-style metrics for the ComfyUI worker.
+
+Stage timings, error counters, cache hits and ComfyUI queue gauges are collected
+in-process by the handlers and served in the Prometheus text exposition format
+from a small HTTP endpoint running inside the worker (default port 9100).
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Port for the /metrics endpoint, set METRICS_PORT=0 to disable it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+# Bucket bounds (seconds) cover everything from a base64 decode to a 40-step sample
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.extend(f'{n}="{_escape_label(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Base class holding one value per label combination"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                f"{self.name} expects labels {self.label_names}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        for sample_name, key, extra, value in self._samples():
+            lines.append(
+                f"{sample_name}{_format_labels(self.label_names, key, extra)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Cumulative histogram with fixed bucket bounds"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return sum(state["counts"]) if state else 0
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, state["counts"]):
+                    cumulative += count
+                    samples.append(
+                        (f"{self.name}_bucket", key, [("le", _format_value(bound))], cumulative)
+                    )
+                samples.append((f"{self.name}_sum", key, None, state["sum"]))
+                samples.append((f"{self.name}_count", key, None, cumulative))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Worker metrics shared by rp_handler.py and handlerCOMEXAMPLE.py ---
+STAGE_SECONDS = Histogram(
+    "comfy_worker_stage_seconds",
+    "Time spent in each handler stage",
+    ["handler", "stage"],
+)
+JOBS = Counter(
+    "comfy_worker_jobs_total",
+    "Jobs processed by the handler, by outcome",
+    ["handler", "outcome"],
+)
+ERRORS = Counter(
+    "comfy_worker_errors_total",
+    "Errors returned by the handler, by type",
+    ["handler", "type"],
+)
+CACHE_HITS = Counter(
+    "comfy_worker_cache_hits_total",
+    "Cache hits, e.g. workflow nodes ComfyUI served from its execution cache",
+    ["handler", "cache"],
+)
+COMFYUI_RESTARTS = Counter(
+    "comfy_worker_comfyui_restarts_total",
+    "Times the supervised ComfyUI process was restarted after exiting",
+)
+QUEUE_DEPTH = Gauge(
+    "comfy_worker_comfyui_queue_depth",
+    "Last observed ComfyUI queue depth (running, pending or remaining)",
+    ["state"],
+)
+
+PROMPT_ABORTS = Counter(
+    "comfy_worker_prompt_aborts_total",
+    "Prompts removed from ComfyUI after a deadline or cancellation, by action (failed: ComfyUI unreachable)",
+    ["action"],
+)
+ADMISSION_ESTIMATED_WAIT = Gauge(
+    "comfy_worker_admission_estimated_wait_seconds",
+    "Estimated ComfyUI queue wait for a newly admitted job",
+)
+ADMISSION_OPEN = Gauge(
+    "comfy_worker_admission_open",
+    "1 while the worker is pulling jobs, 0 while intake is paused by backpressure",
+)
+JANITOR_BYTES_RECLAIMED = Counter(
+    "comfy_worker_janitor_reclaimed_bytes_total",
+    "Bytes deleted from ComfyUI's directories by the disk janitor",
+    ["dir", "reason"],
+)
+JANITOR_FILES_DELETED = Counter(
+    "comfy_worker_janitor_deleted_files_total",
+    "Files deleted from ComfyUI's directories by the disk janitor",
+    ["dir", "reason"],
+)
+JANITOR_DIR_BYTES = Gauge(
+    "comfy_worker_janitor_dir_bytes",
+    "Size of each ComfyUI directory after the last janitor sweep",
+    ["dir"],
+)
+JANITOR_SCAN_SECONDS = Histogram(
+    "comfy_worker_janitor_scan_seconds",
+    "Time the disk janitor spent scanning each directory",
+    ["dir"],
+)
+WORKFLOW_NODES_REMOVED = Counter(
+    "comfy_worker_workflow_nodes_removed_total",
+    "Nodes the workflow optimizer bypassed or pruned before queueing",
+    ["handler", "action"],
+)
+INSTANCE_JOBS = Counter(
+    "comfy_worker_instance_jobs_total",
+    "Jobs routed to each ComfyUI instance",
+    ["instance"],
+)
+LOG_RECORDS_DROPPED = Counter(
+    "comfy_worker_log_records_dropped_total",
+    "Log records dropped because the background log writer fell behind",
+    ["level"],
+)
+SCHEDULER_WAITING = Gauge(
+    "comfy_worker_scheduler_waiting_jobs",
+    "Jobs held back by the prompt scheduler until ComfyUI's queue drains",
+)
+LEDGER_ROWS_DROPPED = Counter(
+    "comfy_worker_ledger_rows_dropped_total",
+    "Job ledger rows dropped because the writer fell behind or SQLite failed",
+)
+COMFYUI_MEMORY_BYTES = Gauge(
+    "comfy_worker_comfyui_memory_bytes",
+    "VRAM and RAM of each ComfyUI server from its last /system_stats poll",
+    ["host", "kind"],
+)
+MODEL_SWAPS = Counter(
+    "comfy_worker_model_swaps_total",
+    "Times the residency manager unloaded ComfyUI's models to load another workflow, by that workflow",
+    ["workflow"],
+)
+MODEL_SWAP_SECONDS = Histogram(
+    "comfy_worker_model_swap_seconds",
+    "Time of the /free call of a model swap and of the first prompt run after it",
+    ["phase"],
+)
+WORKER_REFRESHES = Counter(
+    "comfy_worker_refreshes_total",
+    "Worker refreshes requested from RunPod by the refresh policy, by reason",
+    ["reason"],
+)
+STAGING_SPILLS = Counter(
+    "comfy_worker_staging_spills_total",
+    "Files moved or written to disk because the RAM-backed staging area was full, by folder and how",
+    ["dir", "reason"],
+)
+
+
+@contextmanager
+def stage_timer(handler, stage):
+    """Time a handler stage into comfy_worker_stage_seconds"""
+    with STAGE_SECONDS.time(handler=handler, stage=stage):
+        yield
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would otherwise flood the worker logs
+        pass
+
+
+def start_metrics_server(port=None, host=None, registry=None):
+    """Serve the registry on http://host:port/metrics from a daemon thread"""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        logger.info("Metrics endpoint disabled (METRICS_PORT=0)")
+        return None
+    handler_class = type(
+        "MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": registry or REGISTRY}
+    )
+    try:
+        server = ThreadingHTTPServer((host or METRICS_HOST, port), handler_class)
+    except OSError as e:
+        logger.warning(f"Could not start metrics endpoint on port {port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on http://{host or METRICS_HOST}:{server.server_port}/metrics")
+    return server
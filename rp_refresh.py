@@ -0,0 +1,178 @@
+"""
+Per-job decision whether RunPod should refresh (restart) the worker.
+
+Returning refresh_worker from a job makes RunPod tear the worker down after it and
+pay a cold start for the next job, which used to be all or nothing via
+REFRESH_WORKER. The default is still never. With REFRESH_WORKER=auto, which is
+opt-in, RefreshPolicy looks at measured signals after every job and only
+refreshes once the worker is degrading:
+
+- REFRESH_MAX_ERROR_STREAK consecutive jobs failed on the worker's side (errors
+  caused by the job's own input, deadlines and cancellations don't count)
+- a job failed with an out-of-memory error
+- the handler's RSS grew by more than REFRESH_MAX_RSS_GROWTH_MB since its first job
+- ComfyUI reported less than REFRESH_MIN_RAM_FREE_MB RAM or REFRESH_MIN_VRAM_FREE_MB
+  VRAM free in the health monitor's last /system_stats snapshot (rp_health)
+- the worker ran REFRESH_MAX_JOBS jobs
+
+A threshold of 0 disables that signal. Other jobs may still be in flight when the
+policy trips, so it only closes admission then and the last of them to finish
+returns refresh_worker. With REFRESH_WORKER=always that would let a prefetched job
+(ADMISSION_PREFETCH, rp_admission) run on the used worker and halve the refreshes,
+so the handlers turn prefetch off in that mode (see exclusive).
+"""
+import os
+import logging
+import threading
+
+from rp_metrics import WORKER_REFRESHES
+
+logger = logging.getLogger(__name__)
+
+# never, always or auto; "true" and "false" keep their old meaning of always and never
+REFRESH_WORKER = os.getenv("REFRESH_WORKER", "never").lower()
+# Consecutive worker-side job failures that trigger a refresh
+REFRESH_MAX_ERROR_STREAK = int(os.getenv("REFRESH_MAX_ERROR_STREAK", "5"))
+# Refresh after a job fails with an out-of-memory error
+REFRESH_ON_OOM = os.getenv("REFRESH_ON_OOM", "true").lower() == "true"
+# Growth of the handler's resident memory since its first job that triggers a refresh
+REFRESH_MAX_RSS_GROWTH_MB = float(os.getenv("REFRESH_MAX_RSS_GROWTH_MB", "4096"))
+# ComfyUI free RAM and VRAM below which the worker is refreshed. ComfyUI keeps models
+# resident in VRAM, so low free VRAM alone is normal and that check is off by default
+REFRESH_MIN_RAM_FREE_MB = float(os.getenv("REFRESH_MIN_RAM_FREE_MB", "512"))
+REFRESH_MIN_VRAM_FREE_MB = float(os.getenv("REFRESH_MIN_VRAM_FREE_MB", "0"))
+# Refresh after this many jobs regardless of the other signals
+REFRESH_MAX_JOBS = int(os.getenv("REFRESH_MAX_JOBS", "0"))
+
+_MODES = {"true": "always", "false": "never", "always": "always", "never": "never", "auto": "auto"}
+# Error types caused by the job itself rather than by the worker
+CLIENT_ERROR_TYPES = {
+    "validation", "input_image", "input_upload", "missing_nodes", "value", "no_output",
+    "deadline", "cancelled",
+}
+_MB = 1024 * 1024
+
+
+def handler_rss_bytes():
+    """Resident memory of this process, None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _is_oom(result):
+    """Whether a failed result reports an out-of-memory error, in its message or its details"""
+    if not isinstance(result, dict):
+        return False
+    error = " ".join(str(result.get(key, "")) for key in ("error", "details", "errors"))
+    # Matches both "CUDA out of memory" and torch's OutOfMemoryError
+    return "outofmemory" in error.lower().replace(" ", "")
+
+
+class RefreshPolicy:
+    """Tracks job outcomes and worker resources and decides when the worker needs a refresh"""
+
+    def __init__(self, mode=REFRESH_WORKER, monitor=None, max_error_streak=REFRESH_MAX_ERROR_STREAK,
+                 on_oom=REFRESH_ON_OOM, max_rss_growth_mb=REFRESH_MAX_RSS_GROWTH_MB,
+                 min_ram_free_mb=REFRESH_MIN_RAM_FREE_MB, min_vram_free_mb=REFRESH_MIN_VRAM_FREE_MB,
+                 max_jobs=REFRESH_MAX_JOBS):
+        if mode not in _MODES:
+            logger.warning(f"Unknown REFRESH_WORKER {mode!r}, using never")
+        self.mode = _MODES.get(mode, "never")
+        # rp_health.HealthMonitor whose snapshots supply ComfyUI's free RAM and VRAM
+        self.monitor = monitor
+        self.max_error_streak = max_error_streak
+        self.on_oom = on_oom
+        self.max_rss_growth_mb = max_rss_growth_mb
+        self.min_ram_free_mb = min_ram_free_mb
+        self.min_vram_free_mb = min_vram_free_mb
+        self.max_jobs = max_jobs
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._jobs = 0
+        self._error_streak = 0
+        self._baseline_rss = None
+        self._rss = None
+        self._pending = None
+
+    @property
+    def exclusive(self):
+        """Whether every job must have the worker to itself, i.e. refresh after each one"""
+        return self.mode == "always"
+
+    def pending_reason(self):
+        """Why the worker is waiting to be refreshed, None while it isn't"""
+        return self._pending
+
+    def job_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def job_finished(self, result, error_type=None):
+        """Record a finished job; returns the refresh reason if this job should return refresh_worker"""
+        rss = handler_rss_bytes()
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._jobs += 1
+            failed = not isinstance(result, dict) or "error" in result
+            if not failed:
+                self._error_streak = 0
+            elif error_type not in CLIENT_ERROR_TYPES:
+                self._error_streak += 1
+            self._rss = rss
+            if self._baseline_rss is None:
+                self._baseline_rss = rss
+
+            if self._pending is None:
+                reason = self._reason(result if failed else None)
+                if reason:
+                    self._pending = reason
+                    WORKER_REFRESHES.inc(reason=reason.split(":", 1)[0])
+                    if self._in_flight:
+                        logger.warning(f"Worker needs a refresh ({reason}); draining {self._in_flight} job(s) first")
+            if self._pending and not self._in_flight:
+                logger.warning(f"Requesting a worker refresh after this job: {self._pending}")
+                return self._pending
+            return None
+
+    def _reason(self, failed_result):
+        if self.mode == "never":
+            return None
+        if self.mode == "always":
+            return "always"
+        if self.max_error_streak and self._error_streak >= self.max_error_streak:
+            return f"error_streak: {self._error_streak} consecutive failed jobs"
+        if self.on_oom and failed_result is not None and _is_oom(failed_result):
+            return "oom: the job ran out of memory"
+        if self.max_rss_growth_mb and self._rss and self._baseline_rss:
+            growth_mb = (self._rss - self._baseline_rss) / _MB
+            if growth_mb > self.max_rss_growth_mb:
+                return f"rss_growth: handler RSS grew {growth_mb:.0f} MB"
+        for host in self.monitor.hosts if self.monitor else []:
+            snapshot = self.monitor.snapshot(host) or {}
+            if not snapshot.get("reachable"):
+                continue
+            for kind, threshold in (("ram_free", self.min_ram_free_mb), ("vram_free", self.min_vram_free_mb)):
+                free = snapshot.get(kind)
+                if threshold and free is not None and free / _MB < threshold:
+                    return f"{kind}: ComfyUI at {host} has {free / _MB:.0f} MB free"
+        if self.max_jobs and self._jobs >= self.max_jobs:
+            return f"max_jobs: {self._jobs} jobs processed"
+        return None
+
+    def status(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "jobs": self._jobs,
+                "in_flight": self._in_flight,
+                "error_streak": self._error_streak,
+                "handler_rss_mb": round(self._rss / _MB, 1) if self._rss else None,
+                "handler_rss_growth_mb": (
+                    round((self._rss - self._baseline_rss) / _MB, 1) if self._rss and self._baseline_rss else None
+                ),
+                "pending_refresh": self._pending,
+            }
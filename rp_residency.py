@@ -0,0 +1,299 @@
+"""
+Model residency across the workflows a worker serves.
+
+When jobs alternate between workflows whose models don't fit on the GPU together
+(Blur and Tile, or two ControlNet variants), ComfyUI evicts and reloads models
+piecemeal on every switch and may fall back to partially offloaded execution.
+ResidencyManager knows the model set of every registered workflow (the built-in
+one plus LAUNCH_PROFILE_WORKFLOWS) and of every workflow it has seen since, sized
+from the model files under COMFY_DIR/models, and tracks which set each ComfyUI
+server holds:
+
+- a job whose models are already resident, or fit next to the resident ones, runs
+  as is
+- otherwise the manager POSTs /free with unload_models before queueing it, so the
+  new set loads onto an empty card. ComfyUI unloads every model in that case (it has
+  no per-model unload), but keeps them in RAM, so a later swap back reloads from RAM
+- the prompt scheduler (rp_scheduler) asks swap_rank() when it picks the next
+  waiting job: among equal priorities, jobs for the resident set go first, and jobs
+  whose swap would evict a pinned set go last. Sets are pinned while they are the
+  hottest ones that fit the budget, by job count with a half-life of
+  RESIDENCY_HOT_HALF_LIFE_S. Scheduler aging still bounds how long a cold job waits
+
+The VRAM budget is RESIDENCY_VRAM_BUDGET_MB or, when that is 0, the device total
+from the health monitor (rp_health) minus RESIDENCY_VRAM_HEADROOM_MB for
+activations. Model sizes are their file sizes, a good estimate for the weights.
+"""
+import os
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+
+from rp_instances import workflow_models, MODEL_EXTENSIONS
+from rp_launch_profile import LAUNCH_PROFILE_WORKFLOWS, load_workflows
+from rp_ledger import note_stage
+from rp_metrics import MODEL_SWAPS, MODEL_SWAP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Set to false to leave model eviction entirely to ComfyUI
+RESIDENCY_MANAGER = os.getenv("RESIDENCY_MANAGER", "true").lower() == "true"
+# VRAM the resident models may use; 0 derives it from the device's total VRAM
+RESIDENCY_VRAM_BUDGET_MB = float(os.getenv("RESIDENCY_VRAM_BUDGET_MB", "0"))
+# VRAM kept free for activations, VAE decoding and upscaling when deriving the budget
+RESIDENCY_VRAM_HEADROOM_MB = float(os.getenv("RESIDENCY_VRAM_HEADROOM_MB", "4096"))
+# Seconds after which a workflow's past jobs count half towards its hotness
+RESIDENCY_HOT_HALF_LIFE_S = float(os.getenv("RESIDENCY_HOT_HALF_LIFE_S", "600"))
+# os.pathsep-separated model folders to size models from; defaults to COMFY_DIR/models
+RESIDENCY_MODEL_DIRS = [p for p in os.getenv("RESIDENCY_MODEL_DIRS", "").split(os.pathsep) if p]
+
+_MB = 1024 * 1024
+# A missed lookup rescans the model folders at most this often, for models added at runtime
+_RESCAN_S = 60
+
+
+class ModelSizes:
+    """Sizes of the model files under a set of folders, by path relative to their model type folder and by name"""
+
+    def __init__(self, model_dirs):
+        self.model_dirs = list(model_dirs)
+        self._sizes = None
+        self._scanned_at = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        sizes = {}
+        for root_dir in self.model_dirs:
+            for dirpath, _, filenames in os.walk(root_dir, followlinks=True):
+                relative = os.path.relpath(dirpath, root_dir).split(os.sep)
+                for filename in filenames:
+                    try:
+                        size = os.path.getsize(os.path.join(dirpath, filename))
+                    except OSError:
+                        continue
+                    # Workflows name models relative to their type folder, e.g. "flux/ae.safetensors"
+                    sizes.setdefault("/".join(relative[1:] + [filename]), size)
+                    sizes.setdefault(filename, size)
+        self._sizes = sizes
+        self._scanned_at = time.monotonic()
+
+    def size(self, name):
+        """Bytes of the named model file, None if it isn't one"""
+        name = name.replace("\\", "/")
+        # Loader options such as "flux.1" or "bfloat16" are never files, don't scan for them
+        if not name.lower().endswith(MODEL_EXTENSIONS):
+            return None
+        with self._lock:
+            if self._sizes is None:
+                self._scan()
+            size = self._sizes.get(name)
+            if size is None and time.monotonic() - self._scanned_at >= _RESCAN_S:
+                self._scan()
+                size = self._sizes.get(name)
+            return size
+
+
+class _ServerState:
+    def __init__(self):
+        # model -> bytes, least recently used first
+        self.resident = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+        self.swaps = 0
+        self.free_seconds = 0.0
+        self.swap_pending = False
+        self.last_swap = None
+
+    def resident_bytes(self, extra=()):
+        return sum(self.resident.values()) + sum(size for model, size in extra if model not in self.resident)
+
+
+class ResidencyManager:
+    """Tracks the models each ComfyUI server holds and frees them only when a job's set doesn't fit"""
+
+    def __init__(self, model_dirs, monitor=None, enabled=RESIDENCY_MANAGER, budget_mb=RESIDENCY_VRAM_BUDGET_MB,
+                 headroom_mb=RESIDENCY_VRAM_HEADROOM_MB, half_life_s=RESIDENCY_HOT_HALF_LIFE_S):
+        self.sizes = ModelSizes(model_dirs)
+        # rp_health.HealthMonitor whose snapshots supply each device's total VRAM
+        self.monitor = monitor
+        self.enabled = enabled
+        self.budget_mb = budget_mb
+        self.headroom_mb = headroom_mb
+        self.half_life_s = half_life_s
+        self._lock = threading.Lock()
+        self._registered = {}
+        # model set -> (hotness, monotonic time it was last updated)
+        self._heat = {}
+        self._servers = {}
+
+    # --- model sets --------------------------------------------------------
+
+    def models(self, workflow):
+        """The workflow's model files with their sizes, as a frozenset of (name, bytes)"""
+        if not isinstance(workflow, dict):
+            return frozenset()
+        sized = ((model, self.sizes.size(model)) for model in workflow_models(workflow))
+        return frozenset((model, size) for model, size in sized if size is not None)
+
+    def register(self, name, workflow):
+        models = self.models(workflow)
+        self._registered[models] = name
+        logger.info(f"Residency: workflow {name} needs {len(models)} model(s), {self._mb(models):.0f} MB")
+
+    def register_launch_workflows(self):
+        """Register the LAUNCH_PROFILE_WORKFLOWS files under their file names"""
+        for path in LAUNCH_PROFILE_WORKFLOWS:
+            for workflow in load_workflows([path]):
+                self.register(os.path.splitext(os.path.basename(path))[0], workflow)
+
+    def workflow_name(self, models):
+        """The registered workflow with this model set, or the smallest one containing it (optimized
+        jobs may skip some of their workflow's models)"""
+        if models in self._registered:
+            return self._registered[models]
+        containing = [registered for registered in self._registered if models <= registered]
+        return self._registered[min(containing, key=len)] if containing else "other"
+
+    @staticmethod
+    def _mb(models):
+        return sum(size for _, size in models) / _MB
+
+    def demand(self, workflow):
+        """Count a job for the workflow towards its hotness; returns its model set for swap_rank() and prepare()
+
+        The only call per job that sizes models, so it runs before the job waits on the scheduler.
+        """
+        models = self.models(workflow)
+        if models:
+            now = time.monotonic()
+            with self._lock:
+                heat, updated = self._heat.get(models, (0.0, now))
+                self._heat[models] = (self._decayed(heat, updated, now) + 1.0, now)
+        return models
+
+    def _decayed(self, heat, updated, now):
+        if self.half_life_s <= 0:
+            return heat
+        return heat * math.pow(0.5, (now - updated) / self.half_life_s)
+
+    # --- budget and pinning ------------------------------------------------
+
+    def budget_bytes(self, host):
+        if self.budget_mb > 0:
+            return self.budget_mb * _MB
+        snapshot = self.monitor.snapshot(host) if self.monitor else None
+        if not snapshot or not snapshot.get("vram_total"):
+            return None
+        return max(0.0, snapshot["vram_total"] - self.headroom_mb * _MB)
+
+    def _pinned(self, budget):
+        """Models of the hottest sets that fit the budget together"""
+        now = time.monotonic()
+        ranked = sorted(self._heat.items(), key=lambda item: -self._decayed(item[1][0], item[1][1], now))
+        pinned = {}
+        for models, _ in ranked:
+            candidate = {**pinned, **dict(models)}
+            if sum(candidate.values()) > budget:
+                break
+            pinned = candidate
+        return pinned
+
+    def _server(self, host):
+        return self._servers.setdefault(host, _ServerState())
+
+    def swap_rank(self, host, models):
+        """0 if the models are resident or fit, 1 if they need a swap, 2 if that swap evicts a pinned set
+
+        Called under the scheduler's lock with demand()'s model set, so it never touches the filesystem.
+        """
+        if not self.enabled or not models:
+            return 0
+        budget = self.budget_bytes(host)
+        with self._lock:
+            state = self._server(host)
+            if budget is None or state.resident_bytes(models) <= budget:
+                return 0
+            pinned = self._pinned(budget)
+            names = {model for model, _ in models}
+            evicts_pinned = any(model in pinned and model not in names for model in state.resident)
+            return 2 if evicts_pinned else 1
+
+    # --- per prompt --------------------------------------------------------
+
+    def prepare(self, host, models):
+        """Make room for demand()'s model set before it's queued; returns "hit", "load", "swap" or None"""
+        if not self.enabled or not models:
+            return None
+        budget = self.budget_bytes(host)
+        with self._lock:
+            state = self._server(host)
+            names = {model for model, _ in models}
+            if names.issubset(state.resident):
+                outcome = "hit"
+                state.hits += 1
+            elif budget is None or state.resident_bytes(models) <= budget:
+                outcome = "load"
+                state.loads += 1
+            else:
+                outcome = "swap"
+                state.swaps += 1
+                evicted = [model for model in state.resident if model not in names]
+                state.resident.clear()
+                state.swap_pending = True
+            for model, size in models:
+                state.resident.pop(model, None)
+                state.resident[model] = size
+        if outcome != "swap":
+            return outcome
+
+        name = self.workflow_name(models)
+        started = time.perf_counter()
+        try:
+            # Taken up by ComfyUI before it starts the next prompt
+            response = requests.post(f"http://{host}/free", json={"unload_models": True}, timeout=10)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"Residency: could not free models on {host}, ComfyUI will evict on its own: {str(e)}")
+        free_s = time.perf_counter() - started
+        MODEL_SWAPS.inc(workflow=name)
+        MODEL_SWAP_SECONDS.observe(free_s, phase="free")
+        note_stage("model_free", free_s)
+        with self._lock:
+            state.free_seconds += free_s
+            state.last_swap = {"at": time.time(), "workflow": name, "evicted": evicted}
+        logger.info(
+            f"Residency: swapping to workflow {name} on {host}, unloading {len(evicted)} model(s) "
+            f"({self._mb(models):.0f} MB needed, budget {budget / _MB:.0f} MB)"
+        )
+        return outcome
+
+    def record_execution(self, host, seconds):
+        """Execution time of the server's last prompt; the first one after a swap includes reloading"""
+        with self._lock:
+            state = self._servers.get(host)
+            if not state or not state.swap_pending:
+                return
+            state.swap_pending = False
+        MODEL_SWAP_SECONDS.observe(seconds, phase="first_run")
+
+    def status(self):
+        servers = {}
+        with self._lock:
+            for host, state in self._servers.items():
+                budget = self.budget_bytes(host)
+                servers[host] = {
+                    "budget_mb": round(budget / _MB) if budget is not None else None,
+                    "resident_mb": round(state.resident_bytes() / _MB),
+                    "resident_models": list(state.resident),
+                    "pinned_models": sorted(self._pinned(budget)) if budget is not None else [],
+                    "hits": state.hits,
+                    "loads": state.loads,
+                    "swaps": state.swaps,
+                    "free_seconds": round(state.free_seconds, 3),
+                    "last_swap": state.last_swap,
+                }
+        return {"enabled": self.enabled, "workflows": sorted(self._registered.values()), "servers": servers}
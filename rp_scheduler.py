@@ -0,0 +1,234 @@
+"""
+Priority and cost-aware ordering of the prompts a worker sends to ComfyUI.
+
+ComfyUI runs prompts in the order they were queued, so with several jobs in flight a
+40-step quality job queued first holds up every cheap job behind it. Jobs therefore
+ask PromptScheduler for a turn before they POST /prompt. At most
+SCHEDULER_TARGET_DEPTH prompts per ComfyUI server are queued at once; everything else
+waits here, and whenever a prompt finishes the best waiting job goes next: the highest
+priority first, then the lowest estimated cost, then the earliest arrival.
+
+Waiting raises a job's priority by one level every SCHEDULER_AGING_S, so a steady
+stream of cheap or high-priority jobs can't starve the others. Given a swap_rank
+(see rp_residency), jobs whose models are already on the server go ahead of equally
+prioritized jobs that would make ComfyUI swap models, so work is batched by workflow.
+
+With SCHEDULER_EARLY_RELEASE a turn ends as soon as the running prompt starts its
+tail, the nodes that come after its last sampler (VAE decode, upscale, save), as the
+handler reports through node_started(). The next job, already validated and staged,
+is then waiting in ComfyUI's queue when the GPU frees up instead of being queued
+after the handler notices the previous prompt finished.
+
+The cost estimate only needs to rank jobs, so it is in sampling steps times output
+megapixels, with model upscales counted as UPSCALE_STEP_EQUIVALENT steps per megapixel
+they produce.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+
+from rp_metrics import SCHEDULER_WAITING
+
+logger = logging.getLogger(__name__)
+
+# Prompts queued in each ComfyUI server at once; 0 disables the scheduler. A value of 2
+# keeps the next prompt queued behind the running one at the cost of ordering it early
+SCHEDULER_TARGET_DEPTH = int(os.getenv("SCHEDULER_TARGET_DEPTH", "1"))
+# Seconds of waiting worth one priority level
+SCHEDULER_AGING_S = float(os.getenv("SCHEDULER_AGING_S", "30"))
+# Let the next prompt into ComfyUI's queue once the running one reaches the nodes after its last sampler
+SCHEDULER_EARLY_RELEASE = os.getenv("SCHEDULER_EARLY_RELEASE", "true").lower() == "true"
+
+# Named priorities a job can pass as its "priority" input, besides plain integers
+PRIORITIES = {"low": -1, "normal": 0, "high": 1}
+
+# Ballpark cost of a model upscale, in sampling steps per output megapixel
+UPSCALE_STEP_EQUIVALENT = 10
+# Assumed when the workflow doesn't say
+_DEFAULT_STEPS = 20
+_DEFAULT_MEGAPIXELS = 1.0
+_UPSCALE_CLASS_TYPES = {"UpscaleImageByUsingModel", "ImageUpscaleWithModel"}
+_SAMPLER_CLASS_TYPES = {"KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced"}
+# How often waiting jobs look at their deadline
+_DEADLINE_CHECK_S = 0.25
+
+
+def job_priority(job_input):
+    """The job's priority as an integer, higher runs first; raises ValueError on bad input"""
+    priority = job_input.get("priority", "normal")
+    if isinstance(priority, str) and priority.lower() in PRIORITIES:
+        return PRIORITIES[priority.lower()]
+    if isinstance(priority, int) and not isinstance(priority, bool):
+        return priority
+    raise ValueError(f"Unknown priority {priority!r}, expected an integer or one of {list(PRIORITIES)}")
+
+
+def _number(inputs, name):
+    value = inputs.get(name)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def estimate_cost(workflow):
+    """Relative cost of a workflow in step-megapixels, used to rank waiting jobs"""
+    steps = 0
+    megapixels = 0.0
+    upscales = []
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs", {})
+        steps += _number(inputs, "steps") or 0
+        width, height = _number(inputs, "width"), _number(inputs, "height")
+        if width and height:
+            # Linked sizes are unknown; the largest literal size stands in for the output
+            batch = _number(inputs, "batch_size") or 1
+            megapixels = max(megapixels, width * height * batch / 1e6)
+        if node.get("class_type") in _UPSCALE_CLASS_TYPES:
+            upscales.append(_number(inputs, "upscale_by") or 4)
+    megapixels = megapixels or _DEFAULT_MEGAPIXELS
+    cost = (steps or _DEFAULT_STEPS) * megapixels
+    for factor in upscales:
+        cost += UPSCALE_STEP_EQUIVALENT * megapixels * factor * factor
+    return round(cost, 2)
+
+
+def _linked(inputs):
+    """Ids of the nodes an input dict links to"""
+    return {
+        str(value[0]) for value in inputs.values()
+        if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+    }
+
+
+def tail_nodes(workflow):
+    """Ids of the nodes that run after the workflow's samplers: downstream of one, upstream of none"""
+    nodes = {node_id: node for node_id, node in workflow.items() if isinstance(node, dict)}
+    parents = {node_id: _linked(node.get("inputs", {})) for node_id, node in nodes.items()}
+    samplers = {node_id for node_id, node in nodes.items() if node.get("class_type") in _SAMPLER_CLASS_TYPES}
+
+    def closure(start, edges):
+        seen, stack = set(), list(start)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in seen:
+                seen.add(node_id)
+                stack.extend(edges.get(node_id, ()))
+        return seen
+
+    children = {}
+    for node_id, linked in parents.items():
+        for parent in linked:
+            children.setdefault(parent, set()).add(node_id)
+    return closure(samplers, children) - closure(samplers, parents)
+
+
+class _Ticket:
+    def __init__(self, key, cost, priority, seq, models=None, tail=None):
+        self.key = key
+        self.cost = cost
+        self.priority = priority
+        self.seq = seq
+        self.models = models
+        self.tail = tail or set()
+        self.arrived = time.monotonic()
+        self.released = False
+
+    def rank(self, now, aging_s, swap=0):
+        aged = self.priority + (int((now - self.arrived) // aging_s) if aging_s > 0 else 0)
+        return (-aged, swap, self.cost, self.seq)
+
+
+class PromptScheduler:
+    """Holds jobs back from ComfyUI and releases them best-first as its queue drains"""
+
+    def __init__(self, target_depth=SCHEDULER_TARGET_DEPTH, aging_s=SCHEDULER_AGING_S, swap_rank=None,
+                 early_release=SCHEDULER_EARLY_RELEASE):
+        self.target_depth = target_depth
+        self.aging_s = aging_s
+        self.early_release = early_release
+        # swap_rank(key, models) -> how disruptive running those models on the server would be, 0 for not at all
+        self.swap_rank = swap_rank
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._active = {}
+        self._seq = itertools.count()
+
+    def waiting(self):
+        """Jobs currently held back"""
+        with self._cond:
+            return len(self._waiting)
+
+    def _rank(self, ticket, now):
+        swap = self.swap_rank(ticket.key, ticket.models) if self.swap_rank and ticket.models else 0
+        return ticket.rank(now, self.aging_s, swap)
+
+    def _next_for(self, key, now):
+        candidates = [ticket for ticket in self._waiting if ticket.key == key]
+        return min(candidates, key=lambda ticket: self._rank(ticket, now)) if candidates else None
+
+    def acquire(self, key, cost, priority=0, deadline=None, models=None, tail=None):
+        """Wait for the job's turn on the server key; returns a ticket, or None if the deadline stopped it
+
+        tail holds the ids of the prompt's tail nodes (see tail_nodes()) for early release.
+        """
+        ticket = _Ticket(key, cost, priority, next(self._seq), models, tail if self.early_release else None)
+        if self.target_depth <= 0:
+            return ticket
+        with self._cond:
+            self._waiting.append(ticket)
+            SCHEDULER_WAITING.set(len(self._waiting))
+            try:
+                while True:
+                    if deadline and deadline.stop_reason():
+                        return None
+                    if (self._active.get(key, 0) < self.target_depth
+                            and self._next_for(key, time.monotonic()) is ticket):
+                        self._active[key] = self._active.get(key, 0) + 1
+                        break
+                    self._cond.wait(_DEADLINE_CHECK_S if deadline else self.aging_s or None)
+            finally:
+                self._waiting.remove(ticket)
+                SCHEDULER_WAITING.set(len(self._waiting))
+                # Whoever ranks next may now be first in line
+                self._cond.notify_all()
+        waited = time.monotonic() - ticket.arrived
+        if waited >= 1:
+            logger.info(f"Prompt held back {waited:.1f}s (priority {priority}, estimated cost {cost})")
+        return ticket
+
+    def wants_node_events(self, ticket):
+        """Whether node_started() can end the ticket's turn early"""
+        return bool(ticket.tail) and self.target_depth > 0
+
+    def node_started(self, ticket, node_id):
+        """The ticket's prompt started executing node_id; its tail lets the next job go"""
+        if str(node_id) in ticket.tail and not ticket.released:
+            logger.debug(f"Prompt reached tail node {node_id}, releasing its turn")
+            self.release(ticket)
+
+    def release(self, ticket):
+        """The ticket's prompt left ComfyUI's queue; let the next job go. Safe to call twice"""
+        if self.target_depth <= 0:
+            return
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._active[ticket.key] = max(0, self._active.get(ticket.key, 0) - 1)
+            self._cond.notify_all()
+
+    def status(self):
+        now = time.monotonic()
+        with self._cond:
+            return {
+                "target_depth": self.target_depth,
+                "queued": dict(self._active),
+                "waiting": [
+                    {"server": t.key, "priority": t.priority, "cost": t.cost, "waited_s": round(now - t.arrived, 1)}
+                    for t in sorted(self._waiting, key=lambda t: self._rank(t, now))
+                ],
+            }
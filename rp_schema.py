@@ -0,0 +1,211 @@
+"""
+Local workflow validation against a cached ComfyUI /object_info schema.
+
+ComfyUI only reports an invalid graph after a round trip to /prompt, and the schema
+needed to explain the failure (/object_info, a multi-megabyte response) used to be
+fetched again on every failure. ObjectInfoCache keeps one copy per worker, refreshed
+every OBJECT_INFO_TTL_S, and validate_workflow() checks a graph against it before it
+is queued: known class types, required inputs, enum values such as model filenames,
+number ranges, and that every link points at an existing node output of a matching
+type. Errors name the node, its class and the offending input.
+
+Enum values of upload inputs (LoadImage's "image") are not checked because the job's
+own input images are staged after the schema was cached. A stale cache can also miss
+a model that was added since, so validate_with_refresh() refetches a schema older
+than OBJECT_INFO_MIN_REFRESH_S once before rejecting a job; a stream of bad jobs
+costs at most one fetch per that interval. A failed fetch (ComfyUI unreachable or
+answering garbage) is not retried within that interval either, so jobs don't queue
+up behind a blocking /object_info request each; they validate against the last good
+schema, or not at all until there is one.
+"""
+import os
+import time
+import logging
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the cached /object_info is refetched
+OBJECT_INFO_TTL_S = float(os.getenv("OBJECT_INFO_TTL_S", "300"))
+# A workflow that fails validation refetches a schema older than this before it is rejected
+OBJECT_INFO_MIN_REFRESH_S = float(os.getenv("OBJECT_INFO_MIN_REFRESH_S", "30"))
+# Set to false to leave all validation to ComfyUI
+VALIDATE_WORKFLOWS = os.getenv("VALIDATE_WORKFLOWS", "true").lower() == "true"
+
+# Input options marking values that are uploaded with the job rather than known up front
+_UPLOAD_OPTIONS = ("image_upload", "upload", "video_upload", "audio_upload")
+
+
+class ObjectInfoCache:
+    """Shared, lazily refreshed copy of ComfyUI's /object_info"""
+
+    def __init__(self, comfy_host, ttl_s=OBJECT_INFO_TTL_S, retry_after_s=OBJECT_INFO_MIN_REFRESH_S):
+        self.comfy_host = comfy_host
+        self.ttl_s = ttl_s
+        # Seconds after a failed fetch before the next one is attempted
+        self.retry_after_s = retry_after_s
+        self._object_info = None
+        self._fetched_at = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def age(self):
+        """Seconds since the schema was fetched, or None if it never was"""
+        return None if self._fetched_at is None else time.monotonic() - self._fetched_at
+
+    def get(self, timeout=10, max_age_s=None):
+        """The cached schema, fetching it if missing or older than the TTL; None if ComfyUI is unreachable
+
+        After a failed fetch the cached copy (or None) is returned without another
+        request until retry_after_s have passed.
+        """
+        max_age_s = self.ttl_s if max_age_s is None else max_age_s
+        with self._lock:
+            age = self.age()
+            if self._object_info is not None and age is not None and age <= max_age_s:
+                return self._object_info
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_after_s:
+                return self._object_info
+            try:
+                response = requests.get(f"http://{self.comfy_host}/object_info", timeout=timeout)
+                response.raise_for_status()
+                self._object_info = response.json()
+                self._fetched_at = time.monotonic()
+                self._failed_at = None
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"Could not fetch /object_info, retrying in {self.retry_after_s:g}s at the earliest: {str(e)}")
+                self._failed_at = time.monotonic()
+            return self._object_info
+
+    def invalidate(self):
+        with self._lock:
+            self._fetched_at = None
+
+    def expire(self, min_age_s=OBJECT_INFO_MIN_REFRESH_S):
+        """Invalidate the schema unless it is younger than min_age_s, so repeated failures
+        refetch it at most once per that interval; returns whether it was invalidated"""
+        with self._lock:
+            if self._fetched_at is not None and time.monotonic() - self._fetched_at <= min_age_s:
+                return False
+            self._fetched_at = None
+            return True
+
+
+def _is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _input_specs(class_info):
+    inputs = class_info.get("input", {})
+    return inputs.get("required", {}) or {}, inputs.get("optional", {}) or {}
+
+
+def _combo_options(spec):
+    """Allowed values of a combo input, or None if the input isn't a combo"""
+    if not spec:
+        return None
+    if isinstance(spec[0], list):
+        return spec[0]
+    if spec[0] == "COMBO" and len(spec) > 1 and isinstance(spec[1], dict):
+        return spec[1].get("options")
+    return None
+
+
+def _types_match(output_type, input_type):
+    if output_type == "*" or input_type == "*":
+        return True
+    return bool(set(str(output_type).split(",")) & set(str(input_type).split(",")))
+
+
+def _check_literal(name, value, spec):
+    options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+    combo = _combo_options(spec)
+    if combo is not None:
+        if any(options.get(flag) for flag in _UPLOAD_OPTIONS):
+            return None
+        if value not in combo:
+            shown = ", ".join(map(str, combo[:20])) + (", ..." if len(combo) > 20 else "")
+            return f"Value {value!r} for '{name}' not in list [{shown}]"
+        return None
+    if spec[0] in ("INT", "FLOAT") and isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "min" in options and value < options["min"]:
+            return f"Value {value} for '{name}' is smaller than min of {options['min']}"
+        if "max" in options and value > options["max"]:
+            return f"Value {value} for '{name}' is bigger than max of {options['max']}"
+    return None
+
+
+def validate_workflow(workflow, object_info):
+    """Check an API-format workflow against /object_info; returns a list of error strings"""
+    errors = []
+    has_output = False
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            errors.append(f"Node {node_id}: expected an object with 'class_type' and 'inputs'")
+            continue
+        class_type = node.get("class_type")
+        class_info = object_info.get(class_type)
+        if class_info is None:
+            errors.append(f"Node {node_id}: unknown class_type {class_type!r} (node not installed?)")
+            continue
+        has_output = has_output or bool(class_info.get("output_node"))
+        label = f"Node {node_id} ({class_type})"
+        inputs = node.get("inputs", {})
+        required, optional = _input_specs(class_info)
+
+        for name in required:
+            if name not in inputs:
+                errors.append(f"{label}: required input '{name}' is missing")
+
+        for name, value in inputs.items():
+            spec = required.get(name) or optional.get(name)
+            if not spec:
+                # Unknown inputs are ignored by ComfyUI too
+                continue
+            if _is_link(value):
+                source_id = str(value[0])
+                source = workflow.get(source_id)
+                if not isinstance(source, dict):
+                    errors.append(f"{label}: input '{name}' links to missing node {source_id}")
+                    continue
+                source_info = object_info.get(source.get("class_type"))
+                if source_info is None:
+                    # Reported on the source node itself
+                    continue
+                outputs = source_info.get("output", [])
+                if value[1] >= len(outputs):
+                    errors.append(
+                        f"{label}: input '{name}' links to output {value[1]} of node {source_id}, "
+                        f"which only has {len(outputs)} output(s)"
+                    )
+                elif isinstance(spec[0], str) and not _types_match(outputs[value[1]], spec[0]):
+                    errors.append(
+                        f"{label}: input '{name}' expects {spec[0]} but node {source_id} "
+                        f"output {value[1]} is {outputs[value[1]]}"
+                    )
+                continue
+            error = _check_literal(name, value, spec)
+            if error:
+                errors.append(f"{label}: {error}")
+
+    if not has_output and not errors:
+        errors.append("Workflow has no output node")
+    return errors
+
+
+def validate_with_refresh(workflow, cache, timeout=10):
+    """Validate against the cached schema, refetching it once if the graph looks invalid
+
+    Returns the list of errors, empty when the graph is valid or no schema is available.
+    """
+    object_info = cache.get(timeout=timeout)
+    if object_info is None:
+        return []
+    errors = validate_workflow(workflow, object_info)
+    if errors and (cache.age() or 0) > OBJECT_INFO_MIN_REFRESH_S:
+        # New models or custom nodes may have appeared since the schema was cached
+        object_info = cache.get(timeout=timeout, max_age_s=0)
+        errors = validate_workflow(workflow, object_info) if object_info else []
+    return errors
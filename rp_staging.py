@@ -0,0 +1,265 @@
+"""
+RAM-backed staging of ComfyUI's input, output and temp folders.
+
+Every job writes its input images into ComfyUI's input folder and ComfyUI writes
+its images into the output folder, from where they are fetched and deleted again.
+On the container's overlay filesystem each of those handoffs goes through block
+storage. When this worker launches ComfyUI itself, StagingArea points all three
+folders at COMFY_STAGING_DIR instead, a tmpfs (/dev/shm by default), and the
+handler writes inputs there.
+
+The staging area holds at most COMFY_STAGING_MAX_MB, and never more than half of
+its filesystem (Docker's default /dev/shm is only 64 MB). When a write would go
+over that, files older than COMFY_STAGING_SPILL_AGE_S, which ComfyUI has finished
+writing, are moved to the matching folder under COMFY_DIR and replaced by a
+symlink, so ComfyUI and /view still find them under their usual names. An input
+that still doesn't fit is written under COMFY_DIR directly and linked the same
+way. The disk janitor (rp_janitor) sweeps both places.
+
+Usage is a running byte count: input writes, spills and the janitor's deletions
+(released()) update it, and a rescan every few seconds picks up the images ComfyUI
+wrote itself. Only a write that would go over the cap walks the staged files, and
+status() never does, so health checks stay cheap. That write picks the files to spill
+under the lock and copies them to disk after releasing it, so other writes and
+status() don't wait on block storage.
+
+Launch scripts that start ComfyUI themselves can get the arguments with
+    python main.py $(python rp_staging.py)
+and set COMFY_STAGING_DIR for the handler to match.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+from rp_inputs import input_path, write_image
+from rp_metrics import STAGING_SPILLS
+
+logger = logging.getLogger(__name__)
+
+# RAM-backed folder for ComfyUI's input/output/temp, empty to keep them under COMFY_DIR.
+# Unset, it defaults to /dev/shm/comfyui when the worker launches ComfyUI itself
+COMFY_STAGING_DIR = os.getenv("COMFY_STAGING_DIR")
+# Size cap of the staging area, beyond which files spill to disk
+COMFY_STAGING_MAX_MB = float(os.getenv("COMFY_STAGING_MAX_MB", "2048"))
+# Files younger than this may still be written by ComfyUI and are never moved to disk
+COMFY_STAGING_SPILL_AGE_S = float(os.getenv("COMFY_STAGING_SPILL_AGE_S", "30"))
+
+DEFAULT_STAGING_DIR = "/dev/shm/comfyui"
+STAGING_DIRS = ("input", "output", "temp")
+_MB = 1024 * 1024
+# Seconds the running byte count is trusted before a rescan adds ComfyUI's own writes
+_RESCAN_S = 10
+
+
+class StagingArea:
+    """ComfyUI's working folders on a size-capped tmpfs, spilling to COMFY_DIR when it's full"""
+
+    def __init__(self, comfy_dir, staging_dir=COMFY_STAGING_DIR, launches_comfyui=True,
+                 max_mb=COMFY_STAGING_MAX_MB, spill_age_s=COMFY_STAGING_SPILL_AGE_S):
+        self.comfy_dir = comfy_dir
+        if staging_dir is None:
+            # ComfyUI started elsewhere keeps its folders unless told otherwise
+            staging_dir = DEFAULT_STAGING_DIR if launches_comfyui else ""
+        self.max_bytes = max_mb * _MB
+        self.spill_age_s = spill_age_s
+        self.root = self._prepare(staging_dir) if staging_dir else None
+
+        self._lock = threading.Lock()
+        self._used = 0
+        self._counted_at = None
+        # Files being copied to disk by some writer, by path, with their size
+        self._spilling = {}
+        self.spilled_files = 0
+        self.spilled_bytes = 0
+        self.disk_writes = 0
+
+    def _prepare(self, staging_dir):
+        try:
+            for folder_type in STAGING_DIRS:
+                os.makedirs(os.path.join(staging_dir, folder_type), exist_ok=True)
+            fs = os.statvfs(staging_dir)
+        except OSError as e:
+            logger.warning(f"Staging dir {staging_dir} unusable, keeping ComfyUI's folders under {self.comfy_dir}: {str(e)}")
+            return None
+        fs_bytes = fs.f_blocks * fs.f_frsize
+        if fs_bytes and self.max_bytes > fs_bytes / 2:
+            logger.info(
+                f"Staging dir {staging_dir} is on a {fs_bytes / _MB:.0f} MB filesystem, "
+                f"capping it at {fs_bytes / 2 / _MB:.0f} MB"
+            )
+            self.max_bytes = fs_bytes / 2
+        logger.info(f"Staging ComfyUI's input/output/temp in {staging_dir} (up to {self.max_bytes / _MB:.0f} MB)")
+        return os.path.realpath(staging_dir)
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def dir(self, folder_type):
+        """The folder ComfyUI uses for a folder type, staged or under COMFY_DIR"""
+        return os.path.join(self.root if self.enabled else self.comfy_dir, folder_type)
+
+    def spill_dir(self, folder_type):
+        return os.path.join(self.comfy_dir, folder_type)
+
+    def roots(self):
+        """Janitor directories by name: the staged folders and, when staging, their spill folders"""
+        roots = {folder_type: self.dir(folder_type) for folder_type in STAGING_DIRS}
+        if self.enabled:
+            roots.update({f"{folder_type}_spill": self.spill_dir(folder_type) for folder_type in STAGING_DIRS})
+        return roots
+
+    def launch_args(self, output_subfolder=None):
+        """ComfyUI arguments for the staged folders; instances after the first get their own output subfolder"""
+        args = []
+        if self.enabled:
+            # ComfyUI appends "temp" to --temp-directory itself
+            args += ["--input-directory", self.dir("input"), "--temp-directory", self.root]
+        if output_subfolder:
+            args += ["--output-directory", os.path.join(self.dir("output"), output_subfolder)]
+        elif self.enabled:
+            args += ["--output-directory", self.dir("output")]
+        return args
+
+    # --- writes and spilling -----------------------------------------------
+
+    def _files(self):
+        """(mtime, size, folder type, path) of every regular file in the staging area"""
+        files = []
+        for folder_type in STAGING_DIRS:
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, folder_type)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.lstat(path)
+                    except OSError:
+                        continue
+                    if not os.path.islink(path):
+                        files.append((stat.st_mtime, stat.st_size, folder_type, path))
+        return files
+
+    def _spill(self, folder_type, path):
+        """Move one file to its spill folder and leave a symlink behind; returns the bytes moved
+
+        Runs outside the lock, the caller takes the bytes off the count.
+        """
+        relative = os.path.relpath(path, os.path.join(self.root, folder_type))
+        target = os.path.join(self.spill_dir(folder_type), relative)
+        try:
+            before = os.lstat(path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".spill-")
+            os.close(fd)
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, target)
+            after = os.lstat(path)
+            if (after.st_ino, after.st_mtime, after.st_size) != (before.st_ino, before.st_mtime, before.st_size):
+                # Rewritten while copying, the staged file is the current one
+                os.remove(target)
+                return 0
+            link_path = os.path.join(os.path.dirname(path), f".spill-{os.getpid()}-{threading.get_ident()}")
+            os.symlink(target, link_path)
+            os.replace(link_path, path)
+        except OSError as e:
+            logger.warning(f"Could not spill {path} to disk: {str(e)}")
+            return 0
+        STAGING_SPILLS.inc(dir=folder_type, reason="moved")
+        return before.st_size
+
+    def _recount(self, files=None):
+        files = self._files() if files is None else files
+        self._used = sum(size for _, size, _, _ in files)
+        self._counted_at = time.monotonic()
+
+    def _reserve(self, nbytes):
+        """Under the lock: count nbytes if they fit; returns (fits, [(folder type, path)] to spill first)
+
+        Spill candidates are settled files, oldest first, enough for nbytes to fit once
+        they are moved. They are claimed so concurrent writers don't pick them too.
+        """
+        if self._counted_at is None or time.monotonic() - self._counted_at >= _RESCAN_S:
+            self._recount()
+        if self._used + nbytes > self.max_bytes:
+            # Over the cap: only now are the files listed, for an exact count and spill candidates
+            files = sorted(self._files())
+            self._recount(files)
+        if self._used + nbytes <= self.max_bytes:
+            # Counted before the write so concurrent writers don't overcommit
+            self._used += nbytes
+            return True, []
+        freeing = sum(self._spilling.values())
+        candidates = []
+        now = time.time()
+        for mtime, size, folder_type, path in files:
+            if self._used - freeing + nbytes <= self.max_bytes or now - mtime < self.spill_age_s:
+                break
+            if path not in self._spilling:
+                self._spilling[path] = size
+                freeing += size
+                candidates.append((folder_type, path))
+        return False, candidates
+
+    def released(self, path, nbytes):
+        """The janitor deleted a file; takes its bytes off the count if it was staged"""
+        if not self.enabled or os.path.commonpath([self.root, os.path.realpath(path)]) != self.root:
+            return
+        with self._lock:
+            self._used = max(0, self._used - nbytes)
+
+    def write_input(self, name, blob):
+        """Write an input image where ComfyUI reads it, on disk behind a symlink if the staging area is full"""
+        input_dir = self.dir("input")
+        if not self.enabled:
+            return write_image(input_dir, name, blob)
+        with self._lock:
+            fits, candidates = self._reserve(len(blob))
+        if candidates:
+            # Copied to disk without the lock, so other writes and status() don't wait on block storage
+            moved = [(path, self._spill(folder_type, path)) for folder_type, path in candidates]
+            with self._lock:
+                for path, nbytes in moved:
+                    del self._spilling[path]
+                    if nbytes:
+                        self._used = max(0, self._used - nbytes)
+                        self.spilled_files += 1
+                        self.spilled_bytes += nbytes
+                fits = self._used + len(blob) <= self.max_bytes
+                if fits:
+                    self._used += len(blob)
+        if fits:
+            return write_image(input_dir, name, blob)
+        staged_path = input_path(input_dir, name)
+        target = write_image(self.spill_dir("input"), name, blob)
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        link_path = os.path.join(os.path.dirname(staged_path), f".spill-{os.getpid()}-{threading.get_ident()}")
+        os.symlink(target, link_path)
+        os.replace(link_path, staged_path)
+        STAGING_SPILLS.inc(dir="input", reason="write")
+        with self._lock:
+            self.disk_writes += 1
+        return staged_path
+
+    def status(self):
+        if not self.enabled:
+            return {"enabled": False}
+        with self._lock:
+            return {
+                "enabled": True,
+                "dir": self.root,
+                "max_mb": round(self.max_bytes / _MB, 1),
+                "used_mb": round(self._used / _MB, 1),
+                "spilled_files": self.spilled_files,
+                "spilled_mb": round(self.spilled_bytes / _MB, 1),
+                "disk_writes": self.disk_writes,
+            }
+
+
+if __name__ == "__main__":
+    # Print the ComfyUI arguments for COMFY_STAGING_DIR, for launch scripts
+    logging.basicConfig(level=logging.WARNING)
+    staging = StagingArea(os.environ.get("COMFY_DIR", "/comfyui"))
+    sys.stdout.write(" ".join(staging.launch_args()) + "\n")
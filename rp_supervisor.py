@@ -0,0 +1,176 @@
+"""
+Supervisor for the ComfyUI child process.
+
+Owns the Popen handle so a ComfyUI exit is noticed the moment it happens,
+restarts it with exponential backoff, lets in-flight jobs fail fast instead of
+waiting on dead HTTP endpoints, and keeps the most recent ComfyUI output in a
+bounded ring buffer so it can be attached to error responses.
+"""
+import os
+import sys
+import time
+import atexit
+import logging
+import threading
+import subprocess
+from collections import deque
+
+from rp_metrics import COMFYUI_RESTARTS
+
+logger = logging.getLogger(__name__)
+
+# Lines of ComfyUI output kept in memory
+COMFY_LOG_BUFFER_LINES = int(os.getenv("COMFY_LOG_BUFFER_LINES", "500"))
+# Lines of that buffer attached to error responses
+COMFY_LOG_TAIL_LINES = int(os.getenv("COMFY_LOG_TAIL_LINES", "50"))
+# Restart backoff: first delay, cap, and uptime after which the backoff resets
+COMFY_RESTART_BACKOFF_S = float(os.getenv("COMFY_RESTART_BACKOFF_S", "1"))
+COMFY_RESTART_BACKOFF_MAX_S = float(os.getenv("COMFY_RESTART_BACKOFF_MAX_S", "30"))
+COMFY_STABLE_UPTIME_S = float(os.getenv("COMFY_STABLE_UPTIME_S", "60"))
+# 0 means restart forever
+COMFY_MAX_RESTARTS = int(os.getenv("COMFY_MAX_RESTARTS", "0"))
+
+
+class ComfySupervisor:
+    """Runs ComfyUI as a child process and restarts it when it exits"""
+
+    def __init__(self, command, cwd=None, env=None, log_lines=COMFY_LOG_BUFFER_LINES,
+                 backoff_s=COMFY_RESTART_BACKOFF_S, backoff_max_s=COMFY_RESTART_BACKOFF_MAX_S,
+                 max_restarts=COMFY_MAX_RESTARTS, echo=True, name="ComfyUI"):
+        self.command = command
+        # Tells instances apart in logs when a worker runs several
+        self.name = name
+        self.cwd = cwd
+        self.env = dict(os.environ if env is None else env, PYTHONUNBUFFERED="1")
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self.max_restarts = max_restarts
+        self.echo = echo
+
+        self.process = None
+        self.generation = 0
+        self.restarts = 0
+        self.last_exit_code = None
+        self.last_exit_at = None
+        self.started_at = None
+        self._log = deque(maxlen=log_lines)
+        self._log_lock = threading.Lock()
+        self._state = threading.Condition()
+        self._stopping = False
+        self._monitor = None
+
+    def start(self):
+        """Launch ComfyUI and the monitor thread that keeps it running"""
+        self._spawn()
+        self._monitor = threading.Thread(target=self._supervise, name="comfyui-supervisor", daemon=True)
+        self._monitor.start()
+        atexit.register(self.stop)
+        return self
+
+    def _spawn(self):
+        process = subprocess.Popen(
+            self.command,
+            cwd=self.cwd,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            text=True,
+            errors="replace",
+            bufsize=1,
+        )
+        with self._state:
+            self.process = process
+            self.generation += 1
+            self.started_at = time.time()
+            self._state.notify_all()
+        threading.Thread(
+            target=self._pump_output, args=(process,), name="comfyui-output", daemon=True
+        ).start()
+        logger.info(f"Started {self.name} (pid {process.pid}, generation {self.generation})")
+
+    def _pump_output(self, process):
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            with self._log_lock:
+                self._log.append(line)
+            if self.echo:
+                # Keep ComfyUI's output in the container log as before
+                sys.stdout.write(line + "\n" if self.name == "ComfyUI" else f"[{self.name}] {line}\n")
+        process.stdout.close()
+
+    def _supervise(self):
+        delay = self.backoff_s
+        while True:
+            process = self.process
+            exit_code = process.wait()
+            uptime = time.time() - self.started_at
+            with self._state:
+                self.last_exit_code = exit_code
+                self.last_exit_at = time.time()
+                self._state.notify_all()
+                if self._stopping:
+                    return
+            logger.error(f"{self.name} exited with code {exit_code} after {uptime:.1f}s")
+
+            if uptime >= COMFY_STABLE_UPTIME_S:
+                delay = self.backoff_s
+            # Retry the spawn itself until a process runs; failed spawns count towards the limit
+            while True:
+                if self.max_restarts and self.restarts >= self.max_restarts:
+                    logger.error(f"{self.name} reached the restart limit ({self.max_restarts}), giving up")
+                    return
+                logger.info(f"Restarting {self.name} in {delay:.1f}s...")
+                with self._state:
+                    if self._state.wait_for(lambda: self._stopping, timeout=delay):
+                        return
+                self.restarts += 1
+                delay = min(delay * 2, self.backoff_max_s)
+                try:
+                    self._spawn()
+                except OSError as e:
+                    logger.error(f"Failed to restart {self.name}: {str(e)}")
+                    with self._state:
+                        self.last_exit_at = time.time()
+                    continue
+                COMFYUI_RESTARTS.inc()
+                break
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def has_exited_since(self, generation):
+        """True if the process a job started on (by generation) is gone"""
+        return self.generation != generation or not self.is_running()
+
+    def wait_for_exit(self, generation, timeout):
+        """Sleep up to timeout, waking immediately if that generation's process exits"""
+        with self._state:
+            return self._state.wait_for(lambda: self.has_exited_since(generation), timeout=timeout)
+
+    def recent_output(self, lines=COMFY_LOG_TAIL_LINES):
+        with self._log_lock:
+            return list(self._log)[-lines:] if lines else []
+
+    def status(self):
+        return {
+            "pid": self.process.pid if self.process else None,
+            "running": self.is_running(),
+            "generation": self.generation,
+            "restarts": self.restarts,
+            "last_exit_code": self.last_exit_code,
+            "last_exit_at": self.last_exit_at,
+        }
+
+    def stop(self, timeout=10):
+        """Terminate ComfyUI and stop restarting it"""
+        with self._state:
+            self._stopping = True
+            self._state.notify_all()
+        process = self.process
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
@@ -0,0 +1,235 @@
+"""
+Per-job execution traces in Chrome trace / Perfetto JSON format.
+
+A JobTrace records the handler's own stages and the per-node timings derived from
+ComfyUI's websocket events (executing / executed / execution_cached / progress).
+Jobs opt in with "trace": true (trace returned inline in the job output) or
+"trace": "file" (trace written to TRACE_DIR and its path returned).
+Open the result in chrome://tracing or https://ui.perfetto.dev.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from rp_metrics import stage_timer
+from rp_ledger import note_stage
+
+logger = logging.getLogger(__name__)
+
+# Where "trace": "file" requests are written
+TRACE_DIR = os.getenv("TRACE_DIR", "/tmp/comfy-traces")
+
+# Chrome trace thread ids, one row per source in the viewer
+HANDLER_TID = 1
+COMFY_NODES_TID = 2
+
+
+def trace_mode(job_input):
+    """Return None, "inline" or "file" depending on the job's 'trace' field"""
+    if not isinstance(job_input, dict):
+        return None
+    requested = job_input.get("trace")
+    if requested is True or (isinstance(requested, str) and requested.lower() in ("true", "inline")):
+        return "inline"
+    if isinstance(requested, str) and requested.lower() == "file":
+        return "file"
+    return None
+
+
+class JobTrace:
+    """Collects trace events for a single job"""
+
+    def __init__(self, job_id, mode="inline", workflow=None):
+        self.job_id = job_id
+        self.mode = mode
+        self.prompt_id = None
+        self._origin = time.perf_counter()
+        self._origin_wall = time.time()
+        self._events = []
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self._running_node = None
+        if workflow:
+            self.set_workflow(workflow)
+
+    def set_workflow(self, workflow):
+        """Remember class types and titles so node spans get readable names"""
+        for node_id, node in workflow.items():
+            if isinstance(node, dict):
+                self._nodes[str(node_id)] = (
+                    node.get("class_type", "unknown"),
+                    node.get("_meta", {}).get("title"),
+                )
+
+    def _us(self, t):
+        return round((t - self._origin) * 1_000_000, 1)
+
+    def _append(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def add_span(self, name, start, end, tid=HANDLER_TID, cat="handler", args=None):
+        """Record a complete ("X") event between two perf_counter timestamps"""
+        self._append({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": self._us(start),
+            "dur": round(max(0.0, end - start) * 1_000_000, 1),
+            "pid": 1,
+            "tid": tid,
+            "args": args or {},
+        })
+
+    def instant(self, name, tid=HANDLER_TID, cat="handler", args=None):
+        self._append({
+            "name": name,
+            "cat": cat,
+            "ph": "i",
+            "s": "t",
+            "ts": self._us(time.perf_counter()),
+            "pid": 1,
+            "tid": tid,
+            "args": args or {},
+        })
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter(), args=args)
+
+    def _node_name(self, node_id):
+        class_type, _ = self._nodes.get(str(node_id), ("unknown", None))
+        return f"{class_type} #{node_id}"
+
+    def _close_running_node(self, now, **extra):
+        if self._running_node is None:
+            return
+        node_id, started = self._running_node
+        class_type, title = self._nodes.get(str(node_id), ("unknown", None))
+        args = {"node_id": node_id, "class_type": class_type}
+        if title:
+            args["title"] = title
+        args.update(extra)
+        self.add_span(self._node_name(node_id), started, now, tid=COMFY_NODES_TID, cat="comfyui", args=args)
+        self._running_node = None
+
+    def on_comfy_message(self, message, received_at=None):
+        """Feed a decoded ComfyUI websocket message into the trace"""
+        now = received_at if received_at is not None else time.perf_counter()
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if self.prompt_id and data.get("prompt_id") not in (None, self.prompt_id):
+            return
+
+        if msg_type == "executing":
+            # ComfyUI announces the next node; the previous one has finished
+            self._close_running_node(now)
+            node_id = data.get("node")
+            if node_id is not None:
+                self._running_node = (str(node_id), now)
+            else:
+                self.instant("execution_finished", tid=COMFY_NODES_TID, cat="comfyui")
+        elif msg_type == "executed":
+            node_id = data.get("node")
+            if self._running_node and self._running_node[0] == str(node_id):
+                self._close_running_node(now, output=True)
+        elif msg_type == "execution_start":
+            self.instant("execution_start", tid=COMFY_NODES_TID, cat="comfyui")
+        elif msg_type == "execution_cached":
+            nodes = data.get("nodes") or []
+            self.instant(
+                "execution_cached",
+                tid=COMFY_NODES_TID,
+                cat="comfyui",
+                args={"nodes": [self._node_name(n) for n in nodes]},
+            )
+        elif msg_type == "execution_error":
+            self._close_running_node(now, error=data.get("exception_message"))
+            self.instant("execution_error", tid=COMFY_NODES_TID, cat="comfyui", args={
+                "node_id": data.get("node_id"),
+                "node_type": data.get("node_type"),
+                "message": data.get("exception_message"),
+            })
+        elif msg_type == "progress" and data.get("node") is not None:
+            self._append({
+                "name": f"progress {self._node_name(data['node'])}",
+                "cat": "comfyui",
+                "ph": "C",
+                "ts": self._us(now),
+                "pid": 1,
+                "args": {"step": data.get("value", 0)},
+            })
+
+    def to_chrome_trace(self):
+        """Return the trace as a Chrome trace / Perfetto JSON object"""
+        self._close_running_node(time.perf_counter(), incomplete=True)
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"job {self.job_id}"}},
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": HANDLER_TID, "args": {"name": "handler"}},
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": COMFY_NODES_TID, "args": {"name": "ComfyUI nodes"}},
+        ]
+        with self._lock:
+            events = sorted(self._events, key=lambda e: e["ts"])
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "job_id": self.job_id,
+                "prompt_id": self.prompt_id,
+                "started_at": self._origin_wall,
+            },
+        }
+
+    def write(self, directory=None):
+        """Write the trace to <directory>/<job_id>.trace.json and return the path"""
+        directory = directory or TRACE_DIR
+        os.makedirs(directory, exist_ok=True)
+        safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(self.job_id))
+        path = os.path.join(directory, f"{safe_id}.trace.json")
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        return path
+
+
+def trace_for_job(job):
+    """Create a JobTrace when the job asked for one, otherwise return None"""
+    mode = trace_mode(job.get("input"))
+    if mode is None:
+        return None
+    return JobTrace(job.get("id", "unknown"), mode=mode)
+
+
+def attach_trace(result, trace):
+    """Add the trace (inline) or its file path to the job result"""
+    if trace is None or not isinstance(result, dict):
+        return result
+    try:
+        if trace.mode == "file":
+            result["trace_path"] = trace.write()
+        else:
+            result["trace"] = trace.to_chrome_trace()
+    except OSError as e:
+        logger.warning(f"Could not write job trace: {str(e)}")
+    return result
+
+
+@contextmanager
+def traced_stage(handler, stage, trace=None):
+    """Time a stage into the metrics histogram, the job's ledger row and, when tracing, the job trace"""
+    start = time.perf_counter()
+    try:
+        with stage_timer(handler, stage):
+            if trace is None:
+                yield
+            else:
+                with trace.span(stage):
+                    yield
+    finally:
+        note_stage(stage, time.perf_counter() - start)
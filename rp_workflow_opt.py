@@ -0,0 +1,211 @@
+"""
+Workflow graph optimizer applied to every compiled workflow before it is queued.
+
+Two passes over the API-format graph:
+
+1. Bypass identity transforms: nodes whose parameters make them a no-op (a blur with
+   radius 0, a ControlNet applied at strength 0, an upscale by 1.0, ...) are removed
+   and everything that consumed their outputs is rewired to the matching input.
+2. Prune dead nodes: nodes that no longer reach an output node are dropped, such as
+   the ControlNet loader of a bypassed ControlNet or the model loader of a bypassed
+   upscale. Without /object_info to say which classes are outputs, only known output
+   classes and the original graph's sinks count as outputs, so custom output nodes
+   are never pruned by mistake.
+
+The report lists what was bypassed and removed with a rough estimate of the time
+saved, taken from ESTIMATED_NODE_COST_S.
+"""
+import os
+
+from rp_metrics import WORKFLOW_NODES_REMOVED
+
+# "all" applies every rule, "exact" skips rules that change pixels slightly, "off" disables the pass
+WORKFLOW_OPTIMIZE = os.getenv("WORKFLOW_OPTIMIZE", "all").lower()
+OPTIMIZE_MODES = ("all", "exact", "off")
+
+# Output node classes, used when /object_info isn't available
+KNOWN_OUTPUT_CLASS_TYPES = {
+    "SaveImage", "SaveImagePlus", "PreviewImage", "SaveImageWebsocket", "SaveAnimatedWEBP",
+    "SaveAnimatedPNG", "SaveLatent",
+}
+# Classes without side effects that may be pruned even if they were sinks in the original graph
+SIDE_EFFECT_FREE_CLASS_TYPES = {
+    "LoadImage", "CheckpointLoaderSimple", "VAELoader", "ControlNetLoader", "UpscaleModelLoader",
+    "CLIPLoader", "DualCLIPLoader", "UNETLoader", "LoraLoader", "ImageBlur", "ImageScaleBy",
+    "GetImageSize", "UpscaleImageByUsingModel", "ImageUpscaleWithModel",
+}
+
+# Ballpark seconds per node for a 1280x720 FLUX job, only used for the savings estimate
+# in the report; refine them from per-node timings in job traces
+ESTIMATED_NODE_COST_S = {
+    "UpscaleImageByUsingModel": 2.0,
+    "ImageUpscaleWithModel": 2.0,
+    "UpscaleModelLoader": 0.5,
+    "ControlNetApplyAdvanced": 4.0,
+    "ControlNetApply": 4.0,
+    "ControlNetLoader": 2.0,
+    "ColorMatch": 0.3,
+    "ImageBlur": 0.05,
+    "ImageScaleBy": 0.05,
+    "LatentUpscaleBy": 0.05,
+}
+
+_EPSILON = 1e-6
+
+
+def _literal(inputs, name):
+    """A literal (non-link) numeric input value, or None"""
+    value = inputs.get(name)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def _is_one(inputs, name):
+    value = _literal(inputs, name)
+    return value is not None and abs(value - 1.0) < _EPSILON
+
+
+def _is_zero(inputs, name):
+    value = _literal(inputs, name)
+    return value is not None and abs(value) < _EPSILON
+
+
+def _controlnet_inactive(inputs):
+    if _is_zero(inputs, "strength"):
+        return True
+    start, end = _literal(inputs, "start_percent"), _literal(inputs, "end_percent")
+    return start is not None and end is not None and start >= end
+
+
+# class_type -> (is_identity(inputs), {output slot: input passed through}, exact, reason)
+# Non-exact rules drop work that still changes pixels slightly (a model upscale
+# back to the original size sharpens the image).
+BYPASS_RULES = {
+    "ImageBlur": (lambda i: _is_zero(i, "blur_radius"), {0: "image"}, True, "blur_radius 0"),
+    "ImageScaleBy": (lambda i: _is_one(i, "scale_by"), {0: "image"}, True, "scale_by 1.0"),
+    "LatentUpscaleBy": (lambda i: _is_one(i, "scale_by"), {0: "samples"}, True, "scale_by 1.0"),
+    "ColorMatch": (lambda i: _is_zero(i, "strength"), {0: "image_target"}, True, "strength 0"),
+    "ImageSharpen": (lambda i: _is_zero(i, "alpha"), {0: "image"}, True, "alpha 0"),
+    "ControlNetApply": (lambda i: _is_zero(i, "strength"), {0: "conditioning"}, True, "strength 0"),
+    "ControlNetApplyAdvanced": (
+        _controlnet_inactive, {0: "positive", 1: "negative"}, True, "strength 0 or empty step range"
+    ),
+    "UpscaleImageByUsingModel": (
+        lambda i: _is_one(i, "upscale_by"), {0: "image"}, False, "upscale_by 1.0"
+    ),
+}
+
+
+def _is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _links(node):
+    return [value for value in node.get("inputs", {}).values() if _is_link(value)]
+
+
+def optimize_mode(job_input):
+    """The job's "optimize" setting (false disables it) or WORKFLOW_OPTIMIZE"""
+    requested = job_input.get("optimize") if isinstance(job_input, dict) else None
+    if requested is False:
+        return "off"
+    mode = requested if isinstance(requested, str) else WORKFLOW_OPTIMIZE
+    if mode not in OPTIMIZE_MODES:
+        raise ValueError(f"Unknown optimize mode {mode!r}, expected one of {list(OPTIMIZE_MODES)}")
+    return mode
+
+
+def _is_output(node, object_info, original_sinks, node_id):
+    class_type = node.get("class_type")
+    if object_info is not None and class_type in object_info:
+        return bool(object_info[class_type].get("output_node"))
+    if class_type in KNOWN_OUTPUT_CLASS_TYPES:
+        return True
+    # Unknown classes that nothing consumed to begin with may be custom outputs
+    return node_id in original_sinks and class_type not in SIDE_EFFECT_FREE_CLASS_TYPES
+
+
+def optimize_workflow(workflow, mode="all", object_info=None):
+    """Bypass identity nodes and prune dead ones
+
+    Returns (optimized workflow, report). The input workflow is left untouched; the
+    report lists bypassed and removed nodes and the estimated seconds saved.
+    """
+    report = {"bypassed": [], "removed": [], "estimated_savings_s": 0.0}
+    if mode == "off" or not isinstance(workflow, dict):
+        return workflow, report
+
+    graph = {
+        node_id: dict(node, inputs=dict(node.get("inputs", {})))
+        for node_id, node in workflow.items()
+        if isinstance(node, dict)
+    }
+    consumed = {str(link[0]) for node in graph.values() for link in _links(node)}
+    original_sinks = set(graph) - consumed
+
+    # --- 1. bypass identity transforms ---
+    # Repeated until nothing changes so chains of no-ops collapse
+    changed = True
+    while changed:
+        changed = False
+        for node_id, node in list(graph.items()):
+            rule = BYPASS_RULES.get(node.get("class_type"))
+            if not rule:
+                continue
+            is_identity, passthrough, exact, reason = rule
+            if (mode == "exact" and not exact) or not is_identity(node["inputs"]):
+                continue
+            sources = {slot: node["inputs"].get(name) for slot, name in passthrough.items()}
+            if not all(_is_link(source) for source in sources.values()):
+                continue
+            # Leave the node alone if something consumes an output we can't pass through
+            if any(
+                str(value[0]) == node_id and value[1] not in sources
+                for other in graph.values() for value in _links(other)
+            ):
+                continue
+            for other in graph.values():
+                for name, value in other["inputs"].items():
+                    if _is_link(value) and str(value[0]) == node_id and value[1] in sources:
+                        other["inputs"][name] = list(sources[value[1]])
+            del graph[node_id]
+            report["bypassed"].append({"node": node_id, "class_type": node.get("class_type"), "reason": reason})
+            changed = True
+
+    # --- 2. prune nodes that no longer reach an output ---
+    live = set()
+    pending = [
+        node_id for node_id, node in graph.items()
+        if _is_output(node, object_info, original_sinks, node_id)
+    ]
+    while pending:
+        node_id = pending.pop()
+        if node_id in live or node_id not in graph:
+            continue
+        live.add(node_id)
+        pending.extend(str(link[0]) for link in _links(graph[node_id]))
+    for node_id in [node_id for node_id in graph if node_id not in live]:
+        report["removed"].append({"node": node_id, "class_type": graph[node_id].get("class_type")})
+        del graph[node_id]
+
+    report["estimated_savings_s"] = sum(
+        ESTIMATED_NODE_COST_S.get(entry["class_type"], 0.0)
+        for entry in report["bypassed"] + report["removed"]
+    )
+    return graph, report
+
+
+def record_report(handler, report):
+    """Count what optimize_workflow() dropped; returns a one-line summary, or None if nothing was"""
+    for action in ("bypassed", "removed"):
+        if report[action]:
+            WORKFLOW_NODES_REMOVED.inc(len(report[action]), handler=handler, action=action)
+    if not report["bypassed"] and not report["removed"]:
+        return None
+    bypassed = ", ".join(f"{n['node']} ({n['class_type']}: {n['reason']})" for n in report["bypassed"])
+    removed = ", ".join(f"{n['node']} ({n['class_type']})" for n in report["removed"])
+    return (
+        f"Workflow optimized: bypassed {bypassed or 'nothing'}; removed {removed or 'nothing'}; "
+        f"estimated savings {report['estimated_savings_s']:.1f}s"
+    )
@@ -0,0 +1,119 @@
+"""
+Websocket output mode: stream output images to the handler instead of saving them.
+
+ComfyUI's websocket_image_save custom node (SaveImageWebsocket) sends every image it
+receives as a binary websocket frame to the client that queued the prompt, without
+writing anything under output/. With output_mode "websocket" the handlers swap the
+workflow's save nodes for it and WebsocketImageCollector assembles the frames, which
+skips the disk write, the outputs lookup in /history and the /view download.
+
+SaveImageWebsocket always sends PNG, so outputs arrive as .png whatever format the
+replaced save node was configured for.
+"""
+import os
+import struct
+import threading
+
+# "history" saves to disk and downloads through /view, "websocket" streams the images
+OUTPUT_MODE = os.getenv("OUTPUT_MODE", "history").lower()
+OUTPUT_MODES = ("history", "websocket")
+
+# Save nodes swapped out in websocket mode
+SAVE_NODE_CLASS_TYPES = ("SaveImage", "SaveImagePlus")
+WEBSOCKET_SAVE_CLASS_TYPE = "SaveImageWebsocket"
+
+# Binary frames start with the event type and the image format, both big-endian uint32
+_PREVIEW_IMAGE_EVENT = 1
+_IMAGE_EXTENSIONS = {1: ".jpg", 2: ".png"}
+_HEADER = struct.Struct(">II")
+
+
+def output_mode(job_input):
+    """The job's "output_mode" or OUTPUT_MODE; raises ValueError for unknown modes"""
+    mode = (job_input.get("output_mode") if isinstance(job_input, dict) else None) or OUTPUT_MODE
+    if mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output_mode {mode!r}, expected one of {list(OUTPUT_MODES)}")
+    return mode
+
+
+def swap_save_nodes(workflow):
+    """Replace the workflow's save nodes with SaveImageWebsocket
+
+    Returns (new workflow, {node_id: filename_prefix}) for the swapped nodes; the input
+    workflow is left untouched.
+    """
+    swapped = dict(workflow)
+    prefixes = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or node.get("class_type") not in SAVE_NODE_CLASS_TYPES:
+            continue
+        inputs = node.get("inputs", {})
+        if "images" not in inputs:
+            continue
+        swapped[node_id] = {
+            "class_type": WEBSOCKET_SAVE_CLASS_TYPE,
+            "inputs": {"images": inputs["images"]},
+            "_meta": {"title": f"{node.get('_meta', {}).get('title', node['class_type'])} (websocket)"},
+        }
+        prefixes[node_id] = str(inputs.get("filename_prefix") or "ComfyUI")
+    return swapped, prefixes
+
+
+class WebsocketImageCollector:
+    """Assembles the image frames SaveImageWebsocket nodes send for one prompt
+
+    Feed it every message from a websocket whose client_id belongs to a single job.
+    Binary frames are attributed to whichever node is executing, so latent previews
+    sent while other nodes run are ignored.
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = dict(prefixes)
+        self._frames = {node_id: [] for node_id in self.prefixes}
+        self._current_node = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def on_message(self, message):
+        """Track execution progress from a decoded JSON message"""
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if msg_type == "executing":
+            with self._lock:
+                self._current_node = data.get("node")
+            if data.get("node") is None and data.get("prompt_id"):
+                self._done.set()
+        elif msg_type in ("execution_success", "execution_error", "execution_interrupted"):
+            self._done.set()
+
+    def on_binary(self, frame):
+        """Keep an image frame if one of the swapped save nodes is executing"""
+        if len(frame) <= _HEADER.size:
+            return
+        event, image_format = _HEADER.unpack_from(frame)
+        if event != _PREVIEW_IMAGE_EVENT or image_format not in _IMAGE_EXTENSIONS:
+            return
+        with self._lock:
+            frames = self._frames.get(self._current_node)
+            if frames is not None:
+                frames.append((image_format, bytes(frame[_HEADER.size:])))
+
+    def wait_done(self, timeout):
+        """Wait for the end of execution; frames sent before it have all arrived by then"""
+        return self._done.wait(timeout)
+
+    def missing_nodes(self):
+        """Swapped save nodes that have not sent any image"""
+        with self._lock:
+            return [node_id for node_id, frames in self._frames.items() if not frames]
+
+    def images(self):
+        """[{"node_id", "filename", "data"}] in workflow output order"""
+        images = []
+        with self._lock:
+            for node_id, frames in self._frames.items():
+                for index, (image_format, data) in enumerate(frames, 1):
+                    # Node id keeps names unique when save nodes share a prefix
+                    filename = f"{self.prefixes[node_id]}_{node_id}_{index:05d}_{_IMAGE_EXTENSIONS[image_format]}"
+                    images.append({"node_id": node_id, "filename": filename, "data": data})
+        return images
@@ -0,0 +1,295 @@
+"""
+Soak test: drive thousands of jobs through a handler against the stub ComfyUI and
+fail if the worker's resources keep growing.
+
+The handler runs in this process, started like the worker's __main__ starts it
+(health monitor, janitor, job ledger), with comfy_stub.py in a child process so the
+stub's own memory and sockets stay out of the measurements. A sampler thread
+records RSS, open file descriptors, OS threads and the bytes under the handler's
+private TMPDIR, COMFY_DIR and staging area (COMFY_STAGING_DIR) every --sample-interval seconds.
+
+Growth is the median of the last --window fraction of samples minus the median of
+the first one after --warmup jobs, so steady-state churn and one-off caches don't
+count. Any growth beyond its threshold is reported as a violation and the exit
+status is 1. --tracemalloc adds the Python allocation sites that grew the most.
+
+Usage:
+    python soak_handler.py --handler rp_handler --jobs 5000 --concurrency 2
+    python soak_handler.py --handler handlerCOMEXAMPLE --jobs 2000 --max-rss-growth-mb 32 --output soak.json
+"""
+import os
+import gc
+import sys
+import json
+import time
+import base64
+import logging
+import argparse
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+
+from bench_handler import HANDLERS, load_handler, make_job_input, make_png, start_stub
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+_MB = 1024 * 1024
+
+
+def proc_status():
+    """(RSS bytes, OS thread count) of this process from /proc, None where unavailable"""
+    rss = threads = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return rss, threads
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def dir_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+class Sampler:
+    """Samples the process's resources from a daemon thread"""
+
+    def __init__(self, interval_s, tmp_dir, comfy_dir, staging_dir):
+        self.interval_s = interval_s
+        self.tmp_dir = tmp_dir
+        self.comfy_dir = comfy_dir
+        self.staging_dir = staging_dir
+        self.samples = []
+        self.jobs_done = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        # Garbage waiting for a collection isn't a leak
+        gc.collect()
+        rss, threads = proc_status()
+        self.samples.append({
+            "t": time.perf_counter(),
+            "jobs": self.jobs_done,
+            "rss_mb": rss / _MB if rss is not None else None,
+            "fds": open_fds(),
+            "threads": threads if threads is not None else threading.active_count(),
+            "tmp_mb": dir_bytes(self.tmp_dir) / _MB,
+            "comfy_dir_mb": dir_bytes(self.comfy_dir) / _MB,
+            "staging_mb": dir_bytes(self.staging_dir) / _MB,
+        })
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="soak-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def growth(samples, metric, window):
+    """(baseline, final, growth, growth per 1000 jobs) of a sampled metric"""
+    values = [(s["jobs"], s[metric]) for s in samples if s[metric] is not None]
+    if len(values) < 2:
+        return None
+    size = max(1, int(len(values) * window))
+    baseline = _median([v for _, v in values[:size]])
+    final = _median([v for _, v in values[-size:]])
+    jobs = _median([j for j, _ in values[-size:]]) - _median([j for j, _ in values[:size]])
+    return {
+        "baseline": round(baseline, 2),
+        "final": round(final, 2),
+        "growth": round(final - baseline, 2),
+        "per_1000_jobs": round((final - baseline) * 1000 / jobs, 2) if jobs else None,
+    }
+
+
+def job_inputs(handler_name, image_b64):
+    """Inputs cycled through the soak; rp_handler alternates its built-in and generic workflow paths"""
+    inputs = [make_job_input(handler_name, image_b64)]
+    if handler_name == "rp_handler":
+        inputs.append(make_job_input("handlerCOMEXAMPLE", image_b64))
+    return inputs
+
+
+def soak(module, inputs, args, sampler):
+    """Run args.warmup + args.jobs jobs over args.concurrency threads; returns (error mix, allocation growth)"""
+    errors = {}
+    lock = threading.Lock()
+    next_job = iter(range(args.warmup + args.jobs))
+
+    def worker():
+        for i in next_job:
+            job = {"id": f"soak-{i}", "input": json.loads(json.dumps(inputs[i % len(inputs)]))}
+            try:
+                result = module.handler(job)
+            except Exception as e:
+                result = {"error": f"Handler raised {type(e).__name__}: {e}"}
+            with lock:
+                if "error" in result:
+                    key = str(result["error"])[:120]
+                    errors[key] = errors.get(key, 0) + 1
+                sampler.jobs_done += 1
+                if sampler.jobs_done == args.warmup:
+                    warmed_up.set()
+
+    warmed_up = threading.Event()
+    if not args.warmup:
+        warmed_up.set()
+    threads = [threading.Thread(target=worker, name=f"soak-job-{n}", daemon=True) for n in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    warmed_up.wait()
+    if args.tracemalloc:
+        tracemalloc.start()
+    # The baseline is taken once caches, pools and background threads have settled
+    sampler.sample()
+    baseline_snapshot = tracemalloc.take_snapshot() if args.tracemalloc else None
+    sampler.start()
+    for thread in threads:
+        thread.join()
+    sampler.stop()
+
+    top_growth = []
+    if baseline_snapshot:
+        gc.collect()
+        # The sampler's own list of samples grows by design
+        ignore_self = [tracemalloc.Filter(False, __file__)]
+        final_snapshot = tracemalloc.take_snapshot().filter_traces(ignore_self)
+        for stat in final_snapshot.compare_to(baseline_snapshot.filter_traces(ignore_self), "lineno")[:10]:
+            top_growth.append({"site": str(stat.traceback[0]), "growth_kb": round(stat.size_diff / 1024, 1)})
+        tracemalloc.stop()
+    return errors, top_growth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak a handler against comfy_stub.py and fail on resource growth")
+    parser.add_argument("--handler", choices=HANDLERS, default="rp_handler")
+    parser.add_argument("--jobs", type=int, default=2000, help="Measured jobs after the warmup")
+    parser.add_argument("--warmup", type=int, default=50, help="Jobs run before the baseline sample")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent handler calls")
+    parser.add_argument("--exec-delay", type=float, default=0.01, help="Stub execution seconds per job")
+    parser.add_argument("--output-bytes", type=int, default=200_000, help="Stub output image size")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Stub execution failure rate")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Seconds between resource samples")
+    parser.add_argument("--window", type=float, default=0.2, help="Fraction of samples compared at each end")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=64)
+    parser.add_argument("--max-fd-growth", type=int, default=8)
+    parser.add_argument("--max-thread-growth", type=int, default=4)
+    parser.add_argument("--max-tmp-growth-mb", type=float, default=16, help="Growth of TMPDIR, COMFY_DIR and the staging area each")
+    parser.add_argument("--tracemalloc", action="store_true", help="Report the allocation sites that grew most")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show handler logs")
+    args = parser.parse_args(argv)
+
+    # Private directories so only the handler's own files are counted
+    root = tempfile.mkdtemp(prefix="soak-")
+    tmp_dir = os.path.join(root, "tmp")
+    comfy_dir = os.path.join(root, "comfyui")
+    staging_dir = os.path.join(root, "staging")
+    for path in (tmp_dir, comfy_dir, staging_dir):
+        os.makedirs(path)
+    os.environ["TMPDIR"] = tmp_dir
+    tempfile.tempdir = None
+    os.environ["COMFY_DIR"] = comfy_dir
+    os.environ["COMFY_STAGING_DIR"] = staging_dir
+    os.environ.setdefault("JOB_LEDGER_DIR", os.path.join(root, "ledger"))
+
+    stub, comfy_host = start_stub(args.exec_delay, args.output_bytes, error_rate=args.error_rate)
+    try:
+        module = load_handler(args.handler, comfy_host)
+        for component in ("JANITOR", "LEDGER"):
+            if hasattr(module, component):
+                getattr(module, component).start()
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        sampler = Sampler(args.sample_interval, tmp_dir, comfy_dir, staging_dir)
+        inputs = job_inputs(args.handler, base64.b64encode(make_png()).decode("utf-8"))
+        sink = sys.stderr if args.verbose else open(os.devnull, "w")
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            errors, top_growth = soak(module, inputs, args, sampler)
+        wall = time.perf_counter() - started
+    finally:
+        stub.terminate()
+        stub.wait(timeout=10)
+
+    limits = {
+        "rss_mb": args.max_rss_growth_mb,
+        "fds": args.max_fd_growth,
+        "threads": args.max_thread_growth,
+        "tmp_mb": args.max_tmp_growth_mb,
+        "comfy_dir_mb": args.max_tmp_growth_mb,
+        "staging_mb": args.max_tmp_growth_mb,
+    }
+    resources, violations = {}, []
+    for metric, limit in limits.items():
+        resources[metric] = growth(sampler.samples, metric, args.window)
+        if resources[metric] and resources[metric]["growth"] > limit:
+            violations.append(f"{metric} grew by {resources[metric]['growth']} (limit {limit})")
+
+    report = {
+        "benchmark": "soak",
+        "timestamp": time.time(),
+        "config": {
+            "handler": args.handler,
+            "jobs": args.jobs,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "exec_delay_s": args.exec_delay,
+            "output_bytes": args.output_bytes,
+            "error_rate": args.error_rate,
+            "limits": limits,
+        },
+        "wall_s": wall,
+        "throughput_jobs_per_s": args.jobs / wall if wall else None,
+        "samples": len(sampler.samples),
+        "errors": sum(errors.values()),
+        "error_mix": errors,
+        "resources": resources,
+        "violations": violations,
+        "passed": not violations,
+    }
+    if top_growth:
+        report["top_allocation_growth"] = top_growth
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0 if not violations else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
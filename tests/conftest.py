@@ -0,0 +1,17 @@
+"""
+Shared setup for the unit tests: the worker modules live at the repository root and
+read their configuration at import time, so both are arranged before any test
+imports them. Nothing here talks to ComfyUI or RunPod.
+"""
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+_ROOT = tempfile.mkdtemp(prefix="worker-tests-")
+os.environ.setdefault("COMFY_DIR", os.path.join(_ROOT, "comfyui"))
+os.environ.setdefault("COMFY_STAGING_DIR", os.path.join(_ROOT, "staging"))
+os.environ.setdefault("JOB_LEDGER_DIR", os.path.join(_ROOT, "ledger"))
+os.environ.setdefault("METRICS_PORT", "0")
@@ -0,0 +1,32 @@
+from rp_admission import AdmissionController
+
+
+def controller(**kwargs):
+    return AdmissionController("127.0.0.1:1", max_wait_s=60, max_concurrency=1, prefetch=0, default_job_s=10, **kwargs)
+
+
+def test_admits_without_a_snapshot():
+    assert controller().concurrency_modifier(1) == 1
+
+
+def test_websocket_queue_remaining_closes_intake():
+    admission = controller()
+    admission.observe_queue_remaining(8)
+    # One running (half done) and seven pending prompts of 10s each
+    assert admission.estimated_wait_s() == 75
+    assert admission.concurrency_modifier(1) == 0
+    admission.observe_queue_remaining(1)
+    assert admission.concurrency_modifier(1) == 1
+
+
+def test_monitor_queue_depth_is_shared_across_instances():
+    admission = AdmissionController(["a:1", "b:1"], max_wait_s=60, max_concurrency=1, prefetch=0, default_job_s=10)
+    admission.observe_queue(2, 10)
+    assert admission.estimated_wait_s() == 55
+    assert admission.concurrency_modifier(1) == 2
+
+
+def test_held_jobs_count_as_pending():
+    admission = controller(held_jobs=lambda: 6)
+    admission.observe_queue(1, 0)
+    assert admission.concurrency_modifier(1) == 0
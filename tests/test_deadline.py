@@ -0,0 +1,73 @@
+import time
+
+import requests
+
+import rp_deadline
+from rp_deadline import JobDeadline, abort_prompt
+from rp_metrics import PROMPT_ABORTS
+
+
+class _Response:
+    def __init__(self, payload=None):
+        self.payload = payload or {}
+        self.status_code = 200
+        self.content = b"png"
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+def test_unreachable_comfyui_is_a_failed_abort(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(rp_deadline.requests, "get", refuse)
+    failed = PROMPT_ABORTS.value(action="failed")
+    assert abort_prompt("127.0.0.1:1", "p1") == "failed"
+    assert PROMPT_ABORTS.value(action="failed") == failed + 1
+
+
+def test_failed_interrupt_is_a_failed_abort(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(rp_deadline.requests, "get", lambda *a, **k: _Response({"queue_running": [[0, "p1"]]}))
+    monkeypatch.setattr(rp_deadline.requests, "post", refuse)
+    assert abort_prompt("127.0.0.1:1", "p1") == "failed"
+
+
+def test_unknown_prompt_is_not_found(monkeypatch):
+    monkeypatch.setattr(rp_deadline.requests, "get", lambda *a, **k: _Response({"queue_running": [], "queue_pending": []}))
+    assert abort_prompt("127.0.0.1:1", "p1") == "not_found"
+
+
+def test_example_handler_caps_its_timeouts(monkeypatch):
+    import handlerCOMEXAMPLE as h
+
+    timeouts = []
+    monkeypatch.setattr(h.requests, "get", lambda url, timeout=None, **k: timeouts.append(timeout) or _Response({}))
+    monkeypatch.setattr(h.requests, "post", lambda url, timeout=None, **k: timeouts.append(timeout) or _Response({"prompt_id": "p"}))
+    deadline = JobDeadline("job", 2)
+    h.get_image_data("a.png", "", "output", deadline)
+    h.get_history("p", deadline)
+    h.queue_workflow({}, "client", deadline)
+    h.reconcile_prompt_state("p", deadline)
+    h.check_server("http://127.0.0.1:1/", 1, 0, deadline)
+    assert timeouts and all(t <= 2 for t in timeouts)
+
+
+def test_example_handler_stops_checking_a_cancelled_job(monkeypatch):
+    import handlerCOMEXAMPLE as h
+
+    def refuse(*args, **kwargs):
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(h.requests, "get", refuse)
+    deadline = JobDeadline("job", 60)
+    deadline.cancel()
+    started = time.monotonic()
+    assert not h.check_server("http://127.0.0.1:1/", 500, 50, deadline)
+    assert time.monotonic() - started < 1
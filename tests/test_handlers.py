@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+
+import pytest
+import websocket
+
+from rp_metrics import ERRORS, JOBS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("module_name", ["rp_handler", "handlerCOMEXAMPLE"])
+@pytest.mark.parametrize("mode, prefetch", [("always", 0), ("never", 1), ("auto", 1)])
+def test_prefetch_is_off_when_every_job_refreshes(module_name, mode, prefetch):
+    # Module-level configuration, so each mode needs a fresh interpreter
+    env = dict(os.environ, REFRESH_WORKER=mode, ADMISSION_PREFETCH="1")
+    output = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module_name} as m; sys.stderr.write(f'prefetch {{m.ADMISSION.prefetch}}\\n')"],
+        cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stderr
+    # The handlers' own logs go to stdout
+    assert f"prefetch {prefetch}" in output.splitlines()
+
+
+@pytest.mark.parametrize("module_name", ["rp_handler", "handlerCOMEXAMPLE"])
+def test_crashed_jobs_are_counted(module_name, monkeypatch):
+    module = __import__(module_name)
+
+    def crash(job, deadline, trace=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(module, "_process_job", crash)
+    jobs = JOBS.value(handler=module.HANDLER_NAME, outcome="error")
+    errors = ERRORS.value(handler=module.HANDLER_NAME, type="unexpected")
+    with pytest.raises(RuntimeError):
+        module.handler({"id": "crash", "input": {}})
+    assert JOBS.value(handler=module.HANDLER_NAME, outcome="error") == jobs + 1
+    assert ERRORS.value(handler=module.HANDLER_NAME, type="unexpected") == errors + 1
+    assert module.REFRESH.status()["in_flight"] == 0
+
+
+class _FakeSocket:
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def connect(self, url, timeout=None):
+        pass
+
+    def recv(self):
+        if not self.messages:
+            raise websocket.WebSocketConnectionClosedException("closed")
+        return self.messages.pop(0)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("last, done", [
+    ({"type": "execution_success", "data": {"prompt_id": "p"}}, True),
+    ({"type": "executing", "data": {"node": None, "prompt_id": "p"}}, True),
+    ({"type": "execution_error", "data": {"prompt_id": "p"}}, True),
+    ({"type": "executing", "data": {"node": "3", "prompt_id": "p"}}, False),
+])
+def test_listener_reports_the_prompt_done(monkeypatch, last, done):
+    import rp_handler
+
+    messages = [json.dumps({"type": "executing", "data": {"node": "3", "prompt_id": "p"}}), json.dumps(last)]
+    monkeypatch.setattr(rp_handler.websocket, "WebSocket", lambda: _FakeSocket(messages))
+    finished = threading.Event()
+    nodes = []
+    ws, listener = rp_handler._open_ws_listener(rp_handler.INSTANCES.primary, "client", on_node=nodes.append, finished=finished)
+    listener.join(5)
+    # A dropped connection leaves completion to the /history poll
+    assert finished.is_set() is done
+    assert nodes[0] == "3"
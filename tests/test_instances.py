@@ -0,0 +1,65 @@
+from rp_instances import InstancePool, ComfyInstance, workflow_models
+
+WORKFLOW = {
+    "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "flux.safetensors"}},
+    "2": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "steps": 20}},
+}
+
+
+def pool(count=2):
+    return InstancePool([ComfyInstance(f"127.0.0.1:{8000 + i}", i) for i in range(count)], model_load_penalty=1.0)
+
+
+def test_routing_does_not_mark_models_resident():
+    p = pool()
+    instance = p.choose(WORKFLOW)
+    assert instance.residency(workflow_models(WORKFLOW)) == 0.0
+    p.release(instance)
+
+
+def test_failed_job_does_not_attract_affinity():
+    p = pool()
+    with p.acquire(WORKFLOW) as first:
+        pass  # the prompt failed, executed() is never called
+    # Both idle and cold: the tie goes to the lowest index, not to the failed job's instance by residency
+    second = p.choose(WORKFLOW)
+    assert second.residency(workflow_models(WORKFLOW)) == 0.0
+    p.release(second)
+    assert not first.resident
+
+
+def test_executed_job_attracts_affinity():
+    p = pool()
+    with p.acquire(WORKFLOW) as first:
+        pass
+    p.instances[1].executed(WORKFLOW)
+    with p.acquire(WORKFLOW) as second:
+        assert second is p.instances[1]
+    assert first is p.instances[0]
+
+
+def test_unhealthy_instances_are_a_last_resort():
+    p = pool()
+    p.instances[0].reachable = False
+    p.instances[0].polled_at = p.instances[1].polled_at = float("inf")
+    p.poll_interval_s = float("inf")
+    with p.acquire(WORKFLOW) as instance:
+        assert instance is p.instances[1]
+
+
+def test_only_model_files_count_as_models():
+    workflow = {
+        "1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux.safetensors", "weight_dtype": "default"}},
+        "2": {"class_type": "DualCLIPLoader", "inputs": {"clip_name1": "t5.safetensors", "clip_name2": "clip_l.SFT", "type": "flux"}},
+        "3": {"class_type": "LoraLoader", "inputs": {"lora_name": "style.pt", "strength_model": 1.0, "model": ["1", 0]}},
+        "4": {"class_type": "LoadImage", "inputs": {"image": "input.png"}},
+    }
+    assert workflow_models(workflow) == {"flux.safetensors", "t5.safetensors", "clip_l.SFT", "style.pt"}
+
+
+def test_shared_loader_options_do_not_attract_affinity():
+    p = pool()
+    other = {"1": {"class_type": "UNETLoader", "inputs": {"unet_name": "sdxl.safetensors", "weight_dtype": "default"}}}
+    p.instances[1].executed(other)
+    flux = {"1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux.safetensors", "weight_dtype": "default"}}}
+    assert p.instances[1].residency(workflow_models(flux)) == 0.0
@@ -0,0 +1,11 @@
+from rp_launch_profile import launch_args
+
+WORKFLOW = {"1": {"class_type": "NodeNoPackageRegisters", "inputs": {}}}
+
+
+def test_fallback_to_full_launches_like_full(tmp_path):
+    (tmp_path / "custom_nodes").mkdir()
+    full_args, full_plan = launch_args(str(tmp_path), [WORKFLOW], profile="full")
+    args, plan = launch_args(str(tmp_path), [WORKFLOW], profile="minimal")
+    assert plan["profile"] == full_plan["profile"] == "full"
+    assert args == full_args
@@ -0,0 +1,35 @@
+import pytest
+
+from rp_ledger import percentile, report
+
+
+@pytest.mark.parametrize("values, pct, expected", [
+    (range(1, 11), 90, 9),
+    (range(1, 11), 50, 5),
+    (range(1, 11), 99, 10),
+    (range(1, 11), 100, 10),
+    ([1, 2, 3, 4, 5, 6], 50, 3),
+    ([1, 2], 50, 1),
+    ([7], 50, 7),
+    ([3, 1, 2], 0, 1),
+    (range(1, 101), 99, 99),
+    (range(1, 101), 7, 7),
+])
+def test_nearest_rank(values, pct, expected):
+    assert percentile(list(values), pct) == expected
+
+
+def test_no_values():
+    assert percentile([], 50) is None
+
+
+def test_report_percentiles():
+    rows = [
+        {"finished_at": 100.0 + i, "total_s": float(i), "queue_wait_s": 0.0, "execution_s": float(i),
+         "output_bytes": 0, "outcome": "success", "workflow": "flux"}
+        for i in range(1, 11)
+    ]
+    (entry,) = report(rows)
+    assert entry["total_p50"] == 5
+    assert entry["total_p90"] == 9
+    assert entry["total_p99"] == 10
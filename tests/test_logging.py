@@ -0,0 +1,23 @@
+import base64
+
+import rp_logging
+from rp_logging import job_context, set_prompt_id
+from rp_inputs import stage_images
+
+
+def test_input_staging_workers_keep_the_job_context(tmp_path):
+    seen = []
+
+    def writer(name, blob):
+        seen.append((name, rp_logging._job_id.get(), rp_logging._prompt_id.get()))
+
+    image = base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"x" * 64).decode()
+    with job_context("job-1"):
+        set_prompt_id("prompt-1")
+        staged, errors = stage_images(
+            [{"name": f"{i}.png", "image": image} for i in range(4)], "127.0.0.1:1",
+            input_dir=str(tmp_path), writer=writer,
+        )
+    assert not errors and len(staged) == 4
+    assert sorted(seen) == [(f"{i}.png", "job-1", "prompt-1") for i in range(4)]
+
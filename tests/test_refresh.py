@@ -0,0 +1,90 @@
+from rp_refresh import RefreshPolicy, REFRESH_WORKER
+from rp_admission import AdmissionController
+
+
+def policy(mode="auto", **kwargs):
+    kwargs.setdefault("max_rss_growth_mb", 0)
+    kwargs.setdefault("min_ram_free_mb", 0)
+    return RefreshPolicy(mode=mode, **kwargs)
+
+
+def run(p, result, error_type=None):
+    p.job_started()
+    return p.job_finished(result, error_type)
+
+
+def test_default_mode_never_refreshes():
+    assert REFRESH_WORKER == "never"
+    p = RefreshPolicy(max_jobs=1)
+    assert p.mode == "never"
+    assert run(p, {"error": "CUDA out of memory"}, "execution") is None
+
+
+def test_worker_side_failures_build_an_error_streak():
+    p = policy(max_error_streak=3)
+    assert run(p, {"error": "Job processing failed"}, "execution") is None
+    assert run(p, {"error": "Job processing failed"}, "execution") is None
+    assert run(p, {"error": "Job processing failed"}, "execution").startswith("error_streak")
+
+
+def test_client_errors_and_successes_do_not_count():
+    p = policy(max_error_streak=2)
+    assert run(p, {"error": "bad"}, "execution") is None
+    assert run(p, {"error": "No images"}, "no_output") is None
+    assert run(p, {"error": "bad input"}, "validation") is None
+    assert run(p, {"images": []}) is None
+    assert run(p, {"error": "bad"}, "execution") is None
+    assert p.status()["error_streak"] == 1
+
+
+def test_oom_found_in_details():
+    p = policy()
+    result = {
+        "error": "Job processing failed",
+        "details": ["Workflow execution error: Node Type: KSampler, Message: CUDA out of memory. Tried to allocate"],
+    }
+    assert run(p, result, "execution").startswith("oom")
+
+
+def test_oom_found_in_errors():
+    p = policy()
+    assert run(p, {"error": "failed", "errors": ["torch.OutOfMemoryError"]}, "execution").startswith("oom")
+
+
+def test_refresh_waits_for_jobs_in_flight():
+    p = policy(max_jobs=1)
+    p.job_started()
+    p.job_started()
+    assert p.job_finished({"images": []}) is None
+    assert p.pending_reason().startswith("max_jobs")
+    assert p.job_finished({"images": []}).startswith("max_jobs")
+
+
+def test_always_refreshes_every_job_when_jobs_run_alone():
+    p = policy(mode="always")
+    assert p.exclusive
+    assert [run(p, {"images": []}) for _ in range(3)] == ["always"] * 3
+
+
+def test_always_with_a_prefetched_job_skips_refreshes():
+    # Why the handlers turn prefetch off in this mode: an overlapping job defers the refresh
+    p = policy(mode="always")
+    p.job_started()
+    p.job_started()
+    assert p.job_finished({"images": []}) is None
+
+
+def test_prefetch_off_leaves_only_the_configured_concurrency():
+    admission = AdmissionController("127.0.0.1:1", max_concurrency=1, prefetch=0)
+    assert admission.concurrency_modifier(1) == 1
+    admission = AdmissionController("127.0.0.1:1", max_concurrency=1, prefetch=1)
+    assert admission.concurrency_modifier(1) == 2
+
+
+def test_pending_refresh_closes_admission():
+    p = policy(max_jobs=1)
+    admission = AdmissionController("127.0.0.1:1", pause_reason=p.pending_reason)
+    p.job_started()
+    p.job_started()
+    p.job_finished({"images": []})
+    assert admission.concurrency_modifier(1) == 0
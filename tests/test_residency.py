@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from rp_residency import ModelSizes, ResidencyManager
+
+GB = 1024 ** 3
+BLUR = {
+    "1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux.safetensors", "weight_dtype": "flux.1"}},
+    "2": {"class_type": "ControlNetLoader", "inputs": {"control_net_name": "blur.safetensors"}},
+}
+TILE = {
+    "1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux.safetensors", "weight_dtype": "flux.1"}},
+    "2": {"class_type": "ControlNetLoader", "inputs": {"control_net_name": "tile.safetensors"}},
+}
+
+
+class _Freed:
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    for rel, size in (("unet/flux/flux.safetensors", 6 * GB), ("controlnet/blur.safetensors", 3 * GB),
+                      ("controlnet/tile.safetensors", 3 * GB)):
+        path = tmp_path / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+    return str(tmp_path)
+
+
+def test_non_model_names_never_scan(model_dir, monkeypatch):
+    sizes = ModelSizes([model_dir])
+    scans = []
+    monkeypatch.setattr(sizes, "_scan", lambda: scans.append(1))
+    assert sizes.size("flux.1") is None
+    assert sizes.size("bfloat16") is None
+    assert not scans
+
+
+def test_model_files_are_sized(model_dir):
+    sizes = ModelSizes([model_dir])
+    assert sizes.size("flux.safetensors") == 6 * GB
+    # Names are relative to the model type folder, as workflows write them
+    assert sizes.size("flux/flux.safetensors") == 6 * GB
+    assert sizes.size("flux\\flux.safetensors") == 6 * GB
+    assert sizes.size("missing.safetensors") is None
+
+
+def test_swap_rank_and_prepare_never_touch_the_filesystem(model_dir, monkeypatch):
+    manager = ResidencyManager([model_dir], budget_mb=10 * 1024)
+    blur, tile = manager.demand(BLUR), manager.demand(TILE)
+
+    def no_io(name):
+        raise AssertionError(f"sized {name} after demand()")
+
+    monkeypatch.setattr(manager.sizes, "size", no_io)
+    monkeypatch.setattr("rp_residency.requests.post", lambda *args, **kwargs: _Freed())
+    assert manager.swap_rank("host", blur) == 0
+    assert manager.prepare("host", blur) == "load"
+    assert manager.prepare("host", blur) == "hit"
+    assert manager.swap_rank("host", tile) >= 1
+    assert manager.prepare("host", tile) == "swap"
+
+
+def test_demand_only_counts_sized_models(model_dir):
+    manager = ResidencyManager([model_dir])
+    assert {name for name, _ in manager.demand(BLUR)} == {"flux.safetensors", "blur.safetensors"}
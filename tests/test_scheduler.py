@@ -0,0 +1,41 @@
+import time
+
+from rp_scheduler import estimate_cost, tail_nodes, PromptScheduler, _Ticket
+
+WORKFLOW = {
+    "1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux.safetensors"}},
+    "2": {"class_type": "EmptyLatentImage", "inputs": {"width": 1024, "height": 1024, "batch_size": 1}},
+    "3": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "latent_image": ["2", 0], "steps": 20}},
+    "4": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0]}},
+    "5": {"class_type": "SaveImage", "inputs": {"images": ["4", 0]}},
+}
+
+
+def test_tail_nodes_follow_the_sampler():
+    assert tail_nodes(WORKFLOW) == {"4", "5"}
+
+
+def test_no_sampler_no_tail():
+    assert tail_nodes({"1": {"class_type": "LoadImage", "inputs": {}}}) == set()
+
+
+def test_cost_grows_with_steps_and_size():
+    bigger = dict(WORKFLOW, **{"3": dict(WORKFLOW["3"], inputs=dict(WORKFLOW["3"]["inputs"], steps=40))})
+    assert estimate_cost(bigger) == 2 * estimate_cost(WORKFLOW)
+
+
+def test_resident_jobs_go_first_among_equal_priorities():
+    resident = frozenset({("a.safetensors", 1)})
+    scheduler = PromptScheduler(target_depth=1, swap_rank=lambda key, models: 0 if models == resident else 1)
+    cheap_swap = _Ticket("host", 1.0, 0, 1, frozenset({("b.safetensors", 1)}))
+    costly_resident = _Ticket("host", 5.0, 0, 2, resident)
+    scheduler._waiting = [cheap_swap, costly_resident]
+    assert scheduler._next_for("host", time.monotonic()) is costly_resident
+
+
+def test_priority_beats_residency():
+    resident = frozenset({("a.safetensors", 1)})
+    scheduler = PromptScheduler(target_depth=1, swap_rank=lambda key, models: 0 if models == resident else 1)
+    urgent = _Ticket("host", 1.0, 10, 1, frozenset({("b.safetensors", 1)}))
+    scheduler._waiting = [_Ticket("host", 1.0, 0, 2, resident), urgent]
+    assert scheduler._next_for("host", time.monotonic()) is urgent
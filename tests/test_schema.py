@@ -0,0 +1,60 @@
+import rp_schema
+from rp_schema import ObjectInfoCache
+
+
+class _Response:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"KSampler": {}}
+
+
+def test_expire_is_rate_limited(monkeypatch):
+    fetches = []
+    monkeypatch.setattr(rp_schema.requests, "get", lambda *args, **kwargs: fetches.append(1) or _Response())
+    cache = ObjectInfoCache("127.0.0.1:1")
+    cache.get()
+    # A burst of ComfyUI 400s right after a fetch keeps the schema
+    for _ in range(5):
+        assert not cache.expire(min_age_s=30)
+        cache.get()
+    assert len(fetches) == 1
+    assert cache.expire(min_age_s=0)
+    cache.get()
+    assert len(fetches) == 2
+
+
+def test_failed_fetches_are_rate_limited(monkeypatch):
+    fetches = []
+
+    def unreachable(*args, **kwargs):
+        fetches.append(1)
+        raise rp_schema.requests.ConnectionError("refused")
+
+    monkeypatch.setattr(rp_schema.requests, "get", unreachable)
+    cache = ObjectInfoCache("127.0.0.1:1", retry_after_s=30)
+    for _ in range(5):
+        assert cache.get() is None
+        assert cache.get(max_age_s=0) is None
+    assert len(fetches) == 1
+
+    cache.retry_after_s = 0
+    monkeypatch.setattr(rp_schema.requests, "get", lambda *args, **kwargs: fetches.append(1) or _Response())
+    assert cache.get() == {"KSampler": {}}
+    assert len(fetches) == 2
+
+
+def test_bad_json_keeps_the_last_good_schema(monkeypatch):
+    class _Garbage(_Response):
+        def json(self):
+            raise ValueError("not JSON")
+
+    monkeypatch.setattr(rp_schema.requests, "get", lambda *args, **kwargs: _Response())
+    cache = ObjectInfoCache("127.0.0.1:1", retry_after_s=30)
+    cache.get()
+    fetches = []
+    monkeypatch.setattr(rp_schema.requests, "get", lambda *args, **kwargs: fetches.append(1) or _Garbage())
+    for _ in range(3):
+        assert cache.get(max_age_s=0) == {"KSampler": {}}
+    assert len(fetches) == 1
@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+
+import rp_staging
+from rp_staging import StagingArea
+from rp_janitor import Janitor
+from rp_inputs import InputImageError
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def staging(tmp_path):
+    return StagingArea(str(tmp_path / "comfyui"), staging_dir=str(tmp_path / "shm"), max_mb=1, spill_age_s=0)
+
+
+def test_status_never_walks(staging, monkeypatch):
+    staging.write_input("a.png", b"x" * 1000)
+    monkeypatch.setattr(rp_staging.os, "walk", lambda *args, **kwargs: pytest.fail("status() walked the staging area"))
+    assert staging.status()["used_mb"] == round(1000 / MB, 1)
+
+
+def test_writes_within_the_cap_do_not_walk(staging, monkeypatch):
+    staging.write_input("a.png", b"x" * 1000)
+    monkeypatch.setattr(rp_staging.os, "walk", lambda *args, **kwargs: pytest.fail("write_input() walked"))
+    staging.write_input("b.png", b"x" * 1000)
+
+
+def test_full_area_spills_old_files(staging):
+    staging.write_input("a.png", b"a" * (MB * 3 // 4))
+    path = staging.write_input("b.png", b"b" * (MB // 2))
+    assert not os.path.islink(path)
+    # a.png moved to disk, still readable under its name
+    moved = os.path.join(staging.dir("input"), "a.png")
+    assert os.path.islink(moved)
+    assert open(moved, "rb").read(1) == b"a"
+    assert staging.status()["spilled_files"] == 1
+
+
+def test_input_too_big_for_the_area_goes_to_disk(staging):
+    path = staging.write_input("big.png", b"x" * (2 * MB))
+    assert os.path.islink(path)
+    assert os.path.realpath(path).startswith(os.path.realpath(staging.spill_dir("input")))
+    assert staging.status()["disk_writes"] == 1
+
+
+def test_names_cannot_escape(staging):
+    with pytest.raises(InputImageError):
+        staging.write_input("../escape.png", b"x")
+
+
+def test_janitor_deletes_release_staged_bytes(staging):
+    janitor = Janitor(staging.comfy_dir, roots=staging.roots(), on_delete=staging.released)
+    janitor._thread = True  # accept discard_output() without the background thread
+    staging.write_input("a.png", b"x" * 1000)
+    janitor.discard_output({"filename": "a.png", "type": "input"})
+    assert janitor.delete_delivered_now() == 1000
+    assert staging.status()["used_mb"] == 0
+
+
+def test_janitor_deletes_spilled_copy_with_its_link(staging):
+    janitor = Janitor(staging.comfy_dir, roots=staging.roots())
+    janitor._thread = True
+    path = staging.write_input("big.png", b"x" * (2 * MB))
+    target = os.path.realpath(path)
+    janitor.discard_output({"filename": "big.png", "type": "input"})
+    assert janitor.delete_delivered_now() == 2 * MB
+    assert not os.path.lexists(path) and not os.path.exists(target)
+
+
+def test_spilling_copies_without_holding_the_lock(staging, monkeypatch):
+    staging.write_input("a.png", b"a" * (MB * 3 // 4))
+    copying, release = threading.Event(), threading.Event()
+    copyfile = rp_staging.shutil.copyfile
+
+    def slow_copyfile(src, dst):
+        copying.set()
+        release.wait(5)
+        return copyfile(src, dst)
+
+    monkeypatch.setattr(rp_staging.shutil, "copyfile", slow_copyfile)
+    writer = threading.Thread(target=staging.write_input, args=("b.png", b"b" * (MB // 2)))
+    writer.start()
+    assert copying.wait(5)
+    # Mid-copy, the area still answers and takes writes that fit
+    reader = threading.Thread(target=staging.status)
+    reader.start()
+    reader.join(1)
+    assert not reader.is_alive()
+    staging.write_input("c.png", b"c" * 1000)
+    release.set()
+    writer.join(5)
+    status = staging.status()
+    assert status["spilled_files"] == 1 and status["disk_writes"] == 0
+    assert os.path.islink(os.path.join(staging.dir("input"), "a.png"))
+    assert status["used_mb"] == round((MB // 2 + 1000) / MB, 1)
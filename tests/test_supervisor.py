@@ -0,0 +1,46 @@
+from rp_supervisor import ComfySupervisor
+
+
+def supervisor(**kwargs):
+    return ComfySupervisor(["/bin/true"], backoff_s=0.01, backoff_max_s=0.02, echo=False, **kwargs)
+
+
+def test_failed_spawns_count_towards_the_restart_limit():
+    s = supervisor(max_restarts=3)
+    s.start()
+    s.command = ["/nonexistent/comfyui"]
+    s._monitor.join(5)
+    assert not s._monitor.is_alive()
+    assert s.restarts == 3
+
+
+def test_failed_spawn_is_retried_without_waiting_on_the_dead_process():
+    s = supervisor(max_restarts=3)
+    s.start()
+    first = s.process
+    s.command = ["/nonexistent/comfyui"]
+    waits = []
+    original_wait = first.wait
+
+    def counting_wait(*args, **kwargs):
+        waits.append(1)
+        return original_wait(*args, **kwargs)
+
+    first.wait = counting_wait
+    s._monitor.join(5)
+    # The only wait is the one that noticed the exit
+    assert len(waits) <= 1
+    assert s.process is first
+
+
+def test_restarts_until_stopped_without_a_limit():
+    s = supervisor(max_restarts=0)
+    s.start()
+    try:
+        for _ in range(200):
+            if s.restarts >= 2:
+                break
+            s._monitor.join(0.02)
+        assert s.restarts >= 2
+    finally:
+        s.stop()